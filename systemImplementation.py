@@ -1,139 +1,4810 @@
 import argparse
+import collections
+import contextlib
+import contextvars
+import csv
+import hashlib
+import heapq
+import inspect
+import io
 import json
+import math
+import multiprocessing
+import os
+import platform
+import queue
+import socketserver
+import subprocess
+import tempfile
 import sys
-from deepface import DeepFace
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Lazy heavy imports
+#
+# Importing deepface pulls in TensorFlow, which takes seconds. `DeepFace` is a
+# stand-in that performs the real import on first attribute access, so
+# --help, argument errors and pure-NumPy paths never pay for it. cv2 is
+# imported inside the functions that use it for the same reason.
+# ────────────────────────────────────────────────────────────────────────────────
+# Seconds spent on lazy imports / model loads, reported by --profile-startup
+STARTUP_PROFILE = {}
+
+
+class _LazyDeepFace:
+    def __init__(self):
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    start = time.perf_counter()
+                    from deepface import DeepFace as module
+                    STARTUP_PROFILE["deepface_import_s"] = round(
+                        time.perf_counter() - start, 3
+                    )
+                    self._module = module
+        return getattr(self._module, name)
+
+
+DeepFace = _LazyDeepFace()
+
+
+# File extensions treated as gallery images when scanning a db_path
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+# Hidden folder inside db_path that holds the embedding store(s)
+STORE_DIRNAME = ".facetool"
+# Bump whenever the on-disk store layout (or the way gallery embeddings are
+# computed) changes; older stores are rebuilt
+STORE_VERSION = 7
+# Per-generation data files of an embedding store checkpoint
+STORE_TABLES = ("embeddings", "norms", "names", "row_files", "areas", "files")
+# Gallery search backends selectable from recognize --index
+INDEX_KINDS = ("exact", "hnsw", "int8", "float16", "pq")
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Class   : StageTimer
+# Purpose : Per-stage wall-clock / CPU timings and event counters for one
+#           command. Code marks stages with `with _stage("embed"):` and counts
+#           events with `_count("faces", n)`; both are no-ops unless a timer
+#           has been activated for the current context via `_use_timer()`.
+#
+# Stages used across the tool:
+#   • decode        reading the image file into an array
+#   • detect_align  face detection + alignment (DeepFace.extract_faces)
+#   • embed         recognition model forward pass
+#   • embed_queue   wait for a micro-batch to close (serve mode only)
+#   • search        gallery nearest-neighbour search
+#   • compare       verification distance between two images
+#   • index_load    loading (or building) an ANN index from disk
+#   • store_sync    gallery scan and embedding of new files (nests the above)
+#   • preprocess / age / gender / race / emotion   attribute analysis
+#
+# CPU time is per thread (time.thread_time), so concurrent requests in the
+# server do not inflate each other's numbers.
+# ────────────────────────────────────────────────────────────────────────────────
+class StageTimer:
+    def __init__(self):
+        self.stages = {}    # name -> {"wall_ms", "cpu_ms", "calls"}
+        self.counters = {}  # name -> int
+        self._start = time.perf_counter()
+        # Pipeline stages (video mode) record from several threads at once
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        wall0, cpu0 = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add_stage(
+                name,
+                (time.perf_counter() - wall0) * 1000.0,
+                (time.thread_time() - cpu0) * 1000.0
+            )
+
+    def add_stage(self, name: str, wall_ms: float, cpu_ms: float = 0.0, calls: int = 1) -> None:
+        with self._lock:
+            entry = self.stages.setdefault(name, {"wall_ms": 0.0, "cpu_ms": 0.0, "calls": 0})
+            entry["wall_ms"] += wall_ms
+            entry["cpu_ms"] += cpu_ms
+            entry["calls"] += calls
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other: dict) -> None:
+        # Fold in the as_dict() output of another timer (e.g. from a worker)
+        for name, entry in other.get("stages", {}).items():
+            self.add_stage(name, entry["wall_ms"], entry["cpu_ms"], entry["calls"])
+        for name, n in other.get("counters", {}).items():
+            self.count(name, n)
+
+    def as_dict(self) -> dict:
+        return {
+            "total_wall_ms": round((time.perf_counter() - self._start) * 1000.0, 3),
+            "stages": {
+                name: {k: round(v, 3) for k, v in entry.items()}
+                for name, entry in self.stages.items()
+            },
+            "counters": dict(self.counters),
+        }
+
+    def write_prometheus(self, path: str, command: str) -> None:
+        # Prometheus text exposition format, written atomically so a
+        # node_exporter textfile collector never reads a partial file
+        lines = [
+            "# HELP facetool_stage_wall_seconds Wall-clock time spent per stage.",
+            "# TYPE facetool_stage_wall_seconds gauge",
+        ]
+        for name, entry in self.stages.items():
+            lines.append(
+                f'facetool_stage_wall_seconds{{command="{command}",stage="{name}"}} '
+                f'{entry["wall_ms"] / 1000.0:.6f}'
+            )
+        lines += [
+            "# HELP facetool_stage_cpu_seconds Thread CPU time spent per stage.",
+            "# TYPE facetool_stage_cpu_seconds gauge",
+        ]
+        for name, entry in self.stages.items():
+            lines.append(
+                f'facetool_stage_cpu_seconds{{command="{command}",stage="{name}"}} '
+                f'{entry["cpu_ms"] / 1000.0:.6f}'
+            )
+        lines += [
+            "# HELP facetool_stage_calls Number of times each stage ran.",
+            "# TYPE facetool_stage_calls gauge",
+        ]
+        for name, entry in self.stages.items():
+            lines.append(
+                f'facetool_stage_calls{{command="{command}",stage="{name}"}} {entry["calls"]}'
+            )
+        lines += [
+            "# HELP facetool_events Event counters (faces, images, hits…).",
+            "# TYPE facetool_events gauge",
+        ]
+        for name, n in self.counters.items():
+            lines.append(f'facetool_events{{command="{command}",name="{name}"}} {n}')
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fp:
+            fp.write("\n".join(lines) + "\n")
+        os.replace(tmp, path)
+
+
+_current_timer = contextvars.ContextVar("facetool_timer", default=None)
+
+
+@contextlib.contextmanager
+def _use_timer(timer: StageTimer = None):
+    # Make `timer` the target of _stage()/_count() inside this block
+    # (None leaves the current timer, if any, in place)
+    if timer is None:
+        yield _current_timer.get()
+        return
+    token = _current_timer.set(timer)
+    try:
+        yield timer
+    finally:
+        _current_timer.reset(token)
+
+
+def _stage(name: str):
+    timer = _current_timer.get()
+    return timer.stage(name) if timer is not None else contextlib.nullcontext()
+
+
+def _count(name: str, n: int = 1) -> None:
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.count(name, n)
+
+
+# recognize_face / analyze_face / verify_faces print errors and return an
+# empty result; inside `with _raising():` they re-raise instead, so callers
+# that report errors themselves (the stdin worker) can see them
+_raise_errors = contextvars.ContextVar("facetool_raise_errors", default=False)
+
+
+@contextlib.contextmanager
+def _raising():
+    token = _raise_errors.set(True)
+    try:
+        yield
+    finally:
+        _raise_errors.reset(token)
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Helpers: gallery scanning, hashing and thresholds
+# ────────────────────────────────────────────────────────────────────────────────
+def _list_images(db_path: str) -> list:
+    # Walk db_path and return sorted relative paths of every image file,
+    # skipping the store folder so cached artefacts are never embedded
+    found = []
+    for root, dirs, files in os.walk(db_path):
+        dirs[:] = [d for d in dirs if d != STORE_DIRNAME]
+        for name in files:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                found.append(os.path.relpath(os.path.join(root, name), db_path))
+    return sorted(found)
+
+
+def _file_hash(path: str) -> str:
+    # SHA-1 of the file contents, read in 1 MiB chunks
+    digest = hashlib.sha1()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _load_image(img_path) -> np.ndarray:
+    # Decode an image file, or encoded bytes, to a BGR uint8 array (arrays
+    # pass straight through)
+    if isinstance(img_path, np.ndarray):
+        return img_path
+    import cv2
+
+    with _stage("decode"):
+        if isinstance(img_path, (bytes, bytearray, memoryview)):
+            img = cv2.imdecode(np.frombuffer(img_path, dtype=np.uint8), cv2.IMREAD_COLOR)
+        else:
+            img = cv2.imread(img_path)
+    if img is None:
+        if isinstance(img_path, (bytes, bytearray, memoryview)):
+            raise ValueError("Could not decode in-memory image")
+        raise ValueError(f"Could not read image: {img_path}")
+    return img
+
+
+def _image_input(img):
+    # Normalize what the Python API accepts as an image: a path, encoded
+    # bytes (bytes / bytearray / memoryview), a binary file-like object, or
+    # an HxWx3 uint8 BGR array. File objects are read once into memory
+    # (BytesIO without a copy); arrays and bytes are passed on untouched.
+    if isinstance(img, np.ndarray):
+        if img.dtype != np.uint8 or img.ndim != 3 or img.shape[2] != 3:
+            raise ValueError(
+                f"Image arrays must be HxWx3 uint8 (BGR), got {img.dtype} {img.shape}"
+            )
+        return img
+    if isinstance(img, (bytes, bytearray, memoryview, str)):
+        return img
+    if isinstance(img, os.PathLike):
+        return os.fspath(img)
+    if hasattr(img, "getbuffer"):
+        return img.getbuffer()
+    if hasattr(img, "read"):
+        return img.read()
+    raise TypeError(f"Unsupported image input: {type(img).__name__}")
+
+
+def _detect_faces(img: np.ndarray, detector_backend: str, enforce_detection: bool = True) -> list:
+    # Detect and align every face in a decoded image
+    with _stage("detect_align"):
+        faces = DeepFace.extract_faces(
+            img_path=img,
+            detector_backend=detector_backend,
+            enforce_detection=enforce_detection,
+            align=True
+        )
+    _count("faces", len(faces))
+    return faces
+
+
+# Reduced-size decoding (--detect-side / $FACETOOL_DETECT_SIDE): faces at
+# least this many pixels wide and high in the reduced image keep the crop
+# aligned there; smaller ones are re-aligned from the full-resolution image.
+REDUCED_MIN_FACE = 160
+
+
+def _detect_side() -> int:
+    # Target longer side for reduced JPEG decoding; 0 = decode at full size
+    return int(os.environ.get("FACETOOL_DETECT_SIDE") or 0)
+
+
+def _load_image_reduced(img, side: int):
+    # Decode a JPEG (path or encoded bytes) at reduced size with PIL draft
+    # mode: libjpeg scales by 1/2, 1/4 or 1/8 while decoding, picking the
+    # strongest reduction that keeps the longer side >= `side`. The EXIF
+    # orientation is applied like cv2.imread does. Returns (BGR array,
+    # reduced / full-resolution scale), or None when the input is not a
+    # JPEG or would not shrink, in which case the caller decodes normally.
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+    if isinstance(img, (bytes, bytearray, memoryview)):
+        img = io.BytesIO(img)
+    with _stage("decode_reduced"):
+        try:
+            pil = Image.open(img)
+        except OSError:
+            return None
+        with pil:
+            width, height = pil.size
+            factor = side / max(width, height)
+            if pil.format != "JPEG" or factor > 0.5:
+                return None
+            pil.draft("RGB", (math.ceil(width * factor), math.ceil(height * factor)))
+            scale = pil.size[0] / width
+            reduced = ImageOps.exif_transpose(pil.convert("RGB"))
+        return np.ascontiguousarray(np.asarray(reduced)[:, :, ::-1]), scale
+
+
+def _scale_area(area: dict, factor: float, dx: int = 0, dy: int = 0) -> dict:
+    # Map a facial_area (box plus any landmark points such as left_eye) by
+    # `factor`, then shift it by (dx, dy)
+    scaled = {}
+    for name, value in area.items():
+        if name in ("x", "y"):
+            scaled[name] = int(round(value * factor)) + (dx if name == "x" else dy)
+        elif name in ("w", "h"):
+            scaled[name] = int(round(value * factor))
+        elif isinstance(value, (tuple, list)) and len(value) == 2:
+            scaled[name] = (int(round(value[0] * factor)) + dx, int(round(value[1] * factor)) + dy)
+        else:
+            scaled[name] = value
+    return scaled
+
+
+def _detect_image(
+    img,
+    detector_backend: str,
+    enforce_detection: bool = True,
+    detect_side: int = 0
+) -> list:
+    # Decode + detect + align one image. With detect_side, JPEG paths/bytes
+    # are decoded at reduced size and the detector runs there; facial areas
+    # are mapped back to full-resolution coordinates, and faces too small
+    # for a clean crop are re-aligned from the full-resolution image, which
+    # is decoded only in that case.
+    reduced = None
+    if detect_side and not isinstance(img, np.ndarray):
+        reduced = _load_image_reduced(img, detect_side)
+    if reduced is None:
+        return _detect_faces(_load_image(img), detector_backend, enforce_detection)
+    small, scale = reduced
+    _count("reduced_decodes")
+    full, faces = None, []
+    for face in _detect_faces(small, detector_backend, enforce_detection):
+        area = face["facial_area"]
+        # confidence 0: enforce_detection=False returned the whole image
+        if min(area["w"], area["h"]) >= REDUCED_MIN_FACE or face.get("confidence") == 0:
+            faces.append(dict(face, facial_area=_scale_area(area, 1.0 / scale)))
+            continue
+        if full is None:
+            full = _load_image(img)
+        faces.append(_realign_face(full, face, _scale_area(area, 1.0 / scale), detector_backend))
+    return faces
+
+
+def _realign_face(full: np.ndarray, face: dict, area: dict, detector_backend: str) -> dict:
+    # Detect + align again inside a margin around `area` (full-resolution
+    # coordinates); keeps the reduced-image crop if nothing is found there
+    margin = max(area["w"], area["h"]) // 2
+    x0, y0 = max(area["x"] - margin, 0), max(area["y"] - margin, 0)
+    x1 = min(area["x"] + area["w"] + margin, full.shape[1])
+    y1 = min(area["y"] + area["h"] + margin, full.shape[0])
+    with _stage("detect_align"):
+        found = DeepFace.extract_faces(
+            img_path=np.ascontiguousarray(full[y0:y1, x0:x1]),
+            detector_backend=detector_backend,
+            enforce_detection=False,
+            align=True
+        )
+    found = [f for f in found if f.get("confidence")]
+    if not found:
+        return dict(face, facial_area=area)
+    _count("full_res_realigns")
+    best = max(found, key=lambda f: f["facial_area"]["w"] * f["facial_area"]["h"])
+    return dict(best, facial_area=_scale_area(best["facial_area"], 1.0, x0, y0))
+
+
+def _represent(
+    img_path: str,
+    model_name: str,
+    detector_backend: str,
+    enforce_detection: bool = True,
+    gallery: bool = False
+) -> list:
+    # Default embedder: decode, detect + align, then embed all face crops in
+    # one forward pass, each step timed as its own stage. Returns a list of
+    # {"embedding", "facial_area", ...} dicts, one per detected face, like
+    # DeepFace.represent(). Any callable with the first four arguments can
+    # be passed as `embedder`. gallery selects the crop cache policy of
+    # _extract_faces().
+    faces = _extract_faces(img_path, detector_backend, enforce_detection, gallery)
+    with _stage("embed"):
+        vectors = embed_faces([face["face"] for face in faces], model_name)
+    return [
+        {
+            "embedding": vector,
+            "facial_area": face["facial_area"],
+            "face_confidence": face.get("confidence"),
+        }
+        for face, vector in zip(faces, vectors)
+    ]
+
+
+def _represent_gallery(
+    img_path: str,
+    model_name: str,
+    detector_backend: str,
+    enforce_detection: bool = True
+) -> list:
+    # _represent() for images that become part of a gallery
+    return _represent(img_path, model_name, detector_backend, enforce_detection, gallery=True)
+
+
+def _json_default(obj):
+    # NumPy scalars/arrays that DeepFace sometimes leaves in its results
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _prepare_face(face: np.ndarray, input_shape: tuple) -> np.ndarray:
+    # Mirror DeepFace.represent(): RGB crop -> BGR, letterbox to the model's
+    # (width, height) input size, scale to [0, 1]
+    import cv2
+
+    img = np.asarray(face)[:, :, ::-1]
+    target_h, target_w = input_shape[1], input_shape[0]
+    if img.shape[0] and img.shape[1]:
+        factor = min(target_h / img.shape[0], target_w / img.shape[1])
+        size = (int(img.shape[1] * factor), int(img.shape[0] * factor))
+        img = cv2.resize(img, size)
+    dh, dw = target_h - img.shape[0], target_w - img.shape[1]
+    img = np.pad(img, ((dh // 2, dh - dh // 2), (dw // 2, dw - dw // 2), (0, 0)))
+    img = img.astype(np.float32)
+    if img.max() > 1:
+        img /= 255.0
+    return img
+
+
+def embed_faces(faces: list, model_name: str) -> np.ndarray:
+    # Embed a list of aligned face crops (as returned by extract_faces) with a
+    # single forward pass when the model allows it
+    if not faces:
+        return np.zeros((0, 0), dtype=np.float32)
+    model = DeepFace.build_model(model_name)
+    batch = np.stack([_prepare_face(face, model.input_shape) for face in faces])
+    keras_model = getattr(model, "model", None)
+    try:
+        from deepface.models.FacialRecognition import FacialRecognition
+        plain_forward = type(model).forward is FacialRecognition.forward
+    except ImportError:  # deepface < 0.0.86
+        plain_forward = True
+    if plain_forward and hasattr(keras_model, "predict_on_batch"):
+        out = keras_model.predict_on_batch(batch)
+        return np.asarray(out, dtype=np.float32).reshape(len(faces), -1)
+    # Models with custom post-processing (or no Keras graph) go one by one
+    return np.asarray(
+        [model.forward(img[None, ...]) for img in batch], dtype=np.float32
+    ).reshape(len(faces), -1)
+
+
+def _find_threshold(model_name: str, distance_metric: str) -> float:
+    # DeepFace moved its threshold table between releases
+    try:
+        from deepface.modules.verification import find_threshold
+    except ImportError:  # deepface < 0.0.80
+        from deepface.commons.distance import findThreshold as find_threshold
+    return float(find_threshold(model_name, distance_metric))
+
+
+@contextlib.contextmanager
+def _store_lock(store_dir: str):
+    # Exclusive inter-process lock for store writers (checkpoints, enroll,
+    # unenroll). Readers never take it. No-op where fcntl is unavailable.
+    os.makedirs(store_dir, exist_ok=True)
+    with open(os.path.join(store_dir, ".lock"), "a+b") as fp:
+        try:
+            import fcntl
+        except ImportError:  # Windows
+            yield
+            return
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+def _grown(buf: np.ndarray, n: int, fill=0) -> np.ndarray:
+    # Return a writable buffer with room for n rows: buf itself if it already
+    # has the capacity, else a copy with capacity doubled (amortised O(1) per
+    # appended row). Rows past the old length are set to fill. Read-only
+    # (memory-mapped) buffers are always copied, so only call this when rows
+    # are actually being appended.
+    if len(buf) >= n and buf.flags.writeable:
+        return buf
+    out = np.full((max(n, 2 * len(buf)),) + buf.shape[1:], fill, dtype=buf.dtype)
+    out[:len(buf)] = buf
+    return out
+
+
+class _RowIdentities:
+    # EmbeddingStore.identities: the full image path of every row, or None
+    # for rows unenrolled since the checkpoint. Checkpoint rows resolve
+    # through the mapped names / row_files tables, so nothing is built per
+    # row up front; rows enrolled since are kept in a plain list.
+    def __init__(self, db_path: str, names: np.ndarray, row_files: np.ndarray):
+        self.db_path = db_path
+        self.names = names
+        self.row_files = row_files
+        self.appended = []
+        self.dead = set()
+
+    def __len__(self) -> int:
+        return len(self.row_files) + len(self.appended)
+
+    def __getitem__(self, row: int):
+        if row in self.dead:
+            return None
+        if row >= len(self.row_files):
+            return self.appended[row - len(self.row_files)]
+        return os.path.join(self.db_path, str(self.names[self.row_files[row]]))
+
+
+class _RowAreas:
+    # EmbeddingStore.facial_areas: {"x", "y", "w", "h"} of every row, read
+    # from the mapped areas table (rows enrolled since the checkpoint keep
+    # their full facial_area dicts in a list)
+    def __init__(self, areas: np.ndarray):
+        self.areas = areas
+        self.appended = []
+
+    def __len__(self) -> int:
+        return len(self.areas) + len(self.appended)
+
+    def __getitem__(self, row: int) -> dict:
+        if row >= len(self.areas):
+            return self.appended[row - len(self.areas)]
+        x, y, w, h = (int(v) for v in self.areas[row])
+        return {"x": x, "y": y, "w": w, "h": h}
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Class   : EmbeddingStore
+# Purpose : Versioned on-disk cache of gallery embeddings for one db_path.
+#           Each (model_name, detector_backend, enforce_detection) triple
+#           gets its own store, and every file is tracked by content hash, so
+#           a sync only embeds images that were added or changed and drops
+#           removed ones. enforce_detection is part of the key because it
+#           decides what a face-less image contributes (nothing, or a
+#           whole-image placeholder row).
+#
+# Layout  : <db_path>/.facetool/<model>__<backend>[__noenforce]/
+#             • meta.json         version, model, backend, rows, fingerprint,
+#                                 generation of the current checkpoint
+#             • files.<g>.json    per-file records (hash, size, mtime, faces)
+#             • embeddings.<g>.npy  float32 gallery matrix, one row per face,
+#                                 with spare capacity past meta["rows"]
+#             • norms.<g>.npy     float32 L2 norm of every row
+#             • names.<g>.npy     sorted relative paths of the files with rows
+#             • row_files.<g>.npy int32 index into names, one per row
+#             • areas.<g>.npy     int32 (x, y, w, h) facial area, one per row
+#             • wal.jsonl         enroll / unenroll records since the checkpoint
+#
+# A checkpoint holds rows in sorted file order, then face order per file.
+# All .npy files are opened as read-only memory maps, so every process
+# searching the same gallery shares one copy of the pages in the OS page
+# cache. Opening a store for search reads only the small meta.json and maps
+# the arrays; identities and facial areas are resolved per row on access.
+# files.json, which grows with the gallery, is parsed only by the paths
+# that change the store (sync, append, remove). sync() itself still stats
+# every image in db_path. A checkpoint writes a new generation <g> of the
+# data files and commits by atomically replacing meta.json, so a reader only
+# ever maps files from one checkpoint; older generations are then unlinked
+# (readers keep the mappings they opened).
+#
+# Enrollment appends rows into the spare capacity and then commits a line to
+# the write-ahead log; unenrollment only logs a tombstone (the row's identity
+# becomes None). Readers replay complete log lines on top of the checkpoint,
+# so they see either all of an enrollment or none of it. Log records carry
+# the checkpoint fingerprint and a sequence number, so records from an
+# older checkpoint are never replayed.
+# ────────────────────────────────────────────────────────────────────────────────
+class EmbeddingStore:
+    # Force a compacting checkpoint once the log holds this many records
+    WAL_MAX_RECORDS = 4096
+
+    def __init__(
+        self,
+        db_path: str,
+        model_name: str,
+        detector_backend: str,
+        enforce_detection: bool = True
+    ):
+        self.db_path = db_path
+        self.model_name = model_name
+        self.detector_backend = detector_backend
+        self.enforce_detection = enforce_detection
+        suffix = "" if enforce_detection else "__noenforce"
+        self.store_dir = os.path.join(
+            db_path, STORE_DIRNAME, f"{model_name}__{detector_backend}{suffix}"
+        )
+        self.last_sync = {}
+        self._reset()
+
+    def _reset(self) -> None:
+        # relpath -> {"hash", "size", "mtime_ns", "faces": [facial_area, ...]};
+        # None while a loaded checkpoint's files.json has not been read
+        # (see _index_files())
+        self._files = {}
+        # relpath -> float32 array of shape (len(faces), dim)
+        self._vectors = {}
+        # relpath -> (first row, end row)
+        self._rows = {}
+        # Log records replayed before files.json was read
+        self._pending = []
+        # Row-aligned views set by _attach(); identities[row] is None for
+        # rows removed since the last checkpoint
+        self.identities = _RowIdentities(self.db_path, np.zeros(0, dtype=str), np.zeros(0, dtype=np.int32))
+        self.facial_areas = _RowAreas(np.zeros((0, 4), dtype=np.int32))
+        self.embeddings = np.zeros((0, 0), dtype=np.float32)
+        self.norms = np.zeros(0, dtype=np.float32)
+        self.dead_rows = 0
+        # Full-capacity buffers behind embeddings / norms
+        self._matrix_buf = self.embeddings
+        self._norms_buf = self.norms
+        # Row ranges of files enrolled / removed since the checkpoint
+        self._enrolled = {}
+        self._gone = set()
+        self._fingerprint = hashlib.sha1().hexdigest()
+        self.wal_seq = 0
+        self._wal_records = 0
+        self._wal_good_bytes = 0
+        self._meta_stamp = None
+        self._generation = 0
+
+    @property
+    def files(self) -> dict:
+        self._index_files()
+        return self._files
+
+    @files.setter
+    def files(self, files: dict) -> None:
+        self._files = files
+
+    @property
+    def meta_path(self) -> str:
+        return os.path.join(self.store_dir, "meta.json")
+
+    @property
+    def files_path(self) -> str:
+        return self._table_path("files", ".json")
+
+    @property
+    def matrix_path(self) -> str:
+        return self._table_path("embeddings")
+
+    @property
+    def norms_path(self) -> str:
+        return self._table_path("norms")
+
+    @property
+    def wal_path(self) -> str:
+        return os.path.join(self.store_dir, "wal.jsonl")
+
+    def load(self) -> None:
+        # Map an existing store and replay its log; a missing, stale or
+        # mismatched one is ignored and the next sync() simply embeds
+        # everything again. meta.json names the generation to map; if a newer
+        # checkpoint removed those files first, the new one is mapped instead.
+        for _ in range(3):
+            stamp = None
+            try:
+                stamp = self._stat_meta()
+                with open(self.meta_path, encoding="utf-8") as fp:
+                    meta = json.load(fp)
+                arrays = self._map(meta["generation"])
+                rows = meta["rows"]
+            except (OSError, ValueError, KeyError):
+                try:
+                    if stamp is not None and self._stat_meta() != stamp:
+                        continue
+                except OSError:
+                    pass
+                return
+            break
+        else:
+            return
+        matrix, norms, names, row_files, areas = arrays
+        if (
+            meta.get("version") != STORE_VERSION
+            or meta.get("model_name") != self.model_name
+            or meta.get("detector_backend") != self.detector_backend
+            or meta.get("enforce_detection") != self.enforce_detection
+            or rows > len(matrix)
+            or len(row_files) != rows
+            or len(areas) != rows
+        ):
+            return
+        self._files = None
+        self._generation = meta["generation"]
+        self.wal_seq = meta.get("wal_seq", 0)
+        self._attach(matrix, norms, names, row_files, areas, meta["fingerprint"], rows)
+        self._meta_stamp = stamp
+        self.replay()
+
+    def replay(self) -> bool:
+        # Catch up with enrollments committed by other processes. Returns
+        # True if the store changed; if a newer checkpoint was written the
+        # store is reloaded (and fingerprint() changes).
+        try:
+            stamp = self._stat_meta()
+        except OSError:
+            stamp = None
+        if stamp != self._meta_stamp:
+            self._reset()
+            self.load()
+            return True
+        applied = False
+        for record in self._read_wal():
+            if record.get("base") != self._fingerprint or record["seq"] <= self.wal_seq:
+                continue
+            if not self._apply(record):
+                # Log and checkpoint disagree (e.g. a concurrent rewrite):
+                # start over from whatever is on disk now
+                self._reset()
+                self.load()
+                return True
+            applied = True
+        return applied
+
+    def sync(self, workers: int = 1) -> bool:
+        # Bring the store in line with the files currently in db_path.
+        # Returns True if anything was added, changed or removed. New files
+        # are embedded in a process pool when workers > 1. Counts from the
+        # last sync are kept in self.last_sync.
+        by_hash = {entry["hash"]: rel for rel, entry in self.files.items()}
+        files, vectors, to_embed = {}, {}, []
+        changed = False
+        stats = {"files": 0, "unchanged": 0, "reused": 0, "embedded": 0, "removed": 0}
+
+        # Pass 1: classify every file; only new content goes to to_embed
+        for rel in _list_images(self.db_path):
+            stats["files"] += 1
+            full = os.path.join(self.db_path, rel)
+            st = os.stat(full)
+            old = self.files.get(rel)
+
+            # Unchanged size + mtime: trust the cached entry without hashing
+            if old and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns:
+                files[rel], vectors[rel] = old, self._vectors[rel]
+                stats["unchanged"] += 1
+                continue
+
+            digest = _file_hash(full)
+            source = rel if old and old["hash"] == digest else by_hash.get(digest)
+            if source is not None:
+                # Same content (touched or renamed file): reuse the embeddings
+                files[rel] = dict(
+                    self.files[source], size=st.st_size, mtime_ns=st.st_mtime_ns
+                )
+                vectors[rel] = self._vectors[source]
+                stats["reused"] += 1
+            else:
+                files[rel] = {
+                    "hash": digest,
+                    "size": st.st_size,
+                    "mtime_ns": st.st_mtime_ns,
+                    "faces": [],
+                }
+                to_embed.append(rel)
+            changed = True
+
+        # Pass 2: embed new content, serially or sharded over processes
+        start = time.perf_counter()
+        jobs = [
+            (rel, os.path.join(self.db_path, rel), self.model_name,
+             self.detector_backend, self.enforce_detection)
+            for rel in to_embed
+        ]
+        if workers > 1 and len(jobs) > 1:
+            with multiprocessing.get_context("spawn").Pool(
+                workers, initializer=_gallery_worker_init, initargs=(self.model_name,)
+            ) as pool:
+                results = pool.imap_unordered(
+                    _embed_gallery_job, jobs, chunksize=max(1, min(64, len(jobs) // (workers * 4)))
+                )
+                for rel, faces, vecs in results:
+                    files[rel]["faces"], vectors[rel] = faces, vecs
+        else:
+            for job in jobs:
+                rel, faces, vecs = _embed_gallery_job(job)
+                files[rel]["faces"], vectors[rel] = faces, vecs
+        elapsed = time.perf_counter() - start
+        stats["embedded"] = len(jobs)
+        _count("gallery_files_embedded", len(jobs))
+
+        stats["removed"] = len(set(self.files) - set(files))
+        if stats["removed"]:
+            changed = True
+        stats["embed_seconds"] = round(elapsed, 3)
+        stats["images_per_s"] = round(len(jobs) / elapsed, 2) if jobs and elapsed else 0.0
+        self.last_sync = stats
+
+        self.files, self._vectors = files, vectors
+        if changed:
+            self._rebuild()
+        return changed
+
+    def save(self) -> None:
+        # Write a checkpoint: matrix, norms and metadata go to temp files and
+        # are atomically swapped in, the log is emptied, and the new matrix
+        # is re-opened as a memory map
+        with _store_lock(self.store_dir):
+            self._checkpoint()
+
+    def append(self, entries: dict) -> int:
+        # Enroll files without a rebuild: entries maps relpath ->
+        # (file record, (n_faces, dim) vectors). Rows go into the spare
+        # capacity of the mapped matrix; the log line written afterwards is
+        # the commit point. Returns the number of rows added.
+        entries = {rel: item for rel, item in entries.items() if rel not in self.files}
+        if not entries:
+            return 0
+        with _store_lock(self.store_dir):
+            self.replay()
+            entries = {rel: item for rel, item in entries.items() if rel not in self.files}
+            blocks = [np.asarray(vecs, dtype=np.float32) for _, vecs in entries.values()]
+            blocks = [b for b in blocks if b.size]
+            added = sum(len(b) for b in blocks)
+            start = len(self.embeddings)
+            dim = blocks[0].shape[1] if blocks else self._matrix_buf.shape[1]
+            if start and dim != self._matrix_buf.shape[1]:
+                raise ValueError(
+                    f"Embedding size {dim} does not match the store ({self._matrix_buf.shape[1]})"
+                )
+            if (
+                start + added > len(self._matrix_buf)
+                or dim != self._matrix_buf.shape[1]
+                or self._wal_records >= self.WAL_MAX_RECORDS
+            ):
+                # Out of room: compact and double the capacity (amortised O(1))
+                self._rebuild()
+                self._checkpoint(capacity=2 * (len(self.embeddings) + added), dim=dim)
+                start = len(self.embeddings)
+            if blocks:
+                block = np.concatenate(blocks)
+                matrix = np.load(self.matrix_path, mmap_mode="r+")
+                norms = np.load(self.norms_path, mmap_mode="r+")
+                matrix[start:start + added] = block
+                norms[start:start + added] = np.sqrt(np.einsum("ij,ij->i", block, block))
+                matrix.flush()
+                norms.flush()
+                del matrix, norms
+            record = {
+                "seq": self.wal_seq + 1,
+                "base": self._fingerprint,
+                "op": "enroll",
+                "start": start,
+                "files": [[rel, entry] for rel, (entry, _) in entries.items()],
+            }
+            self._write_wal(record)
+            self._apply(record)
+        return added
+
+    def remove(self, rels: list) -> int:
+        # Unenroll files without a rebuild: their rows are tombstoned in the
+        # log and skipped by searches until the next checkpoint compacts
+        # them away. Returns the number of rows removed.
+        with _store_lock(self.store_dir):
+            self.replay()
+            rels = sorted(rel for rel in set(rels) if rel in self.files)
+            if not rels:
+                return 0
+            removed = sum(len(self.files[rel]["faces"]) for rel in rels)
+            record = {
+                "seq": self.wal_seq + 1,
+                "base": self._fingerprint,
+                "op": "unenroll",
+                "files": rels,
+            }
+            self._write_wal(record)
+            self._apply(record)
+            if self.dead_rows * 2 > len(self.identities):
+                self._rebuild()
+                self._checkpoint()
+        return removed
+
+    def fingerprint(self) -> str:
+        # Digest of the gallery contents at the last checkpoint. Rows enrolled
+        # since are only ever appended after it, so an index built from this
+        # checkpoint stays a valid prefix and can be extended in place.
+        return self._fingerprint
+
+    def _checkpoint(self, capacity: int = 0, dim: int = None) -> None:
+        # Caller holds the store lock. Rows enrolled or removed since the
+        # last checkpoint are compacted first, so the checkpoint is always in
+        # sorted file order. Spare rows are left in the matrix (sparse on most
+        # filesystems) so enrollments can append in place. The new generation
+        # is invisible to readers until meta.json is replaced.
+        self._index_files()
+        if self._enrolled or self.dead_rows:
+            self._rebuild()
+        os.makedirs(self.store_dir, exist_ok=True)
+        try:
+            with open(self.meta_path, encoding="utf-8") as fp:
+                generation = int(json.load(fp)["generation"]) + 1
+        except (OSError, ValueError, KeyError):
+            generation = max(self._generation, 0) + 1
+        rows = len(self.embeddings)
+        if dim is None:
+            dim = self.embeddings.shape[1] if self.embeddings.ndim == 2 else 0
+        capacity = max(capacity, rows + max(rows // 4, 64)) if dim else 0
+        matrix = np.lib.format.open_memmap(
+            self._table_path("embeddings", generation=generation),
+            mode="w+", dtype=np.float32, shape=(capacity, dim)
+        )
+        norms = np.lib.format.open_memmap(
+            self._table_path("norms", generation=generation),
+            mode="w+", dtype=np.float32, shape=(capacity,)
+        )
+        for start in range(0, rows, 65536):
+            stop = min(start + 65536, rows)
+            matrix[start:stop] = self.embeddings[start:stop]
+        norms[:rows] = self.norms
+        matrix.flush()
+        norms.flush()
+        del matrix, norms
+        tables = {
+            "names": self.identities.names,
+            "row_files": self.identities.row_files,
+            "areas": self.facial_areas.areas,
+        }
+        for name, table in tables.items():
+            np.save(self._table_path(name, generation=generation), table)
+        with open(self._table_path("files", ".json", generation), "w", encoding="utf-8") as fp:
+            json.dump({"fingerprint": self._fingerprint, "files": self._files}, fp)
+        tmp_meta = self.meta_path + ".tmp"
+        with open(tmp_meta, "w", encoding="utf-8") as fp:
+            json.dump(
+                {
+                    "version": STORE_VERSION,
+                    "model_name": self.model_name,
+                    "detector_backend": self.detector_backend,
+                    "enforce_detection": self.enforce_detection,
+                    "rows": rows,
+                    "wal_seq": self.wal_seq,
+                    "fingerprint": self._fingerprint,
+                    "generation": generation,
+                },
+                fp,
+            )
+        # The commit point: readers now map the new generation
+        os.replace(tmp_meta, self.meta_path)
+        # Everything logged so far is now part of the checkpoint
+        open(self.wal_path, "w").close()
+        self._wal_records = self._wal_good_bytes = 0
+        # Drop the private copies built by sync() in favour of shared pages
+        self._generation = generation
+        self._attach(*self._map(), self._fingerprint, rows)
+        self._index_rows()
+        self._meta_stamp = self._stat_meta()
+        current = {
+            os.path.basename(self._table_path(name, ".json" if name == "files" else ".npy"))
+            for name in STORE_TABLES
+        }
+        for name in os.listdir(self.store_dir):
+            if name.split(".")[0] in STORE_TABLES and name not in current:
+                try:
+                    os.remove(os.path.join(self.store_dir, name))
+                except OSError:
+                    pass
+
+    def _stat_meta(self):
+        st = os.stat(self.meta_path)
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _read_wal(self) -> list:
+        # Complete records only: a torn last line (crash mid-write) is ignored
+        records, good = [], 0
+        try:
+            with open(self.wal_path, "rb") as fp:
+                for line in fp:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break
+                    good += len(line)
+        except OSError:
+            pass
+        self._wal_records, self._wal_good_bytes = len(records), good
+        return records
+
+    def _write_wal(self, record: dict) -> None:
+        # Caller holds the store lock; a torn tail left by a crash is cut off
+        # before appending, and the record is fsync'd before it is applied
+        with open(self.wal_path, "ab") as fp:
+            if fp.tell() > self._wal_good_bytes:
+                fp.truncate(self._wal_good_bytes)
+            line = (json.dumps(record) + "\n").encode()
+            fp.write(line)
+            fp.flush()
+            os.fsync(fp.fileno())
+        self._wal_good_bytes += len(line)
+        self._wal_records += 1
+
+    def _apply(self, record: dict) -> bool:
+        # Apply one log record to the in-memory views. Identities are
+        # extended before the matrix view grows, so a concurrent search
+        # never returns a row it cannot name. Returns False if the record
+        # does not fit this checkpoint.
+        if record["op"] == "enroll":
+            row = record["start"]
+            if row != len(self.embeddings):
+                return False
+            spans = []
+            for rel, entry in record["files"]:
+                end = row + len(entry["faces"])
+                if end > len(self._matrix_buf):
+                    return False
+                spans.append((rel, entry, row, end))
+                row = end
+            for rel, entry, start, end in spans:
+                full = os.path.join(self.db_path, rel)
+                self.identities.appended.extend([full] * (end - start))
+                self.facial_areas.appended.extend(entry["faces"])
+                self._enrolled[rel] = (start, end)
+                self._gone.discard(rel)
+            self.embeddings = self._matrix_buf[:row]
+            self.norms = self._norms_buf[:row]
+        elif record["op"] == "unenroll":
+            for rel in record["files"]:
+                span = self._row_range(rel)
+                if span is None:
+                    continue
+                start, end = span
+                self.identities.dead.update(range(start, end))
+                self.dead_rows += end - start
+                self._enrolled.pop(rel, None)
+                self._gone.add(rel)
+        if self._files is None:
+            self._pending.append(record)
+        else:
+            self._apply_files(record)
+        self.wal_seq = record["seq"]
+        return True
+
+    def _apply_files(self, record: dict) -> None:
+        # The per-file side of _apply(), once files.json has been read
+        if record["op"] == "enroll":
+            row = record["start"]
+            for rel, entry in record["files"]:
+                end = row + len(entry["faces"])
+                self._files[rel] = entry
+                self._rows[rel] = (row, end)
+                self._vectors[rel] = self._matrix_buf[row:end]
+                row = end
+        elif record["op"] == "unenroll":
+            for rel in record["files"]:
+                if rel in self._files:
+                    del self._files[rel], self._rows[rel], self._vectors[rel]
+
+    def _row_range(self, rel: str):
+        # (first row, end row) of a file that currently has rows, else None;
+        # checkpoint files are found by binary search in the mapped tables
+        if rel in self._enrolled:
+            return self._enrolled[rel]
+        if rel in self._gone:
+            return None
+        names, row_files = self.identities.names, self.identities.row_files
+        i = int(np.searchsorted(names, rel))
+        if i == len(names) or names[i] != rel:
+            return None
+        return (
+            int(np.searchsorted(row_files, i, "left")),
+            int(np.searchsorted(row_files, i, "right")),
+        )
+
+    def _table_path(self, name: str, ext: str = ".npy", generation: int = None) -> str:
+        # Checkpoint files carry their generation in the name, so a new
+        # checkpoint never rewrites a file another process may have mapped
+        if generation is None:
+            generation = self._generation
+        return os.path.join(self.store_dir, f"{name}.{generation}{ext}")
+
+    def _map(self, generation: int = None):
+        # Read-only memory maps of one generation's matrix and norms (full
+        # capacity) and row tables
+        matrix, norms, names, row_files, areas = (
+            np.load(self._table_path(name, generation=generation), mmap_mode="r")
+            for name in ("embeddings", "norms", "names", "row_files", "areas")
+        )
+        if (
+            matrix.dtype != np.float32 or matrix.ndim != 2 or len(norms) != len(matrix)
+            or areas.ndim != 2 or areas.shape[1] != 4
+        ):
+            raise ValueError("Corrupt embedding store")
+        return matrix, norms, names, row_files, areas
+
+    def _attach(
+        self,
+        matrix: np.ndarray,
+        norms: np.ndarray,
+        names: np.ndarray,
+        row_files: np.ndarray,
+        areas: np.ndarray,
+        fingerprint: str,
+        rows: int = None
+    ) -> None:
+        # Point the store at an existing row-aligned matrix and row tables
+        # without copying. Only the first rows rows are in use; the rest is
+        # spare capacity for enrollment.
+        rows = len(matrix) if rows is None else rows
+        self._matrix_buf, self._norms_buf = matrix, norms
+        self.embeddings, self.norms = matrix[:rows], norms[:rows]
+        self.identities = _RowIdentities(self.db_path, names, row_files)
+        self.facial_areas = _RowAreas(areas)
+        self.dead_rows = 0
+        self._enrolled, self._gone, self._pending = {}, set(), []
+        self._fingerprint = fingerprint
+
+    def _index_files(self, retry: bool = True) -> None:
+        # Read files.json and derive per-file row ranges and vectors (slices
+        # of the matrix), then apply the log records replayed before that.
+        # Only the paths that change the store need this.
+        if self._files is not None:
+            return
+        try:
+            with open(self.files_path, encoding="utf-8") as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            data = {}
+        if data.get("fingerprint") != self._fingerprint:
+            # A newer checkpoint replaced the one we mapped: load that one
+            # once; if it still does not match, treat the store as missing
+            self._reset()
+            if retry:
+                self.load()
+                if self._files is None:
+                    self._index_files(retry=False)
+            return
+        pending = self._pending
+        self._files, self._pending = data["files"], []
+        self._index_rows()
+        for record in pending:
+            self._apply_files(record)
+
+    def _index_rows(self) -> None:
+        # Per-file row ranges / vectors for files stored in sorted order
+        self._rows, self._vectors = {}, {}
+        row = 0
+        for rel in sorted(self._files):
+            end = row + len(self._files[rel]["faces"])
+            self._rows[rel] = (row, end)
+            self._vectors[rel] = self._matrix_buf[row:end]
+            row = end
+
+    def _rebuild(self) -> None:
+        # Concatenate per-file vectors into a fresh row-aligned matrix
+        # (this also compacts away rows removed since the last checkpoint)
+        self._index_files()
+        rels = sorted(self._files)
+        blocks = [self._vectors[rel] for rel in rels if len(self._vectors[rel])]
+        matrix = (
+            np.concatenate(blocks).astype(np.float32)
+            if blocks else np.zeros((0, 0), dtype=np.float32)
+        )
+        names = [rel for rel in rels if self._files[rel]["faces"]]
+        counts = [len(self._files[rel]["faces"]) for rel in names]
+        areas = [
+            [area["x"], area["y"], area["w"], area["h"]]
+            for rel in names for area in self._files[rel]["faces"]
+        ]
+        digest = hashlib.sha1()
+        for rel in rels:
+            digest.update(f"{rel}\0{self._files[rel]['hash']}\0{len(self._files[rel]['faces'])}\n".encode())
+        self._attach(
+            matrix,
+            np.sqrt(np.einsum("ij,ij->i", matrix, matrix)),
+            np.array(names, dtype=str),
+            np.repeat(np.arange(len(names), dtype=np.int32), counts),
+            np.array(areas, dtype=np.int32).reshape(-1, 4),
+            digest.hexdigest(),
+        )
+        self._index_rows()
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Class   : ExactIndex
+# Purpose : Brute-force nearest-neighbour search over a gallery matrix.
+#           The gallery is used as one contiguous float32 block (never copied,
+#           so a memory-mapped store stays shared) with per-row norms kept on
+#           the side, so a batch of queries costs a single matmul followed by
+#           an argpartition top-k.
+#
+# Arguments:
+#   • embeddings       (n, dim) gallery matrix, one row per face.
+#   • distance_metric  cosine, euclidean or euclidean_l2.
+#   • norms            Precomputed row norms (computed if None).
+# ────────────────────────────────────────────────────────────────────────────────
+class ExactIndex:
+    METRICS = ("cosine", "euclidean", "euclidean_l2")
+
+    def __init__(
+        self,
+        embeddings: np.ndarray,
+        distance_metric: str = "cosine",
+        norms: np.ndarray = None
+    ):
+        if distance_metric not in self.METRICS:
+            raise ValueError(f"Unknown distance metric: {distance_metric}")
+        self.distance_metric = distance_metric
+        self.matrix = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if norms is None:
+            norms = np.sqrt(np.einsum("ij,ij->i", self.matrix, self.matrix))
+        self.norms = np.asarray(norms, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.matrix)
+
+    def extend(self, embeddings: np.ndarray, norms: np.ndarray = None) -> "ExactIndex":
+        # Follow a gallery that has grown by appended rows (no copy)
+        self.matrix = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if norms is None:
+            norms = np.sqrt(np.einsum("ij,ij->i", self.matrix, self.matrix))
+        self.norms = np.asarray(norms, dtype=np.float32)
+        return self
+
+    def distances(self, queries: np.ndarray, rows=None) -> np.ndarray:
+        # (n_queries, n_gallery) distance matrix from one matmul; pass rows
+        # to score only that subset of the gallery
+        q = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        q_norms = np.linalg.norm(q, axis=1, keepdims=True)
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        norms = self.norms if rows is None else self.norms[rows]
+        if self.distance_metric == "euclidean":
+            sq = q_norms ** 2 + (norms ** 2)[None, :] - 2.0 * (q @ matrix.T)
+            return np.sqrt(np.maximum(sq, 0.0))
+        cos = (q / np.maximum(q_norms, 1e-12)) @ matrix.T
+        cos /= np.maximum(norms, 1e-12)[None, :]
+        if self.distance_metric == "cosine":
+            return 1.0 - cos
+        return np.sqrt(np.maximum(2.0 - 2.0 * cos, 0.0))
+
+    def search(self, queries: np.ndarray, top_k: int = None):
+        # Return (distances, rows), both (n_queries, k), nearest first.
+        # top_k=None ranks the whole gallery.
+        dists = self.distances(queries)
+        n = dists.shape[1]
+        k = n if top_k is None else min(top_k, n)
+        if k < n:
+            part = np.argpartition(dists, k - 1, axis=1)[:, :k]
+        else:
+            part = np.broadcast_to(np.arange(n), dists.shape)
+        part_dists = np.take_along_axis(dists, part, axis=1)
+        order = np.argsort(part_dists, axis=1)
+        return (
+            np.take_along_axis(part_dists, order, axis=1),
+            np.take_along_axis(part, order, axis=1),
+        )
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Class   : HNSWIndex
+# Purpose : Approximate nearest-neighbour search (Hierarchical Navigable
+#           Small World graph) for galleries too large for brute force.
+#           Distances are computed by an ExactIndex over the same matrix, so
+#           reported distances match exact search for the rows returned.
+#
+# Arguments:
+#   • embeddings       (n, dim) gallery matrix, one row per face.
+#   • distance_metric  cosine, euclidean or euclidean_l2.
+#   • M                Links per node on upper layers (2·M on layer 0).
+#   • ef_construction  Candidate list size while inserting.
+#   • ef_search        Candidate list size while querying (recall vs speed).
+#   • norms            Precomputed row norms (computed if None).
+# ────────────────────────────────────────────────────────────────────────────────
+class HNSWIndex:
+    def __init__(
+        self,
+        embeddings: np.ndarray,
+        distance_metric: str = "cosine",
+        M: int = 16,
+        ef_construction: int = 200,
+        ef_search: int = 64,
+        seed: int = 0,
+        norms: np.ndarray = None
+    ):
+        self.exact = ExactIndex(embeddings, distance_metric, norms)
+        self.distance_metric = distance_metric
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self._rng = np.random.default_rng(seed)
+        self._level_mult = 1.0 / math.log(max(M, 2))
+        n = len(self.exact)
+        self.levels = np.zeros(n, dtype=np.int32)
+        # Layer 0 links as a dense (n, 2·M) table padded with -1;
+        # upper layers are sparse: upper[l - 1] maps node -> neighbour list
+        self.base = np.full((n, 2 * M), -1, dtype=np.int32)
+        self.upper = []
+        self.entry_point = -1
+        self.max_level = -1
+
+    def __len__(self) -> int:
+        return len(self.exact)
+
+    def build(self) -> "HNSWIndex":
+        # Insert every gallery row in order
+        for node in range(len(self.exact)):
+            self._insert(node)
+        return self
+
+    def extend(self, embeddings: np.ndarray, norms: np.ndarray = None) -> "HNSWIndex":
+        # Insert rows appended to the gallery since the graph was built,
+        # O(log n) each; link tables grow by doubling
+        first = len(self)
+        self.exact.extend(embeddings, norms)
+        if len(self) == first:
+            return self
+        self.levels = _grown(self.levels, len(self))
+        self.base = _grown(self.base, len(self), fill=-1)
+        for node in range(first, len(self)):
+            self._insert(node)
+        return self
+
+    def search(self, queries: np.ndarray, top_k: int = None, ef: int = None):
+        # Same contract as ExactIndex.search(); rows that could not be filled
+        # come back as -1 with an infinite distance. ef overrides ef_search
+        # for this call only.
+        q = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        ef = self.ef_search if ef is None else ef
+        k = min(top_k or ef, len(self))
+        dists = np.full((len(q), k), np.inf, dtype=np.float32)
+        rows = np.full((len(q), k), -1, dtype=np.int64)
+        if self.entry_point < 0:
+            return dists, rows
+        for i, query in enumerate(q):
+            entry = [self.entry_point]
+            for layer in range(self.max_level, 0, -1):
+                entry = [self._search_layer(query, entry, 1, layer)[0][1]]
+            found = self._search_layer(query, entry, max(ef, k), 0)[:k]
+            dists[i, :len(found)] = [d for d, _ in found]
+            rows[i, :len(found)] = [n for _, n in found]
+        return dists, rows
+
+    # ─── persistence ────────────────────────────────────────────────────────────
+    def save(self, path: str, fingerprint: str = "") -> None:
+        n = len(self)
+        arrays = {"levels": self.levels[:n], "base": self.base[:n]}
+        for layer, links in enumerate(self.upper, start=1):
+            nodes = np.fromiter(links, dtype=np.int64, count=len(links))
+            sizes = [len(links[n]) for n in nodes]
+            arrays[f"upper{layer}_nodes"] = nodes
+            arrays[f"upper{layer}_indptr"] = np.concatenate([[0], np.cumsum(sizes)])
+            arrays[f"upper{layer}_links"] = np.asarray(
+                [m for n in nodes for m in links[n]], dtype=np.int64
+            )
+        meta = {
+            "distance_metric": self.distance_metric,
+            "M": self.M,
+            "ef_construction": self.ef_construction,
+            "entry_point": self.entry_point,
+            "max_level": self.max_level,
+            "layers": len(self.upper),
+            "fingerprint": fingerprint,
+        }
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, meta=np.asarray(json.dumps(meta)), **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(
+        cls,
+        path: str,
+        embeddings: np.ndarray,
+        fingerprint: str = None,
+        norms: np.ndarray = None
+    ):
+        # Returns None if the file is missing, unreadable or built from a
+        # different gallery (fingerprint mismatch). Rows enrolled since the
+        # graph was saved are inserted on load.
+        try:
+            with np.load(path) as data:
+                meta = json.loads(str(data["meta"]))
+                if fingerprint is not None and meta["fingerprint"] != fingerprint:
+                    return None
+                n = len(data["levels"])
+                if n > len(embeddings):
+                    return None
+                index = cls(
+                    embeddings[:n],
+                    meta["distance_metric"],
+                    M=meta["M"],
+                    ef_construction=meta["ef_construction"],
+                    norms=None if norms is None else norms[:n],
+                )
+                index.levels = data["levels"]
+                index.base = data["base"]
+                for layer in range(1, meta["layers"] + 1):
+                    nodes = data[f"upper{layer}_nodes"]
+                    indptr = data[f"upper{layer}_indptr"]
+                    links = data[f"upper{layer}_links"]
+                    index.upper.append({
+                        int(n): links[indptr[j]:indptr[j + 1]].tolist()
+                        for j, n in enumerate(nodes)
+                    })
+        except (OSError, ValueError, KeyError):
+            return None
+        index.entry_point = meta["entry_point"]
+        index.max_level = meta["max_level"]
+        return index.extend(embeddings, norms)
+
+    # ─── graph internals ────────────────────────────────────────────────────────
+    def _dist(self, query: np.ndarray, nodes) -> list:
+        return self.exact.distances(query, rows=np.asarray(nodes)).ravel().tolist()
+
+    def _neighbours(self, node: int, layer: int) -> list:
+        if layer == 0:
+            links = self.base[node]
+            return links[links >= 0].tolist()
+        return self.upper[layer - 1][node]
+
+    def _set_neighbours(self, node: int, layer: int, links: list) -> None:
+        if layer == 0:
+            self.base[node] = -1
+            self.base[node, :len(links)] = links
+        else:
+            self.upper[layer - 1][node] = list(links)
+
+    def _search_layer(self, query: np.ndarray, entry: list, ef: int, layer: int) -> list:
+        # Best-first search on one layer; returns [(distance, node)] ascending
+        visited = set(entry)
+        candidates = list(zip(self._dist(query, entry), entry))
+        heapq.heapify(candidates)
+        results = [(-d, n) for d, n in candidates]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            dist, node = heapq.heappop(candidates)
+            if dist > -results[0][0] and len(results) >= ef:
+                break
+            fresh = [n for n in self._neighbours(node, layer) if n not in visited]
+            if not fresh:
+                continue
+            visited.update(fresh)
+            for d, n in zip(self._dist(query, fresh), fresh):
+                if len(results) < ef or d < -results[0][0]:
+                    heapq.heappush(candidates, (d, n))
+                    heapq.heappush(results, (-d, n))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted((-d, n) for d, n in results)
+
+    def _select(self, candidates: list, m: int) -> list:
+        # Neighbour-selection heuristic: keep a candidate only if it is closer
+        # to the base node than to any neighbour already kept, then top up
+        # with the nearest pruned ones so every node keeps m links
+        kept, pruned = [], []
+        for dist, node in candidates:
+            if len(kept) >= m:
+                break
+            if kept and min(self._dist(self.exact.matrix[node], kept)) < dist:
+                pruned.append(node)
+            else:
+                kept.append(node)
+        return kept + pruned[:m - len(kept)]
+
+    def _insert(self, node: int) -> None:
+        query = self.exact.matrix[node]
+        level = int(-math.log(1.0 - self._rng.random()) * self._level_mult)
+        self.levels[node] = level
+        while len(self.upper) < level:
+            self.upper.append({})
+        for layer in range(1, level + 1):
+            self.upper[layer - 1][node] = []
+        if self.entry_point < 0:
+            self.entry_point, self.max_level = node, level
+            return
+
+        entry = [self.entry_point]
+        for layer in range(self.max_level, level, -1):
+            entry = [self._search_layer(query, entry, 1, layer)[0][1]]
+        for layer in range(min(level, self.max_level), -1, -1):
+            found = self._search_layer(query, entry, self.ef_construction, layer)
+            links = self._select(found, self.M)
+            self._set_neighbours(node, layer, links)
+            m_max = 2 * self.M if layer == 0 else self.M
+            for other in links:
+                others = self._neighbours(other, layer) + [node]
+                if len(others) > m_max:
+                    d = self._dist(self.exact.matrix[other], others)
+                    others = self._select(sorted(zip(d, others)), m_max)
+                self._set_neighbours(other, layer, others)
+            entry = [n for _, n in found]
+        if level > self.max_level:
+            self.entry_point, self.max_level = node, level
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Class   : QuantizedIndex
+# Purpose : Two-stage search over a scalar-quantized copy of the gallery.
+#           Stage 1 scans compact codes (int8 with a per-dimension scale, or
+#           float16) to shortlist `rerank` candidates; stage 2 re-ranks that
+#           shortlist with exact float32 distances, touching only those rows
+#           of the (memory-mapped) full-precision matrix.
+#
+# Arguments:
+#   • embeddings       (n, dim) float32 gallery matrix.
+#   • distance_metric  cosine, euclidean or euclidean_l2.
+#   • dtype            "int8" (4x smaller) or "float16" (2x smaller).
+#   • rerank           Shortlist size re-ranked in float32 (at least 1; unlike
+#                      PQIndex there is no approximate-only mode).
+#   • norms            Precomputed row norms (computed if None).
+#
+# For cosine / euclidean_l2 the unit-normalised rows are quantized, so the
+# coarse score is a plain dot product.
+# ────────────────────────────────────────────────────────────────────────────────
+class QuantizedIndex:
+    DTYPES = ("int8", "float16")
+    # Rows decoded to float32 at a time during the coarse scan
+    CHUNK_ROWS = 16384
+
+    def __init__(
+        self,
+        embeddings: np.ndarray,
+        distance_metric: str = "cosine",
+        dtype: str = "int8",
+        rerank: int = 100,
+        norms: np.ndarray = None
+    ):
+        if dtype not in self.DTYPES:
+            raise ValueError(f"Unknown quantization dtype: {dtype}")
+        self.exact = ExactIndex(embeddings, distance_metric, norms)
+        self.distance_metric = distance_metric
+        self.dtype = dtype
+        if rerank < 1:
+            raise ValueError(f"{dtype} search needs rerank >= 1, got {rerank}")
+        self.rerank = rerank
+        self.codes = None
+        self.scale = None
+        self.code_sq_norms = None
+
+    def __len__(self) -> int:
+        return len(self.exact)
+
+    def build(self) -> "QuantizedIndex":
+        n, dim = self.exact.matrix.shape
+        if self.dtype == "int8":
+            # Symmetric per-dimension scale from the largest magnitude seen
+            peak = np.zeros(dim, dtype=np.float32)
+            for start in range(0, n, self.CHUNK_ROWS):
+                chunk = self._source(start, start + self.CHUNK_ROWS)
+                peak = np.maximum(peak, np.abs(chunk).max(axis=0))
+            self.scale = np.maximum(peak, 1e-12) / 127.0
+        else:
+            self.scale = np.ones(dim, dtype=np.float32)
+
+        self.codes = np.empty((n, dim), dtype=np.int8 if self.dtype == "int8" else np.float16)
+        self.code_sq_norms = np.empty(n, dtype=np.float32)
+        self._encode_rows(0, n)
+        return self
+
+    def extend(self, embeddings: np.ndarray, norms: np.ndarray = None) -> "QuantizedIndex":
+        # Encode rows appended to the gallery with the existing scale (int8
+        # values outside it are clipped until the next full build)
+        first = len(self)
+        self.exact.extend(embeddings, norms)
+        if len(self) == first:
+            return self  # nothing appended: keep memory-mapped codes mapped
+        self.codes = _grown(self.codes, len(self))
+        self.code_sq_norms = _grown(self.code_sq_norms, len(self))
+        self._encode_rows(first, len(self))
+        return self
+
+    def memory_bytes(self) -> dict:
+        n = len(self)
+        return {
+            "float32": int(self.exact.matrix.nbytes),
+            self.dtype: int(
+                self.codes[:n].nbytes + self.scale.nbytes + self.code_sq_norms[:n].nbytes
+            ),
+        }
+
+    def search(self, queries: np.ndarray, top_k: int = None, rerank: int = None):
+        # Same contract as ExactIndex.search(); with top_k=None the whole
+        # re-ranked shortlist is returned. rerank overrides self.rerank for
+        # this call only.
+        q = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        n = len(self)
+        rerank = self.rerank if rerank is None else rerank
+        if rerank < 1:
+            raise ValueError(f"{self.dtype} search needs rerank >= 1, got {rerank}")
+        k = min(top_k or rerank, n)
+        shortlist = min(max(rerank, k), n)
+        coarse = self._coarse(q)
+        if shortlist < n:
+            candidates = np.argpartition(coarse, shortlist - 1, axis=1)[:, :shortlist]
+        else:
+            candidates = np.broadcast_to(np.arange(n), coarse.shape)
+
+        dists = np.empty((len(q), k), dtype=np.float32)
+        rows = np.empty((len(q), k), dtype=np.int64)
+        for i, (query, cand) in enumerate(zip(q, candidates)):
+            cand = np.sort(cand)  # sequential page access on the mmap
+            exact = self.exact.distances(query, rows=cand)[0]
+            order = np.argsort(exact)[:k]
+            dists[i], rows[i] = exact[order], cand[order]
+        return dists, rows
+
+    # ─── persistence ────────────────────────────────────────────────────────────
+    def save(self, prefix: str, fingerprint: str = "") -> None:
+        # <prefix>.codes.npy (memory-mapped on load) + <prefix>.npz sidecar
+        tmp_codes = prefix + ".codes.tmp.npy"
+        tmp_meta = prefix + ".tmp.npz"
+        np.save(tmp_codes, self.codes[:len(self)])
+        np.savez(
+            tmp_meta,
+            scale=self.scale,
+            code_sq_norms=self.code_sq_norms[:len(self)],
+            meta=np.asarray(json.dumps({
+                "distance_metric": self.distance_metric,
+                "dtype": self.dtype,
+                "fingerprint": fingerprint,
+            })),
+        )
+        os.replace(tmp_codes, prefix + ".codes.npy")
+        os.replace(tmp_meta, prefix + ".npz")
+
+    @classmethod
+    def load(
+        cls,
+        prefix: str,
+        embeddings: np.ndarray,
+        fingerprint: str = None,
+        norms: np.ndarray = None
+    ):
+        # Returns None if missing, unreadable or built from another gallery
+        try:
+            with np.load(prefix + ".npz") as data:
+                meta = json.loads(str(data["meta"]))
+                scale = data["scale"]
+                code_sq_norms = data["code_sq_norms"]
+            codes = np.load(prefix + ".codes.npy", mmap_mode="r")
+        except (OSError, ValueError, KeyError):
+            return None
+        if fingerprint is not None and meta["fingerprint"] != fingerprint:
+            return None
+        n = len(codes)
+        if n > len(embeddings):
+            return None
+        index = cls(
+            embeddings[:n], meta["distance_metric"], meta["dtype"],
+            norms=None if norms is None else norms[:n],
+        )
+        index.codes, index.scale, index.code_sq_norms = codes, scale, code_sq_norms
+        return index.extend(embeddings, norms)
+
+    # ─── internals ──────────────────────────────────────────────────────────────
+    def _source(self, start: int, stop: int) -> np.ndarray:
+        # Rows to quantize: unit-normalised unless the metric is euclidean
+        chunk = np.asarray(self.exact.matrix[start:stop], dtype=np.float32)
+        if self.distance_metric == "euclidean":
+            return chunk
+        return chunk / np.maximum(self.exact.norms[start:stop], 1e-12)[:, None]
+
+    def _encode_rows(self, first: int, last: int) -> None:
+        for start in range(first, last, self.CHUNK_ROWS):
+            stop = min(start + self.CHUNK_ROWS, last)
+            chunk = self._source(start, stop)
+            if self.dtype == "int8":
+                block = np.clip(np.rint(chunk / self.scale), -127, 127).astype(np.int8)
+            else:
+                block = chunk.astype(np.float16)
+            self.codes[start:stop] = block
+            decoded = block.astype(np.float32) * self.scale
+            self.code_sq_norms[start:stop] = np.einsum("ij,ij->i", decoded, decoded)
+
+    def _coarse(self, q: np.ndarray) -> np.ndarray:
+        # Approximate (n_queries, n) distances from the codes, chunk by chunk
+        if self.distance_metric != "euclidean":
+            q = q / np.maximum(np.linalg.norm(q, axis=1, keepdims=True), 1e-12)
+        scaled = q * self.scale
+        out = np.empty((len(q), len(self)), dtype=np.float32)
+        for start in range(0, len(self), self.CHUNK_ROWS):
+            stop = min(start + self.CHUNK_ROWS, len(self))
+            block = np.asarray(self.codes[start:stop], dtype=np.float32)
+            dots = scaled @ block.T
+            if self.distance_metric == "euclidean":
+                sq = self.code_sq_norms[start:start + len(block)]
+                out[:, start:start + len(block)] = sq[None, :] - 2.0 * dots
+            else:
+                out[:, start:start + len(block)] = -dots
+        return out
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Class   : PQIndex
+# Purpose : Product-quantized gallery for galleries too large for RAM even at
+#           int8. Each vector is split into m sub-vectors and each sub-vector
+#           is replaced by the id of its nearest k-means centroid, so a face
+#           costs m bytes. Queries are scored with asymmetric distance
+#           computation (ADC): one (m, ks) table of query-to-centroid
+#           distances per query, then a table lookup per code.
+#
+# Arguments:
+#   • embeddings       (n, dim) float32 gallery matrix (may be memory-mapped).
+#   • distance_metric  cosine, euclidean or euclidean_l2.
+#   • m                Number of sub-quantizers (bytes per face); must divide
+#                      dim. Defaults to dim / 8.
+#   • rerank           Shortlist size re-ranked with exact float32 distances;
+#                      0 returns the ADC estimates directly.
+#   • train_size       Rows sampled to train the codebooks.
+#   • seed             RNG seed for sampling and centroid initialisation.
+#   • norms            Precomputed row norms (computed if None).
+#
+# Memory during search is bounded by the codes plus one chunk of distances:
+# the shortlist is merged chunk by chunk instead of scoring all n rows at once.
+# ────────────────────────────────────────────────────────────────────────────────
+class PQIndex:
+    KS = 256  # centroids per sub-quantizer, so codes fit in uint8
+    CHUNK_ROWS = 262144
+    KMEANS_ITERS = 20
+
+    def __init__(
+        self,
+        embeddings: np.ndarray,
+        distance_metric: str = "cosine",
+        m: int = None,
+        rerank: int = 100,
+        train_size: int = 65536,
+        seed: int = 0,
+        norms: np.ndarray = None
+    ):
+        self.exact = ExactIndex(embeddings, distance_metric, norms)
+        self.distance_metric = distance_metric
+        dim = self.exact.matrix.shape[1] if self.exact.matrix.ndim == 2 else 0
+        if m is None:
+            m = max(1, dim // 8)
+            while dim and dim % m:
+                m -= 1
+        if dim and dim % m:
+            raise ValueError(f"m={m} does not divide embedding size {dim}")
+        self.m = m
+        self.rerank = rerank
+        self.train_size = train_size
+        self.seed = seed
+        self.codebooks = None  # (m, ks, dsub) float32
+        self.codes = None      # (n, m) uint8
+
+    def __len__(self) -> int:
+        return len(self.exact)
+
+    def build(self) -> "PQIndex":
+        n, dim = self.exact.matrix.shape
+        rng = np.random.default_rng(self.seed)
+        sample_rows = np.sort(rng.choice(n, size=min(n, self.train_size), replace=False))
+        sample = self._source(sample_rows)
+        ks = min(self.KS, len(sample))
+        dsub = dim // self.m
+
+        self.codebooks = np.stack([
+            self._kmeans(sample[:, j * dsub:(j + 1) * dsub], ks, rng)
+            for j in range(self.m)
+        ])
+        self.codes = np.empty((n, self.m), dtype=np.uint8)
+        self._encode_rows(0, n)
+        return self
+
+    def extend(self, embeddings: np.ndarray, norms: np.ndarray = None) -> "PQIndex":
+        # Encode rows appended to the gallery with the trained codebooks
+        first = len(self)
+        self.exact.extend(embeddings, norms)
+        if len(self) == first:
+            return self  # nothing appended: keep memory-mapped codes mapped
+        self.codes = _grown(self.codes, len(self))
+        self._encode_rows(first, len(self))
+        return self
+
+    def memory_bytes(self) -> dict:
+        return {
+            "float32": int(self.exact.matrix.nbytes),
+            "pq": int(self.codes[:len(self)].nbytes + self.codebooks.nbytes),
+        }
+
+    def search(self, queries: np.ndarray, top_k: int = None, rerank: int = None):
+        # Same contract as ExactIndex.search(); with top_k=None the whole
+        # shortlist is returned. rerank overrides self.rerank for this call
+        # only.
+        q = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        n = len(self)
+        rerank = self.rerank if rerank is None else rerank
+        k = min(top_k or rerank or n, n)
+        shortlist = min(max(rerank, k), n)
+        if self.distance_metric != "euclidean":
+            q = q / np.maximum(np.linalg.norm(q, axis=1, keepdims=True), 1e-12)
+
+        dists = np.empty((len(q), k), dtype=np.float32)
+        rows = np.empty((len(q), k), dtype=np.int64)
+        for i, query in enumerate(q):
+            approx, cand = self._adc_shortlist(self._distance_table(query), shortlist)
+            if rerank:
+                cand = np.sort(cand)  # sequential page access on the mmap
+                exact = self.exact.distances(query, rows=cand)[0]
+            else:
+                exact = self._to_metric(approx)
+            order = np.argsort(exact)[:k]
+            dists[i], rows[i] = exact[order], cand[order]
+        return dists, rows
+
+    # ─── persistence ────────────────────────────────────────────────────────────
+    def save(self, prefix: str, fingerprint: str = "") -> None:
+        # <prefix>.codes.npy (memory-mapped on load) + <prefix>.npz codebooks
+        tmp_codes = prefix + ".codes.tmp.npy"
+        tmp_meta = prefix + ".tmp.npz"
+        np.save(tmp_codes, self.codes[:len(self)])
+        np.savez(
+            tmp_meta,
+            codebooks=self.codebooks,
+            meta=np.asarray(json.dumps({
+                "distance_metric": self.distance_metric,
+                "m": self.m,
+                "fingerprint": fingerprint,
+            })),
+        )
+        os.replace(tmp_codes, prefix + ".codes.npy")
+        os.replace(tmp_meta, prefix + ".npz")
+
+    @classmethod
+    def load(
+        cls,
+        prefix: str,
+        embeddings: np.ndarray,
+        fingerprint: str = None,
+        norms: np.ndarray = None
+    ):
+        # Returns None if missing, unreadable or built from another gallery
+        try:
+            with np.load(prefix + ".npz") as data:
+                meta = json.loads(str(data["meta"]))
+                codebooks = data["codebooks"]
+            codes = np.load(prefix + ".codes.npy", mmap_mode="r")
+        except (OSError, ValueError, KeyError):
+            return None
+        if fingerprint is not None and meta["fingerprint"] != fingerprint:
+            return None
+        n = len(codes)
+        if n > len(embeddings):
+            return None
+        index = cls(
+            embeddings[:n], meta["distance_metric"], meta["m"],
+            norms=None if norms is None else norms[:n],
+        )
+        index.codebooks, index.codes = codebooks, codes
+        return index.extend(embeddings, norms)
+
+    # ─── internals ──────────────────────────────────────────────────────────────
+    def _source(self, rows) -> np.ndarray:
+        # Rows to quantize: unit-normalised unless the metric is euclidean
+        chunk = np.asarray(self.exact.matrix[rows], dtype=np.float32)
+        if self.distance_metric == "euclidean":
+            return chunk
+        return chunk / np.maximum(self.exact.norms[rows], 1e-12)[:, None]
+
+    def _kmeans(self, x: np.ndarray, ks: int, rng) -> np.ndarray:
+        # Plain Lloyd iterations; empty clusters are re-seeded from random points
+        centroids = x[rng.choice(len(x), size=ks, replace=False)].copy()
+        for _ in range(self.KMEANS_ITERS):
+            assign = self._nearest(x, centroids)
+            counts = np.bincount(assign, minlength=ks)
+            sums = np.stack([
+                np.bincount(assign, weights=x[:, d], minlength=ks)
+                for d in range(x.shape[1])
+            ], axis=1)
+            empty = counts == 0
+            centroids[~empty] = sums[~empty] / counts[~empty, None]
+            if empty.any():
+                centroids[empty] = x[rng.choice(len(x), size=int(empty.sum()))]
+        return centroids
+
+    @staticmethod
+    def _nearest(x: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        # ||x - c||² up to the per-row constant ||x||²
+        scores = (centroids ** 2).sum(axis=1)[None, :] - 2.0 * (x @ centroids.T)
+        return np.argmin(scores, axis=1)
+
+    def _encode_rows(self, first: int, last: int) -> None:
+        for start in range(first, last, self.CHUNK_ROWS):
+            stop = min(start + self.CHUNK_ROWS, last)
+            self.codes[start:stop] = self._encode(self._source(slice(start, stop)))
+
+    def _encode(self, x: np.ndarray) -> np.ndarray:
+        dsub = self.codebooks.shape[2]
+        return np.stack([
+            self._nearest(x[:, j * dsub:(j + 1) * dsub], self.codebooks[j])
+            for j in range(self.m)
+        ], axis=1).astype(np.uint8)
+
+    def _distance_table(self, query: np.ndarray) -> np.ndarray:
+        # (m, ks) squared distances from each query sub-vector to each centroid
+        sub = query.reshape(self.m, 1, -1)
+        return ((self.codebooks - sub) ** 2).sum(axis=2)
+
+    def _adc_shortlist(self, table: np.ndarray, shortlist: int):
+        # Best `shortlist` rows by ADC estimate, merged chunk by chunk
+        best_d = np.empty(0, dtype=np.float32)
+        best_r = np.empty(0, dtype=np.int64)
+        columns = np.arange(self.m)
+        for start in range(0, len(self), self.CHUNK_ROWS):
+            block = np.asarray(self.codes[start:min(start + self.CHUNK_ROWS, len(self))])
+            d = table[columns, block].sum(axis=1)
+            d = np.concatenate([best_d, d])
+            r = np.concatenate([best_r, np.arange(start, start + len(block))])
+            if len(d) > shortlist:
+                keep = np.argpartition(d, shortlist - 1)[:shortlist]
+                d, r = d[keep], r[keep]
+            best_d, best_r = d, r
+        return best_d, best_r
+
+    def _to_metric(self, sq: np.ndarray) -> np.ndarray:
+        # ADC squared L2 on (normalised) vectors -> the configured metric
+        sq = np.maximum(sq, 0.0)
+        if self.distance_metric == "cosine":
+            return (sq / 2.0).astype(np.float32)
+        return np.sqrt(sq).astype(np.float32)
+
+
+def load_index(
+    store: EmbeddingStore,
+    distance_metric: str = "cosine",
+    kind: str = "exact"
+):
+    # Return a searcher over the store's gallery. Graph indexes are persisted
+    # next to the store and rebuilt whenever the gallery fingerprint changes;
+    # rows enrolled since an index was saved are added to it on load.
+    if kind == "exact":
+        return ExactIndex(store.embeddings, distance_metric, store.norms)
+    if kind == "hnsw":
+        path = os.path.join(store.store_dir, f"hnsw_{distance_metric}.npz")
+        fingerprint = store.fingerprint()
+        index = HNSWIndex.load(path, store.embeddings, fingerprint, store.norms)
+        if index is None:
+            index = HNSWIndex(store.embeddings, distance_metric, norms=store.norms).build()
+            os.makedirs(store.store_dir, exist_ok=True)
+            index.save(path, fingerprint)
+        return index
+    if kind in QuantizedIndex.DTYPES:
+        prefix = os.path.join(store.store_dir, f"{kind}_{distance_metric}")
+        fingerprint = store.fingerprint()
+        index = QuantizedIndex.load(prefix, store.embeddings, fingerprint, store.norms)
+        if index is None:
+            index = QuantizedIndex(
+                store.embeddings, distance_metric, kind, norms=store.norms
+            ).build()
+            os.makedirs(store.store_dir, exist_ok=True)
+            index.save(prefix, fingerprint)
+        return index
+    if kind == "pq":
+        prefix = os.path.join(store.store_dir, f"pq_{distance_metric}")
+        fingerprint = store.fingerprint()
+        index = PQIndex.load(prefix, store.embeddings, fingerprint, store.norms)
+        if index is None:
+            index = PQIndex(store.embeddings, distance_metric, norms=store.norms).build()
+            os.makedirs(store.store_dir, exist_ok=True)
+            index.save(prefix, fingerprint)
+        return index
+    raise ValueError(f"Unknown index type: {kind}")
+
+
+def _gallery_worker_init(model_name: str) -> None:
+    # Pool initializer for gallery builds: one intra-op thread per worker
+    # (the pool itself provides the parallelism), then load the model once
+    os.environ.setdefault("OMP_NUM_THREADS", "1")
+    try:
+        import tensorflow as tf
+
+        tf.config.threading.set_intra_op_parallelism_threads(1)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    except (ImportError, RuntimeError):
+        pass
+    DeepFace.build_model(model_name)
+
+
+def _embed_gallery_job(job: tuple) -> tuple:
+    # Embed every face found in one gallery image; returns (rel, faces, vecs).
+    # Images without a detectable face are recorded with zero rows so they
+    # are not retried until their content changes.
+    rel, path, model_name, detector_backend, enforce_detection = job
+    try:
+        reps = _represent_gallery(path, model_name, detector_backend, enforce_detection)
+    except ValueError as e:
+        print(f"[WARN] Skipping {path}: {e}", file=sys.stderr)
+        reps = []
+    faces = [rep["facial_area"] for rep in reps]
+    if not reps:
+        return rel, faces, np.zeros((0, 0), dtype=np.float32)
+    return rel, faces, np.asarray([rep["embedding"] for rep in reps], dtype=np.float32)
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Function: build_store
+# Purpose : Build or refresh the embedding store of a gallery up front,
+#           sharding new images across `workers` processes (each loads the
+#           model once), optionally followed by an ANN index build.
+#
+# Returns : Sync counts plus images/sec for the embedding phase.
+# ────────────────────────────────────────────────────────────────────────────────
+def build_store(
+    db_path: str,
+    model_name: str = "VGG-Face",
+    detector_backend: str = "opencv",
+    enforce_detection: bool = True,
+    workers: int = 1,
+    index: str = "exact",
+    distance_metric: str = "cosine"
+) -> dict:
+    start = time.perf_counter()
+    store = EmbeddingStore(db_path, model_name, detector_backend, enforce_detection)
+    store.load()
+    if store.sync(workers=workers):
+        store.save()
+    report = dict(store.last_sync, rows=len(store.identities), workers=workers)
+    if index != "exact" and store.identities:
+        t0 = time.perf_counter()
+        load_index(store, distance_metric, index)
+        report["index_seconds"] = round(time.perf_counter() - t0, 3)
+    report["total_seconds"] = round(time.perf_counter() - start, 3)
+    return report
+
+
+def open_store(
+    db_path: str,
+    model_name: str,
+    detector_backend: str,
+    enforce_detection: bool = True
+) -> EmbeddingStore:
+    # Load the store for db_path, embed any new/changed files and persist
+    store = EmbeddingStore(db_path, model_name, detector_backend, enforce_detection)
+    store.load()
+    if store.sync():
+        store.save()
+    return store
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Class   : GalleryCache
+# Purpose : Keep embedding stores and their search indexes in memory across
+#           calls (used by the long-running serve mode). A gallery folder is
+#           re-scanned at most once every rescan_s seconds; indexes are
+#           rebuilt only when that scan actually changed the store.
+# ────────────────────────────────────────────────────────────────────────────────
+class GalleryCache:
+    def __init__(self, rescan_s: float = 30.0):
+        self.rescan_s = rescan_s
+        self._lock = threading.Lock()
+        self._stores = {}     # (db, model, backend, enforce) -> (store, last_scan)
+        self._searchers = {}  # (db, model, backend, enforce, metric, index) -> searcher
+
+    def get(
+        self,
+        db_path: str,
+        model_name: str,
+        detector_backend: str,
+        enforce_detection: bool = True,
+        distance_metric: str = "cosine",
+        index: str = "exact"
+    ):
+        # Return (store, searcher) for one gallery configuration
+        key = (os.path.abspath(db_path), model_name, detector_backend, enforce_detection)
+        with self._lock:
+            cached = self._stores.get(key)
+            now = time.monotonic()
+            if cached is None:
+                store = open_store(db_path, model_name, detector_backend, enforce_detection)
+                self._stores[key] = (store, now)
+            else:
+                store, last_scan = cached
+                if now - last_scan >= self.rescan_s:
+                    # Pick up enrollments logged by other processes first, so
+                    # the sync below sees their files as already embedded
+                    fingerprint = store.fingerprint()
+                    if store.replay():
+                        self._refresh(key, store, fingerprint)
+                    if store.sync():
+                        store.save()
+                        self._searchers = {
+                            k: v for k, v in self._searchers.items() if k[:4] != key
+                        }
+                    self._stores[key] = (store, now)
+
+            skey = key + (distance_metric, index)
+            searcher = self._searchers.get(skey)
+            if searcher is None:
+                searcher = load_index(store, distance_metric, index)
+                self._searchers[skey] = searcher
+        return store, searcher
+
+    def stores(self, db_path: str) -> list:
+        # Stores currently held for db_path (any model / backend)
+        db = os.path.abspath(db_path)
+        with self._lock:
+            return [store for key, (store, _) in self._stores.items() if key[0] == db]
+
+    def updated(self, store: EmbeddingStore, fingerprint: str) -> None:
+        # Bring cached searchers in line after store.append() / remove()
+        key = (
+            os.path.abspath(store.db_path), store.model_name,
+            store.detector_backend, store.enforce_detection
+        )
+        with self._lock:
+            self._refresh(key, store, fingerprint)
+
+    def _refresh(self, key: tuple, store: EmbeddingStore, fingerprint: str) -> None:
+        # Caller holds the lock. Same checkpoint: extend each searcher in
+        # place with the appended rows. New checkpoint: drop them.
+        for skey in [k for k in self._searchers if k[:4] == key]:
+            if store.fingerprint() == fingerprint:
+                self._searchers[skey].extend(store.embeddings, store.norms)
+            else:
+                del self._searchers[skey]
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Enrollment
+#
+# An identity is a sub-folder of db_path (as with DeepFace.find()). enroll
+# copies the images into <db_path>/<identity>/ under content-hash names and
+# appends their embeddings to the store and any index in place; unenroll
+# deletes the folder and then tombstones the identity's rows in every store
+# of db_path. Both go through the store's write-ahead log, so other processes
+# (and the next sync) see the change without re-embedding or rebuilding.
+# ────────────────────────────────────────────────────────────────────────────────
+def _identity_dir(db_path: str, identity: str) -> str:
+    if (
+        not identity
+        or identity.startswith(".")
+        or os.sep in identity
+        or (os.altsep and os.altsep in identity)
+    ):
+        raise ValueError(f"Invalid identity name: {identity!r}")
+    return os.path.join(db_path, identity)
+
+
+def enroll_face(
+    identity: str,
+    img_paths: list,
+    db_path: str,
+    model_name: str = "VGG-Face",
+    detector_backend: str = "opencv",
+    enforce_detection: bool = True,
+    cache: GalleryCache = None,
+    embedder=None
+) -> dict:
+    folder = _identity_dir(db_path, identity)
+    if cache is not None:
+        store = cache.get(db_path, model_name, detector_backend, enforce_detection)[0]
+    else:
+        store = open_store(db_path, model_name, detector_backend, enforce_detection)
+    embed = embedder or _represent_gallery
+
+    entries = {}
+    for img_path in img_paths:
+        # Embed first, so a failed detection leaves the gallery untouched
+        faces = embed(img_path, model_name, detector_backend, enforce_detection)
+        digest = _file_hash(img_path)
+        ext = os.path.splitext(img_path)[1].lower()
+        target = os.path.join(folder, digest[:16] + ext)
+        if not os.path.exists(target):
+            os.makedirs(folder, exist_ok=True)
+            tmp = target + ".tmp"
+            with open(img_path, "rb") as src, open(tmp, "wb") as dst:
+                dst.write(src.read())
+            os.replace(tmp, target)
+        st = os.stat(target)
+        entries[os.path.relpath(target, db_path)] = (
+            {
+                "hash": digest,
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "faces": [face["facial_area"] for face in faces],
+            },
+            np.asarray([face["embedding"] for face in faces], dtype=np.float32),
+        )
+
+    fingerprint = store.fingerprint()
+    added = store.append(entries)
+    if cache is not None:
+        cache.updated(store, fingerprint)
+    return {
+        "identity": identity,
+        "files": sorted(entries),
+        "faces_added": added,
+        "gallery_rows": len(store.identities) - store.dead_rows,
+    }
+
+
+def unenroll_face(identity: str, db_path: str, cache: GalleryCache = None) -> dict:
+    folder = _identity_dir(db_path, identity)
+    prefix = identity + os.sep
+
+    # Every store of this gallery, whatever its model / backend
+    stores = {s.store_dir: s for s in cache.stores(db_path)} if cache is not None else {}
+    root = os.path.join(db_path, STORE_DIRNAME)
+    for name in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        store_dir = os.path.join(root, name)
+        if store_dir in stores or "__" not in name:
+            continue
+        enforce_detection = not name.endswith("__noenforce")
+        model_name, detector_backend = name[:len(name) - (0 if enforce_detection else 11)].rsplit("__", 1)
+        store = EmbeddingStore(db_path, model_name, detector_backend, enforce_detection)
+        store.load()
+        stores[store_dir] = store
+
+    # Deleted first, logged second: after a crash in between, the rows left
+    # behind belong to missing files and the next sync() drops them. The
+    # other order would let that sync re-embed and re-enroll the images.
+    files = [os.path.join(folder, rel) for rel in _list_images(folder)] if os.path.isdir(folder) else []
+    for path in files:
+        os.remove(path)
+    try:
+        os.rmdir(folder)
+    except OSError:
+        pass
+
+    removed = 0
+    for store in stores.values():
+        fingerprint = store.fingerprint()
+        removed += store.remove([rel for rel in store.files if rel.startswith(prefix)])
+        if cache is not None:
+            cache.updated(store, fingerprint)
+    return {"identity": identity, "files_deleted": len(files), "faces_removed": removed}
 
 
 # ────────────────────────────────────────────────────────────────────────────────
 # Function: recognize_face
 # Purpose : Given a query image, search a directory of faces and return
 #           the closest matches (sorted by embedding distance).
+#           Gallery embeddings come from the EmbeddingStore kept inside
+#           db_path, so only new or changed images are embedded per call.
+#
+# Arguments:
+#   • img_path         The image you want to recognize: a path, encoded bytes,
+#                      a binary file object or an HxWx3 uint8 BGR array.
+#   • db_path          Directory containing one face image per person.
+#   • model_name       Embedding model to use (VGG‑Face, Facenet, ArcFace…).
+#   • detector_backend Face detector to use (opencv, mtcnn, dlib, retinaface).
+#   • enforce_detection If False, won’t error on “no face found”.
+#   • distance_metric  How to compute similarity (cosine, euclidean…).
+#   • top_k            Max matches per query face (None = all under threshold).
+#   • index            Gallery search backend: "exact", "hnsw", "int8",
+#                      "float16" (quantized scan + exact re-rank) or "pq".
+#   • ef               HNSW candidate list size (higher = better recall).
+#   • rerank           int8/float16/pq shortlist size re-ranked in float32.
+#   • cache            Optional GalleryCache to reuse stores/indexes in memory.
+#   • embedder         Optional callable replacing DeepFace.represent() for
+#                      the query image (e.g. a BatchingEmbedder).
+#   • timings          Optional StageTimer that receives per-stage timings.
+#
+# Returns : A list of dicts, each with “identity” and distance scores.
+# ────────────────────────────────────────────────────────────────────────────────
+def recognize_face(
+    img_path: str,
+    db_path: str,
+    model_name: str = "VGG-Face",
+    detector_backend: str = "opencv",
+    enforce_detection: bool = True,
+    distance_metric: str = "cosine",
+    top_k: int = None,
+    index: str = "exact",
+    ef: int = None,
+    rerank: int = None,
+    cache: GalleryCache = None,
+    embedder=None,
+    timings: StageTimer = None
+) -> list:
+    with _use_timer(timings):
+        try:
+            # Load (and incrementally refresh) the gallery embeddings
+            with _stage("store_sync"):
+                if cache is not None:
+                    store, searcher = cache.get(
+                        db_path, model_name, detector_backend,
+                        enforce_detection, distance_metric, index
+                    )
+                else:
+                    store = open_store(db_path, model_name, detector_backend, enforce_detection)
+                    searcher = None
+            _count("gallery_rows", len(store.identities))
+            threshold = _find_threshold(model_name, distance_metric)
+
+            # Embed every face in the query image
+            embed = embedder or _represent
+            probes = embed(_image_input(img_path), model_name, detector_backend, enforce_detection)
+
+            hits = []
+            if not store.identities or not probes:
+                return hits
+            # One batched search for all query faces
+            queries = np.asarray([p["embedding"] for p in probes], dtype=np.float32)
+            if searcher is None:
+                with _stage("index_load"):
+                    searcher = load_index(store, distance_metric, index)
+            # Over-fetch by the number of unenrolled rows awaiting compaction
+            fetch = top_k + store.dead_rows if top_k and store.dead_rows else top_k
+            with _stage("search"):
+                all_dists, all_rows = searcher.search(
+                    queries, fetch, **_search_options(searcher, ef, rerank)
+                )
+
+            for probe, dists, rows in zip(probes, all_dists, all_rows):
+                hits.extend(_gallery_hits(
+                    store, probe["facial_area"], dists, rows, threshold, top_k
+                ))
+            _count("hits", len(hits))
+            return hits
+        except Exception as e:
+            if _raise_errors.get():
+                raise
+            # Print any errors to stderr and return an empty list
+            print(f"[ERROR] Recognition failed: {e}", file=sys.stderr)
+            return []
+
+
+def _gallery_hits(
+    store: EmbeddingStore,
+    source: dict,
+    dists: np.ndarray,
+    rows: np.ndarray,
+    threshold: float,
+    top_k: int = None
+) -> list:
+    # Turn one query face's ranked (dists, rows) into match records, same
+    # shape as DeepFace.find(): target = gallery, source = query. Stops at
+    # the threshold / top_k and skips unenrolled (None) rows.
+    hits = []
+    for dist, row in zip(dists, rows):
+        if dist > threshold or (top_k and len(hits) >= top_k):
+            break
+        if row < 0 or store.identities[row] is None:
+            continue
+        target = store.facial_areas[row]
+        hits.append({
+            "identity": store.identities[row],
+            "target_x": target["x"], "target_y": target["y"],
+            "target_w": target["w"], "target_h": target["h"],
+            "source_x": source["x"], "source_y": source["y"],
+            "source_w": source["w"], "source_h": source["h"],
+            "threshold": threshold,
+            "distance": float(dist),
+        })
+    return hits
+
+
+def _open_gallery(
+    db_path: str,
+    model_name: str,
+    detector_backend: str,
+    enforce_detection: bool,
+    distance_metric: str,
+    index: str,
+    ef: int = None,
+    rerank: int = None,
+    cache: GalleryCache = None
+):
+    # (store, searcher, threshold, options) for the multi-probe paths;
+    # options are the search() keyword arguments for ef / rerank
+    with _stage("store_sync"):
+        if cache is not None:
+            store, searcher = cache.get(
+                db_path, model_name, detector_backend,
+                enforce_detection, distance_metric, index
+            )
+        else:
+            store = open_store(db_path, model_name, detector_backend, enforce_detection)
+            searcher = None
+    _count("gallery_rows", len(store.identities))
+    if searcher is None and store.identities:
+        with _stage("index_load"):
+            searcher = load_index(store, distance_metric, index)
+    options = _search_options(searcher, ef, rerank)
+    return store, searcher, _find_threshold(model_name, distance_metric), options
+
+
+def _search_options(searcher, ef: int = None, rerank: int = None) -> dict:
+    # Per-request search knobs the searcher understands, passed to search()
+    # rather than set on it: a GalleryCache searcher is shared by every
+    # request, so one request's ef / rerank must not leak into the next
+    options = {}
+    if ef is not None and hasattr(searcher, "ef_search"):
+        options["ef"] = ef
+    if rerank is not None and hasattr(searcher, "rerank"):
+        options["rerank"] = rerank
+    return options
+
+
+# Max float32 distances held at once during a batched search (~256 MiB)
+SEARCH_BLOCK_ELEMENTS = 1 << 26
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Function: recognize_faces
+# Purpose : recognize_face() for many probe images at once. Face crops from
+#           all probes are embedded batch_size at a time, then every query
+#           face is searched against the gallery together: for ExactIndex
+#           that is one (queries x gallery) matmul, split into blocks only
+#           when the distance matrix would exceed SEARCH_BLOCK_ELEMENTS.
+#
+# Arguments: as recognize_face(), plus
+#   • img_paths        Iterable of probe images (paths, or any other input
+#                      recognize_face accepts).
+#   • batch_size       Face crops per model call.
+#
+# Returns : One list of match records per probe, in input order. A probe
+#           that fails to load or detect gets [] (the error goes to stderr).
+# ────────────────────────────────────────────────────────────────────────────────
+def recognize_faces(
+    img_paths,
+    db_path: str,
+    model_name: str = "VGG-Face",
+    detector_backend: str = "opencv",
+    enforce_detection: bool = True,
+    distance_metric: str = "cosine",
+    top_k: int = None,
+    index: str = "exact",
+    ef: int = None,
+    rerank: int = None,
+    batch_size: int = 64,
+    cache: GalleryCache = None,
+    timings: StageTimer = None
+) -> list:
+    with _use_timer(timings):
+        store, searcher, threshold, options = _open_gallery(
+            db_path, model_name, detector_backend, enforce_detection,
+            distance_metric, index, ef, rerank, cache
+        )
+
+        # Stage 1: decode + detect per probe; crops are embedded as soon as a
+        # batch fills, so only embeddings (not images) are kept for all probes
+        results, owners, vectors, crops = [], [], [], []
+        for path in img_paths:
+            results.append([])
+            _count("images")
+            try:
+                faces = _extract_faces(_image_input(path), detector_backend, enforce_detection)
+            except Exception as e:
+                name = path if isinstance(path, str) else f"probe #{len(results) - 1}"
+                print(f"[ERROR] Recognition failed for {name}: {e}", file=sys.stderr)
+                _count("probe_errors")
+                continue
+            for face in faces:
+                crops.append(face["face"])
+                owners.append((len(results) - 1, face["facial_area"]))
+            if len(crops) >= batch_size:
+                with _stage("embed"):
+                    vectors.append(embed_faces(crops, model_name))
+                crops = []
+        if crops:
+            with _stage("embed"):
+                vectors.append(embed_faces(crops, model_name))
+        if not owners or not store.identities:
+            return results
+
+        # Stage 2: all query faces against the gallery in as few calls as fit
+        queries = np.concatenate(vectors)
+        fetch = top_k + store.dead_rows if top_k and store.dead_rows else top_k
+        block = max(1, SEARCH_BLOCK_ELEMENTS // len(store.identities))
+        n_hits = 0
+        for start in range(0, len(queries), block):
+            with _stage("search"):
+                all_dists, all_rows = searcher.search(
+                    queries[start:start + block], fetch, **options
+                )
+            for (i, source), dists, rows in zip(owners[start:start + block], all_dists, all_rows):
+                hits = _gallery_hits(store, source, dists, rows, threshold, top_k)
+                results[i].extend(hits)
+                n_hits += len(hits)
+        _count("hits", n_hits)
+        return results
+
+
+class _BoxKalman:
+    # Constant-velocity Kalman filter on a face box (cx, cy, w, h, and
+    # their velocities) for FaceTracker. Noise is relative to box height so
+    # the filter behaves the same at any face size
+    POS_STD = 1.0 / 20
+    VEL_STD = 1.0 / 160
+    F = np.eye(8)
+    F[:4, 4:] = np.eye(4)
+
+    def __init__(self, box: tuple):
+        x, y, w, h = box
+        self.x = np.array([x + w / 2, y + h / 2, w, h, 0, 0, 0, 0], dtype=np.float64)
+        std = [2 * self.POS_STD * h] * 4 + [10 * self.VEL_STD * h] * 4
+        self.P = np.diag(np.square(std))
+
+    def predict(self) -> tuple:
+        h = max(self.x[3], 1.0)
+        q = [self.POS_STD * h] * 4 + [self.VEL_STD * h] * 4
+        self.x = self.F @ self.x
+        self.P = self.F @ self.P @ self.F.T + np.diag(np.square(q))
+        return self.box()
+
+    def update(self, box: tuple) -> None:
+        x, y, w, h = box
+        z = np.array([x + w / 2, y + h / 2, w, h])
+        r = np.diag(np.square([self.POS_STD * max(self.x[3], 1.0)] * 4))
+        gain = self.P[:, :4] @ np.linalg.inv(self.P[:4, :4] + r)
+        self.x = self.x + gain @ (z - self.x[:4])
+        self.P = self.P - gain @ self.P[:4, :]
+
+    def box(self) -> tuple:
+        cx, cy, w, h = self.x[:4]
+        return cx - w / 2, cy - h / 2, w, h
+
+
+def _iou(a: tuple, b: tuple) -> float:
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    iw = max(0.0, min(ax + aw, bx + bw) - max(ax, bx))
+    ih = max(0.0, min(ay + ah, by + bh) - max(ay, by))
+    inter = iw * ih
+    union = aw * ah + bw * bh - inter
+    return inter / union if union > 0 else 0.0
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Class   : FaceTracker
+# Purpose : Associate detections across sampled video frames so a face seen
+#           in consecutive frames is embedded once, not once per frame.
+#           Every track runs a constant-velocity Kalman filter on its box
+#           (centre, width, height, as in SORT). Each frame's detections are
+#           matched greedily to the predicted boxes by IoU; unmatched
+#           detections start new tracks, and tracks missed for more than
+#           max_missed frames end.
+#
+# Arguments:
+#   • iou_threshold    Minimum IoU between prediction and detection to match.
+#   • max_missed       Sampled frames a track survives without a detection.
+#   • reembed_every    Re-embed a track every this many sampled frames (K).
+#   • quality_gain     Also re-embed when face quality (box area x detector
+#                      confidence) beats the best embedded one by this factor.
+#
+# update() returns, per detection, (track_id, embed?) plus the tracks that
+# ended on this frame; finish() ends the rest.
+# ────────────────────────────────────────────────────────────────────────────────
+class FaceTracker:
+    def __init__(
+        self,
+        iou_threshold: float = 0.3,
+        max_missed: int = 5,
+        reembed_every: int = 10,
+        quality_gain: float = 1.25
+    ):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.reembed_every = reembed_every
+        self.quality_gain = quality_gain
+        self.tracks = {}  # id -> state dict
+        self._next_id = 0
+        self._tick = 0    # sampled frames seen
+
+    def update(self, frame_no: int, time_s: float, faces: list):
+        self._tick += 1
+        ids = list(self.tracks)
+        predicted = [self.tracks[i]["kf"].predict() for i in ids]
+        boxes = [
+            tuple(float(face["facial_area"][k]) for k in ("x", "y", "w", "h"))
+            for face in faces
+        ]
+
+        # Greedy IoU matching, best pairs first
+        pairs = sorted(
+            (
+                (_iou(p, b), t, d)
+                for t, p in enumerate(predicted)
+                for d, b in enumerate(boxes)
+            ),
+            reverse=True,
+        )
+        matched_t, owner = set(), {}
+        for score, t, d in pairs:
+            if score < self.iou_threshold:
+                break
+            if t not in matched_t and d not in owner:
+                matched_t.add(t)
+                owner[d] = ids[t]
+
+        assignments = []
+        for d, (face, box) in enumerate(zip(faces, boxes)):
+            quality = box[2] * box[3] * (face.get("confidence") or 1.0)
+            track_id = owner.get(d)
+            if track_id is None:
+                track_id = self._next_id
+                self._next_id += 1
+                self.tracks[track_id] = {
+                    "kf": _BoxKalman(box),
+                    "missed": 0,
+                    "first_frame": frame_no,
+                    "first_time_s": time_s,
+                    "frames": 0,
+                    "last_embed": self._tick,
+                    "best_quality": quality,
+                }
+                embed = True
+            else:
+                track = self.tracks[track_id]
+                track["kf"].update(box)
+                track["missed"] = 0
+                embed = (
+                    self._tick - track["last_embed"] >= self.reembed_every
+                    or quality > track["best_quality"] * self.quality_gain
+                )
+                if embed:
+                    track["last_embed"] = self._tick
+                    track["best_quality"] = max(track["best_quality"], quality)
+            track = self.tracks[track_id]
+            track["frames"] += 1
+            track["last_frame"], track["last_time_s"] = frame_no, time_s
+            assignments.append((track_id, embed))
+
+        ended = []
+        for t, track_id in enumerate(ids):
+            if t in matched_t:
+                continue
+            track = self.tracks[track_id]
+            track["missed"] += 1
+            if track["missed"] > self.max_missed:
+                ended.append(self._end(track_id))
+        return assignments, ended
+
+    def finish(self) -> list:
+        return [self._end(track_id) for track_id in list(self.tracks)]
+
+    def _end(self, track_id: int) -> dict:
+        track = self.tracks.pop(track_id)
+        return {
+            "track": track_id,
+            "first_frame": track["first_frame"],
+            "last_frame": track["last_frame"],
+            "first_time_s": track["first_time_s"],
+            "last_time_s": track["last_time_s"],
+            "frames": track["frames"],
+        }
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Function: recognize_video
+# Purpose : Recognize faces in a video file, streaming one JSON line per
+#           sampled frame that contains faces. Three pipeline stages run
+#           concurrently, connected by bounded queues, so throughput is set
+#           by the slowest one:
+#             1. decode   (thread)  OpenCV decode; frames between samples are
+#                                   only grabbed, never converted to pixels
+#             2. detect   (thread)  detection + alignment per sampled frame,
+#                                   then FaceTracker decides which faces need
+#                                   a (re-)embedding
+#             3. embed    (caller)  crops from all frames waiting in the queue
+#                                   (up to batch_size) in one model call, then
+#                                   one gallery search for the whole batch;
+#                                   each match is a vote for its track
+#           OpenCV and TensorFlow release the GIL while they work, so threads
+#           overlap without copying frames between processes.
+#
+# Arguments: as recognize_face(), plus
+#   • video_path       Video file (anything cv2.VideoCapture can open).
+#   • out_path         JSONL destination (stdout if None).
+#   • enforce_detection Applies to gallery images only; frames without a
+#                      face are expected and simply produce no line.
+#   • sample_fps       Frames per second of video to analyse (None = all).
+#   • batch_size       Max face crops per model call.
+#   • track            Track faces across frames and embed each track only on
+#                      creation, every reembed_every sampled frames, or when
+#                      its face quality improves (False = embed every face).
+#   • reembed_every    K for the above.
+#
+# Returns : A summary dict (frames read / sampled / with faces, faces, faces
+#           embedded, tracks, matches, seconds, sampled frames per second).
+#           Each frame line has frame, time_s, timestamp (HH:MM:SS.mmm),
+#           faces, matches (faces embedded on this frame) and, when
+#           tracking, tracks: [{track, embedded, identity}]. When a track
+#           ends a line {track, first/last frame and time, frames,
+#           embeddings, identity, votes} follows, where identity is the
+#           gallery sub-folder (or file) with the most votes.
+# ────────────────────────────────────────────────────────────────────────────────
+# Frames / detections buffered between pipeline stages
+VIDEO_QUEUE_SIZE = 32
+
+
+def _timestamp(seconds: float) -> str:
+    ms = int(round(seconds * 1000.0))
+    return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d}.{ms % 1000:03d}"
+
+
+def recognize_video(
+    video_path: str,
+    db_path: str,
+    out_path: str = None,
+    model_name: str = "VGG-Face",
+    detector_backend: str = "opencv",
+    distance_metric: str = "cosine",
+    top_k: int = None,
+    index: str = "exact",
+    ef: int = None,
+    rerank: int = None,
+    enforce_detection: bool = True,
+    sample_fps: float = 2.0,
+    batch_size: int = 32,
+    track: bool = True,
+    reembed_every: int = 10,
+    cache: GalleryCache = None,
+    timings: StageTimer = None
+) -> dict:
+    import cv2
+
+    with _use_timer(timings):
+        store, searcher, threshold, options = _open_gallery(
+            db_path, model_name, detector_backend, enforce_detection,
+            distance_metric, index, ef, rerank, cache
+        )
+        capture = cv2.VideoCapture(video_path)
+        if not capture.isOpened():
+            raise ValueError(f"Could not open video: {video_path}")
+        source_fps = capture.get(cv2.CAP_PROP_FPS)
+        if not source_fps or source_fps != source_fps or source_fps <= 0:
+            source_fps = 25.0  # containers without a frame rate
+        step = max(source_fps / sample_fps, 1.0) if sample_fps else 1.0
+
+        frames_q = queue.Queue(VIDEO_QUEUE_SIZE)
+        faces_q = queue.Queue(VIDEO_QUEUE_SIZE)
+        stop = threading.Event()
+        errors = []
+        summary = {"frames_read": 0, "frames_sampled": 0, "frames_with_faces": 0,
+                   "faces": 0, "faces_embedded": 0, "tracks": 0, "matches": 0}
+        tracker = FaceTracker(reembed_every=reembed_every) if track else None
+        votes = {}                         # track id -> Counter(identity -> votes)
+        embeddings = collections.Counter()  # track id -> faces embedded
+
+        def put(q, item):
+            # Blocking put / get that give up once the pipeline is shutting
+            # down (get then returns the None end-of-stream marker)
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def get(q):
+            while True:
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    if stop.is_set():
+                        return None
+
+        def decode():
+            next_sample = 0.0
+            while not stop.is_set():
+                frame_no = summary["frames_read"]
+                if frame_no + 1e-9 < next_sample:
+                    if not capture.grab():
+                        break
+                    summary["frames_read"] += 1
+                    continue
+                with _stage("decode"):
+                    ok, frame = capture.read()
+                if not ok:
+                    break
+                summary["frames_read"] += 1
+                summary["frames_sampled"] += 1
+                next_sample += step
+                put(frames_q, (frame_no, frame_no / source_fps, frame))
+
+        def detect():
+            while True:
+                item = get(frames_q)
+                if item is None:
+                    break
+                frame_no, t, frame = item
+                # Frames without faces are normal in footage: never enforce,
+                # and drop the whole-frame placeholder DeepFace returns then
+                faces = _detect_faces(frame, detector_backend, enforce_detection=False)
+                faces = [face for face in faces if face.get("confidence") != 0]
+                if tracker is not None:
+                    assignments, ended = tracker.update(frame_no, t, faces)
+                else:
+                    assignments, ended = [(None, True)] * len(faces), []
+                for face, (track_id, embed) in zip(faces, assignments):
+                    face["track"], face["embed"] = track_id, embed
+                    if not embed:
+                        face["face"] = None  # crop not needed downstream
+                put(faces_q, (frame_no, t, faces, ended))
+            if tracker is not None and not stop.is_set():
+                put(faces_q, (None, None, [], tracker.finish()))
+
+        def run_stage(fn, out_q):
+            try:
+                fn()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                put(out_q, None)
+
+        workers = [
+            threading.Thread(
+                target=contextvars.copy_context().run, args=(run_stage, fn, out_q),
+                name=f"video-{fn.__name__}", daemon=True
+            )
+            for fn, out_q in ((decode, frames_q), (detect, faces_q))
+        ]
+        start = time.perf_counter()
+        out = open(out_path, "w", encoding="utf-8") if out_path else sys.stdout
+
+        def person(identity):
+            # Vote per gallery sub-folder (one per enrolled identity);
+            # loose files at the top of db_path vote as themselves
+            parts = os.path.relpath(identity, db_path).split(os.sep, 1)
+            return parts[0] if len(parts) > 1 else identity
+
+        def leader(track_id):
+            top = votes.get(track_id, collections.Counter()).most_common(1)
+            return top[0][0] if top else None
+
+        def flush(pending):
+            # Embed + search every face of the pending frames that needs it
+            crops = [
+                face["face"] for _, _, faces, _ in pending for face in faces if face["embed"]
+            ]
+            results = []
+            if crops:
+                with _stage("embed"):
+                    vectors = embed_faces(crops, model_name)
+                if searcher is not None:
+                    fetch = top_k + store.dead_rows if top_k and store.dead_rows else top_k
+                    with _stage("search"):
+                        results = list(zip(*searcher.search(vectors, fetch, **options)))
+            results = iter(results)
+            for frame_no, t, faces, ended in pending:
+                if faces:
+                    hits, tracks = [], []
+                    for face in faces:
+                        track_id = face["track"]
+                        if face["embed"]:
+                            dists, rows = next(results, ((), ()))
+                            found = _gallery_hits(
+                                store, face["facial_area"], dists, rows, threshold, top_k
+                            )
+                            if track_id is not None:
+                                embeddings[track_id] += 1
+                                for hit in found:
+                                    hit["track"] = track_id
+                                if found:
+                                    votes.setdefault(track_id, collections.Counter())[
+                                        person(found[0]["identity"])
+                                    ] += 1
+                            hits.extend(found)
+                        if track_id is not None:
+                            tracks.append({
+                                "track": track_id,
+                                "embedded": face["embed"],
+                                "identity": leader(track_id),
+                            })
+                    summary["frames_with_faces"] += 1
+                    summary["faces"] += len(faces)
+                    summary["faces_embedded"] += sum(1 for face in faces if face["embed"])
+                    summary["matches"] += len(hits)
+                    record = {
+                        "frame": frame_no,
+                        "time_s": round(t, 3),
+                        "timestamp": _timestamp(t),
+                        "faces": len(faces),
+                        "matches": hits,
+                    }
+                    if tracker is not None:
+                        record["tracks"] = tracks
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                for info in ended:
+                    track_id = info["track"]
+                    info.update(
+                        start=_timestamp(info["first_time_s"]),
+                        end=_timestamp(info["last_time_s"]),
+                        embeddings=embeddings.pop(track_id, 0),
+                        identity=leader(track_id),
+                        votes=dict(votes.pop(track_id, {})),
+                    )
+                    summary["tracks"] += 1
+                    out.write(json.dumps(info, ensure_ascii=False) + "\n")
+
+        try:
+            for worker in workers:
+                worker.start()
+            pending, n_crops, done = [], 0, False
+            while not done:
+                item = get(faces_q)
+                if item is None:
+                    done = True
+                else:
+                    pending.append(item)
+                    n_crops += sum(1 for face in item[2] if face["embed"])
+                # Batch whatever detection has already produced: big batches
+                # when embedding is the bottleneck, low latency otherwise
+                if pending and (done or n_crops >= batch_size or faces_q.empty()):
+                    flush(pending)
+                    pending, n_crops = [], 0
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+            capture.release()
+            if out is not sys.stdout:
+                out.close()
+            else:
+                out.flush()
+        if errors:
+            raise errors[0]
+
+    elapsed = time.perf_counter() - start
+    summary.update(
+        video=video_path,
+        source_fps=round(source_fps, 3),
+        sample_fps=sample_fps,
+        seconds=round(elapsed, 3),
+        frames_per_s=round(summary["frames_sampled"] / elapsed, 2) if elapsed else 0.0,
+    )
+    return summary
+
+
+def _synthetic_queries(gallery: np.ndarray, n_queries: int, seed: int = 0) -> np.ndarray:
+    # Gallery rows plus small Gaussian noise: realistic near-duplicate probes
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(gallery), size=n_queries)
+    scale = 0.05 * float(np.mean(np.abs(gallery)))
+    noise = rng.normal(0.0, scale, size=(n_queries, gallery.shape[1]))
+    return (gallery[picks] + noise).astype(np.float32)
+
+
+def _timed_search(searcher, queries: np.ndarray, top_k: int):
+    # Run queries one at a time so latency reflects the online path;
+    # returns (rows found per query, per-query milliseconds)
+    found, times = [], []
+    for q in queries:
+        start = time.perf_counter()
+        found.append(searcher.search(q, top_k)[1][0])
+        times.append((time.perf_counter() - start) * 1000.0)
+    return np.asarray(found), np.asarray(times)
+
+
+def _recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    # Mean fraction of the exact top-k that the approximate search returned
+    return float(np.mean([
+        len(set(f.tolist()) & set(t.tolist())) / len(t) for f, t in zip(found, truth)
+    ]))
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Function: quantization_report
+# Purpose : Memory saving and recall loss of the int8 / float16 / PQ indexes
+#           against exact float32 search, for the benchmark report.
+# ────────────────────────────────────────────────────────────────────────────────
+def quantization_report(
+    store: EmbeddingStore,
+    distance_metric: str = "cosine",
+    n_queries: int = 200,
+    top_k: int = 10,
+    seed: int = 0
+) -> dict:
+    if not store.identities:
+        return {}
+    queries = _synthetic_queries(store.embeddings, n_queries, seed)
+    top_k = min(top_k, len(store.identities))
+    truth, exact_ms = _timed_search(
+        load_index(store, distance_metric, "exact"), queries, top_k
+    )
+    report = {"exact_mean_ms": round(float(exact_ms.mean()), 3)}
+    for dtype in QuantizedIndex.DTYPES + ("pq",):
+        index = load_index(store, distance_metric, dtype)
+        found, ms = _timed_search(index, queries, top_k)
+        memory = index.memory_bytes()
+        report[dtype] = {
+            "float32_bytes": memory["float32"],
+            "code_bytes": memory[dtype],
+            "memory_saving": round(1.0 - memory[dtype] / max(memory["float32"], 1), 4),
+            f"recall@{top_k}": round(_recall_at_k(found, truth), 4),
+            "rerank": index.rerank,
+            "mean_ms": round(float(ms.mean()), 3),
+        }
+    return report
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Function: index_report
+# Purpose : Measure recall and latency of the HNSW index against exact
+#           search on the embedding store of a gallery folder.
+#           Queries are gallery rows with small Gaussian noise added, so no
+#           probe images are needed.
+#
+# Arguments:
+#   • db_path          Directory containing the gallery.
+#   • model_name       Embedding model the store was built with.
+#   • detector_backend Face detector the store was built with.
+#   • distance_metric  cosine, euclidean or euclidean_l2.
+#   • ef_values        HNSW ef_search settings to sweep.
+#   • n_queries        Number of synthetic queries.
+#   • top_k            Recall is measured as recall@top_k.
+#   • seed             Seed for the synthetic queries.
+#   • enforce_detection Which store of the gallery to measure (see
+#                      EmbeddingStore).
+#
+# Returns : A dict with build time, exact latency and one row per ef value.
+# ────────────────────────────────────────────────────────────────────────────────
+def index_report(
+    db_path: str,
+    model_name: str = "VGG-Face",
+    detector_backend: str = "opencv",
+    distance_metric: str = "cosine",
+    ef_values: list = None,
+    n_queries: int = 200,
+    top_k: int = 10,
+    seed: int = 0,
+    enforce_detection: bool = True
+) -> dict:
+    if ef_values is None:
+        ef_values = [16, 32, 64, 128, 256]
+
+    store = open_store(db_path, model_name, detector_backend, enforce_detection)
+    if not store.identities:
+        return {"gallery_size": 0}
+    gallery = store.embeddings
+    queries = _synthetic_queries(gallery, n_queries, seed)
+    top_k = min(top_k, len(gallery))
+
+    def per_query_ms(searcher):
+        return _timed_search(searcher, queries, top_k)
+
+    exact = ExactIndex(gallery, distance_metric, store.norms)
+    truth, exact_ms = per_query_ms(exact)
+
+    start = time.perf_counter()
+    hnsw = load_index(store, distance_metric, "hnsw")
+    load_s = time.perf_counter() - start
+
+    rows = []
+    for ef in ef_values:
+        hnsw.ef_search = ef
+        found, ms = per_query_ms(hnsw)
+        recall = _recall_at_k(found, truth)
+        rows.append({
+            "ef": ef,
+            f"recall@{top_k}": round(float(recall), 4),
+            "mean_ms": round(float(ms.mean()), 3),
+            "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        })
+
+    return {
+        "gallery_size": len(gallery),
+        "distance_metric": distance_metric,
+        "queries": n_queries,
+        "hnsw_load_or_build_s": round(load_s, 3),
+        "exact": {
+            "mean_ms": round(float(exact_ms.mean()), 3),
+            "p95_ms": round(float(np.percentile(exact_ms, 95)), 3),
+        },
+        "hnsw": rows,
+    }
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Attribute analysis pipeline
+#
+# Each image goes through detection + alignment exactly once; the aligned
+# crops of every image in the call are then stacked and fanned out to the
+# requested attribute models, one batched forward pass per action. Output
+# matches DeepFace.analyze(): one dict per face with age, gender, race,
+# emotion (+ dominant_*), region and face_confidence.
+# ────────────────────────────────────────────────────────────────────────────────
+EMOTION_LABELS = ["angry", "disgust", "fear", "happy", "sad", "surprise", "neutral"]
+GENDER_LABELS = ["Woman", "Man"]
+RACE_LABELS = ["asian", "indian", "black", "white", "middle eastern", "latino hispanic"]
+# Input size shared by the age / gender / race models
+ATTRIBUTE_INPUT = (224, 224)
+
+
+def _attribute_model(action: str):
+    # DeepFace client for one attribute model (cached by DeepFace itself)
+    try:
+        return DeepFace.build_model(model_name=action.capitalize(), task="facial_attribute")
+    except TypeError:  # deepface < 0.0.90 has no task argument
+        return DeepFace.build_model(action.capitalize())
+
+
+def _predict_batch(client, batch: np.ndarray) -> np.ndarray:
+    # One forward pass through the client's Keras model when it exposes one
+    keras_model = getattr(client, "model", None)
+    if hasattr(keras_model, "predict_on_batch"):
+        return np.asarray(keras_model.predict_on_batch(batch), dtype=np.float64)
+    return np.asarray([client.predict(img[None, ...]) for img in batch], dtype=np.float64)
+
+
+def _attribute_fields(action: str, preds: np.ndarray) -> dict:
+    # Turn one face's raw model output into DeepFace.analyze() fields
+    if action == "age":
+        return {"age": int(np.sum(preds * np.arange(len(preds))))}
+    labels = {"gender": GENDER_LABELS, "race": RACE_LABELS, "emotion": EMOTION_LABELS}[action]
+    if action == "gender":
+        scores = 100.0 * preds
+    else:
+        scores = 100.0 * preds / max(float(preds.sum()), 1e-12)
+    return {
+        action: {label: float(v) for label, v in zip(labels, scores)},
+        f"dominant_{action}": labels[int(np.argmax(preds))],
+    }
+
+
+def analyze_images(
+    img_paths: list,
+    actions: list,
+    detector_backend: str = "mtcnn",
+    enforce_detection: bool = True,
+    timings: StageTimer = None
+) -> list:
+    # Analyze a list of images with one detection pass per image and one
+    # batched model call per action. Returns, per image, either a list of
+    # face dicts or the exception raised while detecting faces in it.
+    # Stages and counters go to `timings` (or the active StageTimer).
+    with _use_timer(timings):
+        # Stage 1: decode + detection + alignment, once per image
+        results, crops, owners = [], [], []
+        for path in img_paths:
+            _count("images")
+            try:
+                faces = _extract_faces(_image_input(path), detector_backend, enforce_detection)
+            except Exception as e:
+                results.append(e)
+                continue
+            records = []
+            for face in faces:
+                records.append({
+                    "region": face["facial_area"],
+                    "face_confidence": face.get("confidence"),
+                })
+                crops.append(face["face"])
+                owners.append(records[-1])
+            results.append(records)
+        if not crops:
+            return results
+
+        # Stage 2: shared preprocessing (BGR, letterboxed to the model input)
+        with _stage("preprocess"):
+            batch = np.stack([_prepare_face(crop, ATTRIBUTE_INPUT) for crop in crops])
+
+        # Stage 3: fan the same crops out to each attribute model
+        import cv2
+
+        for action in actions:
+            with _stage(action):
+                if action == "emotion":
+                    # Emotion model takes 48x48 grayscale
+                    inputs = np.stack([
+                        cv2.resize(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), (48, 48))[..., None]
+                        for img in batch
+                    ])
+                else:
+                    inputs = batch
+                preds = _predict_batch(_attribute_model(action), inputs)
+                for record, pred in zip(owners, preds):
+                    record.update(_attribute_fields(action, pred))
+        return results
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Function: analyze_face
+# Purpose : Detect a face in an image and estimate attributes:
+#           age, gender, race composition, emotion scores.
+#           Detection runs once; all faces share one pass per attribute model.
 #
 # Arguments:
-#   • img_path         Path to the image you want to recognize.
-#   • db_path          Directory containing one face image per person.
-#   • model_name       Embedding model to use (VGG‑Face, Facenet, ArcFace…).
-#   • detector_backend Face detector to use (opencv, mtcnn, dlib, retinaface).
-#   • enforce_detection If False, won’t error on “no face found”.
+#   • img_path         The image to analyze (path, bytes, file object or
+#                      HxWx3 uint8 BGR array, as for recognize_face).
+#   • actions          List of analyses to run (["age","gender","race","emotion"]).
+#   • model_name       Kept for CLI compatibility; attribute models are fixed.
+#   • detector_backend Face detector (mtcnn, opencv, dlib, retinaface).
+#   • enforce_detection If False, won’t error if no face found.
+#   • output_json      If provided, write a JSON report to this filepath.
+#   • timings          Optional StageTimer that receives per-stage timings.
 #
-# Returns : A list of dicts, each with “identity” and distance scores.
+# Returns : A dict containing requested attributes and their values.
 # ────────────────────────────────────────────────────────────────────────────────
-def recognize_face(
+def analyze_face(
     img_path: str,
-    db_path: str,
-    model_name: str = "VGG-Face",
-    detector_backend: str = "opencv",
-    enforce_detection: bool = True
+    actions: list = None,
+    model_name: str = "Facenet",
+    detector_backend: str = "mtcnn",
+    enforce_detection: bool = True,
+    output_json: str = None,
+    timings: StageTimer = None
+) -> dict:
+    # Default to all four analyses if none specified
+    if actions is None:
+        actions = ["age", "gender", "race", "emotion"]
+
+    try:
+        # One detection pass, then every requested attribute model
+        result = analyze_images(
+            [img_path], actions, detector_backend, enforce_detection, timings
+        )[0]
+        if isinstance(result, Exception):
+            raise result
+        # Optionally dump the result dict to a JSON file
+        if output_json:
+            with open(output_json, "w", encoding="utf-8") as fp:
+                json.dump(result, fp, indent=4, ensure_ascii=False, default=_json_default)
+        return result
+    except Exception as e:
+        if _raise_errors.get():
+            raise
+        # Print any errors to stderr and return an empty dict
+        print(f"[ERROR] Analysis failed: {e}", file=sys.stderr)
+        return {}
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Function: analyze_batch
+# Purpose : Run analyze over many images through a worker pool and stream one
+#           compact JSON line per detected face as soon as it is ready.
+#           Lines are flushed one by one, so memory stays flat and everything
+#           written before a crash is kept (see `resume`).
+#
+# Arguments:
+#   • img_paths        Iterable of image paths (consumed lazily).
+#   • out_path         JSONL destination (stdout if None).
+#   • actions          List of analyses to run (["age","gender","race","emotion"]).
+#   • model_name       Embedding model (Facenet, VGG‑Face, ArcFace…).
+#   • detector_backend Face detector (mtcnn, opencv, dlib, retinaface).
+#   • enforce_detection If False, won’t error if no face found.
+#   • workers          Number of worker processes (1 = run in-process).
+#   • resume           Append to out_path, skipping images already in it.
+#   • batch_size       Images per batched attribute-model call.
+#
+# Returns : A summary dict (images, faces, errors, skipped, seconds…) with
+#           per-stage "timings" summed over all images.
+#           Each line carries img_path and face_index plus the attributes,
+#           or img_path and an "error" message.
+# ────────────────────────────────────────────────────────────────────────────────
+_ANALYZE_CONFIG = {}
+
+
+def _analyze_init(config: dict) -> None:
+    # Worker initializer: remember the settings and load the models once
+    _ANALYZE_CONFIG.update(config)
+    warm_models([], config["actions"])
+
+
+def _analyze_chunk(img_paths: list):
+    # Analyze a chunk of images together; returns (records per image, timings)
+    # where each record list is JSONL-ready (one dict per face or one error)
+    cfg = _ANALYZE_CONFIG
+    timings = StageTimer()
+    try:
+        results = analyze_images(
+            img_paths,
+            cfg["actions"],
+            cfg["detector_backend"],
+            cfg["enforce_detection"],
+            timings
+        )
+    except Exception as e:  # a model failure takes the whole chunk down
+        results = [e] * len(img_paths)
+    records = []
+    for path, faces in zip(img_paths, results):
+        if isinstance(faces, Exception):
+            records.append([{"img_path": path, "error": str(faces)}])
+        else:
+            records.append([
+                dict(face, img_path=path, face_index=i) for i, face in enumerate(faces)
+            ])
+    return records, timings.as_dict()
+
+
+def _chunked(items, size: int):
+    # Group an iterable into lists of at most `size` items, lazily
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_image_paths(input_dir: str = None, input_list: str = None):
+    # Yield image paths from a folder (recursively) and/or a text file with
+    # one path per line
+    if input_dir:
+        for rel in _list_images(input_dir):
+            yield os.path.join(input_dir, rel)
+    if input_list:
+        with open(input_list, encoding="utf-8") as fp:
+            for line in fp:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    yield line
+
+
+def analyze_batch(
+    img_paths,
+    out_path: str = None,
+    actions: list = None,
+    model_name: str = "Facenet",
+    detector_backend: str = "mtcnn",
+    enforce_detection: bool = True,
+    workers: int = 1,
+    resume: bool = False,
+    batch_size: int = 16
+) -> dict:
+    if actions is None:
+        actions = ["age", "gender", "race", "emotion"]
+    config = {
+        "actions": actions,
+        "model_name": model_name,
+        "detector_backend": detector_backend,
+        "enforce_detection": enforce_detection,
+    }
+    summary = {"images": 0, "faces": 0, "errors": 0, "skipped": 0}
+    timings = StageTimer()
+
+    # Images already present in a previous (possibly interrupted) run
+    done = set()
+    if resume and out_path and os.path.exists(out_path):
+        with open(out_path, encoding="utf-8") as fp:
+            for line in fp:
+                try:
+                    done.add(json.loads(line)["img_path"])
+                except (ValueError, KeyError):
+                    continue  # truncated last line from a crash
+
+    def pending():
+        for path in img_paths:
+            if path in done:
+                summary["skipped"] += 1
+                continue
+            yield path
+
+    start = time.perf_counter()
+    mode = "a" if resume else "w"
+    out = open(out_path, mode, encoding="utf-8") if out_path else sys.stdout
+    pool = None
+    try:
+        if workers > 1:
+            pool = multiprocessing.get_context("spawn").Pool(
+                workers, initializer=_analyze_init, initargs=(config,)
+            )
+            chunks = pool.imap_unordered(_analyze_chunk, _chunked(pending(), batch_size))
+        else:
+            _analyze_init(config)
+            chunks = map(_analyze_chunk, _chunked(pending(), batch_size))
+
+        for chunk_records, chunk_timings in chunks:
+            timings.merge(chunk_timings)
+            for records in chunk_records:
+                summary["images"] += 1
+                for record in records:
+                    if "error" in record:
+                        summary["errors"] += 1
+                    else:
+                        summary["faces"] += 1
+                    out.write(json.dumps(
+                        record, ensure_ascii=False, separators=(",", ":"), default=_json_default
+                    ) + "\n")
+            out.flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if out is not sys.stdout:
+            out.close()
+
+    elapsed = time.perf_counter() - start
+    summary["seconds"] = round(elapsed, 3)
+    summary["images_per_s"] = round(summary["images"] / elapsed, 2) if elapsed else 0.0
+    summary["timings"] = timings.as_dict()
+    return summary
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Class   : _DiskCache
+# Purpose : Shared machinery of the on-disk caches below: one .npz file per
+#           entry under <cache_dir>/<key[:2]>/<key>.npz, where a file's mtime
+#           is its last use. Once the cache grows past max_bytes, the least
+#           recently used entries are deleted until it is back under 90% of
+#           the limit. Writes go through a temp file and os.replace, so
+#           concurrent processes can share a cache directory.
+#
+#           The total size is kept in <cache_dir>/size: each write adds its
+#           entry to it, and every eviction scan rewrites it exactly. Only
+#           a total over budget (or a missing size file) walks the
+#           directory, so a one-shot command writing a single entry stays
+#           cheap however large the cache is. Concurrent writers can lose
+#           each other's increments; the next scan corrects that.
+#
+# Arguments:
+#   • cache_dir        Directory (default <root>/<SUBDIR>, where root is
+#                      $FACETOOL_CACHE_DIR, else $XDG_CACHE_HOME/facetool).
+#   • max_bytes        Size budget for all entries.
+#
+# Hits and misses are counted on the object and as the <COUNTER>_hits /
+# <COUNTER>_misses counters of the active StageTimer.
+# ────────────────────────────────────────────────────────────────────────────────
+class _DiskCache:
+    SUBDIR = None
+    COUNTER = None
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = 512 * 1024 * 1024):
+        if cache_dir is None:
+            cache_dir = os.path.join(_cache_root(), self.SUBDIR)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._bytes = None  # last total read or written; None until then
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "bytes": self._bytes}
+
+    def _read(self, key: str):
+        # Arrays stored under key (a dict), or None on a miss
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(path)  # LRU clock
+        except (OSError, ValueError):
+            arrays = None
+        with self._lock:
+            if arrays is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        _count(f"{self.COUNTER}_{'misses' if arrays is None else 'hits'}")
+        return arrays
+
+    def _write(self, key: str, compress: bool = False, **arrays) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        (np.savez_compressed if compress else np.savez)(tmp, **arrays)
+        os.replace(tmp, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            total = self._read_total()
+            if total is not None:
+                total += size
+                self._write_total(total)
+                self._bytes = total
+        if total is None or total > self.max_bytes:
+            self._evict()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".npz")
+
+    def _read_total(self):
+        # Bytes recorded in the size file, or None if it is missing
+        try:
+            with open(os.path.join(self.cache_dir, "size"), encoding="utf-8") as fp:
+                return int(fp.read())
+        except (OSError, ValueError):
+            return None
+
+    def _write_total(self, total: int) -> None:
+        path = os.path.join(self.cache_dir, "size")
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fp:
+            fp.write(str(total))
+        os.replace(tmp, path)
+
+    def _evict(self) -> None:
+        # Re-scan (other processes may share the directory), then drop the
+        # least recently used entries down to 90% of the budget
+        entries, total = [], 0
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if not name.endswith(".npz") or name.endswith(".tmp.npz"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, path))
+                total += st.st_size
+        if total > self.max_bytes:
+            entries.sort()
+            for _, size, path in entries:
+                if total <= 0.9 * self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                _count(f"{self.COUNTER}_evictions")
+        with self._lock:
+            self._write_total(total)
+            self._bytes = total
+
+
+def _cache_root() -> str:
+    # Root directory of the on-disk caches
+    return os.environ.get("FACETOOL_CACHE_DIR") or os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "facetool"
+    )
+
+
+def _content_hash(img) -> str:
+    # SHA-1 of an image file's bytes, or None for anything that is not a
+    # path. In-memory inputs (bytes, arrays) are never cached on disk: that
+    # would cost the disk round-trip they avoid and keep a copy of every
+    # uploaded image.
+    if isinstance(img, (str, os.PathLike)):
+        return _file_hash(img)
+    return None
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Class   : EmbeddingCache
+# Purpose : On-disk LRU cache of represent() results for individual images,
+#           so verifying the same reference photo again skips detection and
+#           embedding entirely. Entries are keyed by
+#           (image content hash, model, detector backend, alignment,
+#           enforce_detection), so a renamed or copied file still hits and
+#           an edited one misses. Each entry holds the embeddings plus the
+#           facial areas and confidences.
+# ────────────────────────────────────────────────────────────────────────────────
+class EmbeddingCache(_DiskCache):
+    SUBDIR = "embeddings"
+    COUNTER = "embed_cache"
+
+    @staticmethod
+    def key(
+        digest: str,
+        model_name: str,
+        detector_backend: str,
+        enforce_detection: bool = True,
+        align: bool = True,
+        detect_side: int = 0
+    ) -> str:
+        raw = f"{digest}\0{model_name}\0{detector_backend}\0align={align:d}\0enforce={enforce_detection:d}"
+        if detect_side:
+            raw += f"\0side={detect_side}"
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def get(self, key: str):
+        # Cached represent() result, or None on a miss
+        data = self._read(key)
+        if data is None:
+            return None
+        meta = json.loads(str(data["meta"]))
+        return [
+            {"embedding": vector, "facial_area": area, "face_confidence": confidence}
+            for vector, (area, confidence) in zip(data["embeddings"], meta)
+        ]
+
+    def put(self, key: str, reps: list) -> None:
+        self._write(
+            key,
+            embeddings=np.asarray([r["embedding"] for r in reps], dtype=np.float32),
+            meta=np.asarray(json.dumps(
+                [[r["facial_area"], r.get("face_confidence")] for r in reps],
+                default=_json_default,
+            )),
+        )
+
+    def wrap(self, embedder=None):
+        # Embedder with the same signature as _represent() that consults the
+        # cache first; only file paths are hashed and cached
+        embed = embedder or _represent
+
+        def cached(img_path, model_name, detector_backend, enforce_detection=True):
+            digest = _content_hash(img_path)
+            if digest is None:
+                return embed(img_path, model_name, detector_backend, enforce_detection)
+            key = self.key(
+                digest, model_name, detector_backend, enforce_detection,
+                detect_side=_detect_side()
+            )
+            reps = self.get(key)
+            if reps is None:
+                reps = embed(img_path, model_name, detector_backend, enforce_detection)
+                self.put(key, reps)
+            return reps
+
+        return cached
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Class   : FaceCropCache
+# Purpose : On-disk LRU cache of extract_faces() results (aligned crops,
+#           facial areas, confidences), keyed by (image content hash,
+#           detector backend, alignment, enforce_detection). Detection does
+#           not depend on the recognition model, so building a second
+#           model's gallery, or re-running with another --model, reuses the
+#           crops instead of running the detector again.
+#
+#           Crops are stored compressed. DeepFace hands them out as uint8
+#           pixels divided by 255, so they are stored as uint8 whenever
+#           that is lossless, and as float32 otherwise.
+#
+# Only gallery images use it by default; probe images are usually seen once,
+# and caching them would keep a copy of every submitted face on disk.
+# Processes spawned for gallery builds pick up the same settings, because
+# the default instance is configured through the environment:
+# $FACETOOL_CROP_CACHE=0 disables it, $FACETOOL_CROP_CACHE=all extends it
+# to probe images, and $FACETOOL_CROP_CACHE_MB sets its size (default 2048).
+# ────────────────────────────────────────────────────────────────────────────────
+class FaceCropCache(_DiskCache):
+    SUBDIR = "crops"
+    COUNTER = "crop_cache"
+
+    @staticmethod
+    def key(
+        digest: str,
+        detector_backend: str,
+        enforce_detection: bool = True,
+        align: bool = True,
+        detect_side: int = 0
+    ) -> str:
+        raw = f"{digest}\0{detector_backend}\0align={align:d}\0enforce={enforce_detection:d}"
+        if detect_side:
+            raw += f"\0side={detect_side}"
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def get(self, key: str):
+        # Cached extract_faces() result, or None on a miss
+        data = self._read(key)
+        if data is None:
+            return None
+        faces = []
+        for i, (area, confidence) in enumerate(json.loads(str(data["meta"]))):
+            crop = data[f"face_{i}"]
+            if crop.dtype == np.uint8:
+                crop = crop / 255.0
+            faces.append({"face": crop, "facial_area": area, "confidence": confidence})
+        return faces
+
+    def put(self, key: str, faces: list) -> None:
+        crops = {}
+        for i, face in enumerate(faces):
+            crop = np.asarray(face["face"])
+            pixels = np.rint(crop * 255.0)
+            lossless = crop.size == 0 or (
+                pixels.min() >= 0 and pixels.max() <= 255
+                and np.abs(pixels / 255.0 - crop).max() < 1e-6
+            )
+            crops[f"face_{i}"] = pixels.astype(np.uint8) if lossless else crop.astype(np.float32)
+        meta = [[face["facial_area"], face.get("confidence")] for face in faces]
+        self._write(
+            key, compress=True,
+            meta=np.asarray(json.dumps(meta, default=_json_default)), **crops
+        )
+
+    def detect(
+        self,
+        img,
+        detector_backend: str,
+        enforce_detection: bool = True,
+        detect_side: int = 0
+    ) -> list:
+        # _detect_image() with the crops served from the cache when this
+        # image was detected with these settings before
+        digest = _content_hash(img)
+        if digest is None:
+            return _detect_image(img, detector_backend, enforce_detection, detect_side)
+        key = self.key(digest, detector_backend, enforce_detection, detect_side=detect_side)
+        faces = self.get(key)
+        if faces is None:
+            faces = _detect_image(img, detector_backend, enforce_detection, detect_side)
+            self.put(key, faces)
+        else:
+            _count("faces", len(faces))
+        return faces
+
+
+_default_crop_cache = None
+
+
+def _extract_faces(
+    img,
+    detector_backend: str,
+    enforce_detection: bool = True,
+    gallery: bool = False
 ) -> list:
+    # Decode + detect + align one image, decoding at $FACETOOL_DETECT_SIDE.
+    # Gallery images go through the default FaceCropCache unless
+    # $FACETOOL_CROP_CACHE=0; probe images only if it is "all".
+    global _default_crop_cache
+    mode = os.environ.get("FACETOOL_CROP_CACHE", "1")
+    if mode == "0" or (not gallery and mode != "all"):
+        return _detect_image(img, detector_backend, enforce_detection, _detect_side())
+    if _default_crop_cache is None:
+        _default_crop_cache = FaceCropCache(
+            max_bytes=int(float(os.environ.get("FACETOOL_CROP_CACHE_MB", 2048)) * 1024 * 1024)
+        )
+    return _default_crop_cache.detect(img, detector_backend, enforce_detection, _detect_side())
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Function: verify_faces
+# Purpose : Compare two face images and decide if they show the same person.
+#
+# Arguments:
+#   • img1             First image (path, bytes, file object or HxWx3 uint8
+#                      BGR array, as for recognize_face).
+#   • img2             Second image.
+#   • model_name       Embedding model (ArcFace, Facenet, VGG‑Face…).
+#   • distance_metric  How to compute similarity (cosine, euclidean…).
+#   • detector_backend Face detector (dlib, mtcnn, opencv, retinaface).
+#   • enforce_detection If False, won’t error if no face found.
+#   • embedder         Optional callable replacing DeepFace.represent().
+#   • embedding_cache  EmbeddingCache consulted before embedding either image
+#                      (None = the default on-disk cache, False = off).
+#   • timings          Optional StageTimer that receives per-stage timings.
+#
+# Returns : A dict with keys:
+#           – verified (bool)
+#           – distance (float)
+#           – threshold (float)
+# ────────────────────────────────────────────────────────────────────────────────
+def verify_faces(
+    img1: str,
+    img2: str,
+    model_name: str = "ArcFace",
+    distance_metric: str = "cosine",
+    detector_backend: str = "dlib",
+    enforce_detection: bool = True,
+    embedder=None,
+    embedding_cache=None,
+    timings: StageTimer = None
+) -> dict:
+    with _use_timer(timings):
+        try:
+            # Embed both images, then compare like DeepFace.verify(): the
+            # closest pair of faces across the two images decides
+            embed = _cached_embedder(embedder, embedding_cache)
+            reps1 = embed(_image_input(img1), model_name, detector_backend, enforce_detection)
+            reps2 = embed(_image_input(img2), model_name, detector_backend, enforce_detection)
+            threshold = _find_threshold(model_name, distance_metric)
+            with _stage("compare"):
+                return _compare_embeddings(
+                    _stack_embeddings(reps1), _stack_embeddings(reps2),
+                    distance_metric, threshold
+                )
+        except Exception as e:
+            if _raise_errors.get():
+                raise
+            # Print any errors to stderr and return an empty dict
+            print(f"[ERROR] Verification failed: {e}", file=sys.stderr)
+            return {}
+
+
+_default_embedding_cache = None
+
+
+def _cached_embedder(embedder=None, embedding_cache=None):
+    # embedder (default _represent) behind embedding_cache: None selects the
+    # process-wide default EmbeddingCache, False disables caching
+    global _default_embedding_cache
+    if embedding_cache is False:
+        return embedder or _represent
+    if embedding_cache is None:
+        if _default_embedding_cache is None:
+            _default_embedding_cache = EmbeddingCache()
+        embedding_cache = _default_embedding_cache
+    return embedding_cache.wrap(embedder)
+
+
+def _stack_embeddings(reps: list) -> np.ndarray:
+    # (n_faces, dim) float32 matrix from a list of represent() results
+    if not reps:
+        raise ValueError("No face embedding produced")
+    return np.asarray([r["embedding"] for r in reps], dtype=np.float32)
+
+
+def _compare_embeddings(
+    vecs1: np.ndarray,
+    vecs2: np.ndarray,
+    distance_metric: str,
+    threshold: float
+) -> dict:
+    # Verification verdict from the closest pair of faces across two images
+    distance = float(ExactIndex(vecs2, distance_metric).distances(vecs1).min())
+    return {
+        "verified": distance <= threshold,
+        "distance": distance,
+        "threshold": threshold
+    }
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Function: verify_pairs
+# Purpose : Verify many image pairs listed in a CSV file, streaming one JSON
+#           line per pair. Each distinct image is embedded once and kept in
+#           an in-memory LRU cache, so cost scales with unique images rather
+#           than with pairs.
+#
+# Arguments:
+#   • pairs_path       CSV with two columns (img1,img2); header row optional.
+#   • out_path         JSONL destination (stdout if None).
+#   • model_name       Embedding model (ArcFace, Facenet, VGG‑Face…).
+#   • distance_metric  How to compute similarity (cosine, euclidean…).
+#   • detector_backend Face detector (dlib, mtcnn, opencv, retinaface).
+#   • enforce_detection If False, won’t error if no face found.
+#   • cache_size       Max number of images whose embeddings are kept.
+#   • embedder         Optional callable replacing DeepFace.represent().
+#   • embedding_cache  On-disk EmbeddingCache behind the in-memory one
+#                      (None = default, False = off).
+#
+# Returns : A summary dict (pairs, verified, errors, embedded, cache_hits…).
+#           Per-pair lines carry img1, img2 and either verified / distance /
+#           threshold or an "error" message.
+# ────────────────────────────────────────────────────────────────────────────────
+def verify_pairs(
+    pairs_path: str,
+    out_path: str = None,
+    model_name: str = "ArcFace",
+    distance_metric: str = "cosine",
+    detector_backend: str = "dlib",
+    enforce_detection: bool = True,
+    cache_size: int = 100000,
+    embedder=None,
+    embedding_cache=None
+) -> dict:
+    embed = _cached_embedder(embedder, embedding_cache)
+    threshold = _find_threshold(model_name, distance_metric)
+    cache = collections.OrderedDict()
+    summary = {"pairs": 0, "verified": 0, "errors": 0, "embedded": 0, "cache_hits": 0}
+
+    def lookup(path):
+        # Embeddings for one image, or the exception raised while embedding it
+        if path in cache:
+            cache.move_to_end(path)
+            summary["cache_hits"] += 1
+            return cache[path]
+        try:
+            value = _stack_embeddings(embed(path, model_name, detector_backend, enforce_detection))
+        except Exception as e:
+            value = e
+        summary["embedded"] += 1
+        cache[path] = value
+        if len(cache) > cache_size:
+            cache.popitem(last=False)
+        return value
+
+    start = time.perf_counter()
+    out = open(out_path, "w", encoding="utf-8") if out_path else sys.stdout
+    try:
+        with open(pairs_path, newline="", encoding="utf-8") as fp:
+            for line_no, row in enumerate(csv.reader(fp)):
+                row = [cell.strip() for cell in row]
+                if not row or not row[0] or row[0].startswith("#"):
+                    continue
+                if line_no == 0 and [c.lower() for c in row[:2]] == ["img1", "img2"]:
+                    continue
+                summary["pairs"] += 1
+                if len(row) < 2:
+                    record = {"img1": row[0], "img2": None, "error": "Missing second image"}
+                else:
+                    record = {"img1": row[0], "img2": row[1]}
+                    vecs1, vecs2 = lookup(row[0]), lookup(row[1])
+                    failed = next((v for v in (vecs1, vecs2) if isinstance(v, Exception)), None)
+                    if failed is not None:
+                        record["error"] = str(failed)
+                    else:
+                        record.update(
+                            _compare_embeddings(vecs1, vecs2, distance_metric, threshold)
+                        )
+                if "error" in record:
+                    summary["errors"] += 1
+                elif record["verified"]:
+                    summary["verified"] += 1
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        else:
+            out.flush()
+
+    elapsed = time.perf_counter() - start
+    summary["seconds"] = round(elapsed, 3)
+    summary["pairs_per_s"] = round(summary["pairs"] / elapsed, 2) if elapsed else 0.0
+    return summary
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Batched embedding: detection stays per request, but aligned face crops from
+# concurrent requests are pooled and pushed through the model in one call.
+# ────────────────────────────────────────────────────────────────────────────────
+# ────────────────────────────────────────────────────────────────────────────────
+# Class   : MicroBatcher
+# Purpose : Collect face crops submitted from many threads and embed them
+#           together: a batch runs as soon as max_batch_size crops are queued
+#           or max_wait_ms has passed since the first one arrived.
+#
+# Each request gets back its own latency record:
+#   • queue_ms    time spent waiting for the batch to close
+#   • model_ms    duration of the shared forward pass
+#   • batch_size  number of crops in that forward pass
+# ────────────────────────────────────────────────────────────────────────────────
+class MicroBatcher:
+    def __init__(self, model_name: str, max_batch_size: int = 32, max_wait_ms: float = 5.0):
+        self.model_name = model_name
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.batches = 0
+        self.items = 0
+        self._recent = collections.deque(maxlen=1000)
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name=f"batcher-{model_name}", daemon=True
+        )
+        self._thread.start()
+
+    def embed(self, faces: list):
+        # Block until the crops have been embedded; returns (vectors, stats)
+        if not faces:
+            return np.zeros((0, 0), dtype=np.float32), {
+                "queue_ms": 0.0, "model_ms": 0.0, "batch_size": 0
+            }
+        future = Future()
+        self._queue.put((faces, future, time.perf_counter()))
+        return future.result()
+
+    def stats(self) -> dict:
+        with self._lock:
+            recent = list(self._recent)
+            summary = {
+                "model_name": self.model_name,
+                "batches": self.batches,
+                "items": self.items,
+                "mean_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            }
+        for field in ("queue_ms", "model_ms"):
+            values = [r[field] for r in recent]
+            if values:
+                summary[f"{field}_p50"] = round(float(np.percentile(values, 50)), 3)
+                summary[f"{field}_p95"] = round(float(np.percentile(values, 95)), 3)
+        return summary
+
+    def _run(self) -> None:
+        while True:
+            pending = [self._queue.get()]
+            count = len(pending[0][0])
+            deadline = time.perf_counter() + self.max_wait_ms / 1000.0
+            while count < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                pending.append(item)
+                count += len(item[0])
+            self._process(pending)
+
+    def _process(self, pending: list) -> None:
+        start = time.perf_counter()
+        faces = [face for item in pending for face in item[0]]
+        try:
+            vectors = embed_faces(faces, self.model_name)
+        except Exception as e:
+            for _, future, _ in pending:
+                future.set_exception(e)
+            return
+        model_ms = (time.perf_counter() - start) * 1000.0
+
+        offset = 0
+        with self._lock:
+            self.batches += 1
+            self.items += len(faces)
+            for item_faces, future, submitted in pending:
+                stats = {
+                    "queue_ms": round((start - submitted) * 1000.0, 3),
+                    "model_ms": round(model_ms, 3),
+                    "batch_size": len(faces),
+                }
+                self._recent.append(stats)
+                future.set_result((vectors[offset:offset + len(item_faces)], stats))
+                offset += len(item_faces)
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Class   : BatchingEmbedder
+# Purpose : Drop-in `embedder` for recognize_face / verify_faces. Detection
+#           and alignment run on the calling thread; the crops go through a
+#           per-model MicroBatcher. Latency records of the calls made on the
+#           current thread since begin_request() are kept for the server.
+# ────────────────────────────────────────────────────────────────────────────────
+class BatchingEmbedder:
+    def __init__(self, max_batch_size: int = 32, max_wait_ms: float = 5.0):
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._batchers = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __call__(
+        self,
+        img_path: str,
+        model_name: str,
+        detector_backend: str,
+        enforce_detection: bool = True
+    ) -> list:
+        start = time.perf_counter()
+        faces = _extract_faces(img_path, detector_backend, enforce_detection)
+        detect_ms = (time.perf_counter() - start) * 1000.0
+        vectors, stats = self._batcher(model_name).embed([f["face"] for f in faces])
+        getattr(self._local, "records", []).append(
+            dict(stats, detect_ms=round(detect_ms, 3))
+        )
+        # The forward pass ran on the batcher thread; book it here
+        timer = _current_timer.get()
+        if timer is not None:
+            timer.add_stage("embed_queue", stats["queue_ms"])
+            timer.add_stage("embed", stats["model_ms"])
+        return [
+            {
+                "embedding": vector,
+                "facial_area": face["facial_area"],
+                "face_confidence": face.get("confidence"),
+            }
+            for face, vector in zip(faces, vectors)
+        ]
+
+    def begin_request(self) -> None:
+        self._local.records = []
+
+    def request_stats(self) -> list:
+        return getattr(self._local, "records", [])
+
+    def stats(self) -> list:
+        with self._lock:
+            batchers = list(self._batchers.values())
+        return [b.stats() for b in batchers]
+
+    def _batcher(self, model_name: str) -> MicroBatcher:
+        with self._lock:
+            batcher = self._batchers.get(model_name)
+            if batcher is None:
+                batcher = MicroBatcher(model_name, self.max_batch_size, self.max_wait_ms)
+                self._batchers[model_name] = batcher
+            return batcher
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Server: long-running process that keeps DeepFace models warm
+#
+# Endpoints (JSON in, JSON out — same shapes the CLI prints):
+#   • GET  /health      {"status": "ok", "models": [...], "actions": [...]}
+#   • GET  /stats       micro-batching counters and latency percentiles
+#   • POST /recognize   keyword arguments of recognize_face()
+#   • POST /analyze     keyword arguments of analyze_face()
+#   • POST /verify      keyword arguments of verify_faces()
+# ────────────────────────────────────────────────────────────────────────────────
+SERVE_OPS = {
+    "recognize": recognize_face,
+    "analyze": analyze_face,
+    "verify": verify_faces,
+}
+# Arguments clients may not set: server-owned objects, a Python-only timer,
+# and output_json, which would let a client write files as the server
+_SERVER_ONLY_ARGS = {"cache", "embedder", "embedding_cache", "timings", "output_json"}
+
+
+def warm_models(model_names: list, actions: list) -> None:
+    # Load recognition and attribute models into DeepFace's in-process cache
+    for name in model_names:
+        DeepFace.build_model(name)
+    for action in actions:
+        _attribute_model(action)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    server_version = "FaceTool/1.0"
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/health":
+            self._reply(200, {
+                "status": "ok",
+                "models": self.server.warm_models,
+                "actions": self.server.warm_actions,
+            })
+        elif self.path.rstrip("/") == "/stats":
+            self._reply(200, {"batchers": self.server.embedder.stats()})
+        else:
+            self._reply(404, {"error": f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        op = self.path.strip("/")
+        func = SERVE_OPS.get(op)
+        if func is None:
+            self._reply(404, {"error": f"Unknown operation: {op}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            self._reply(400, {"error": f"Invalid JSON body: {e}"})
+            return
+        if not isinstance(body, dict):
+            self._reply(400, {"error": "Request body must be a JSON object"})
+            return
+
+        allowed = set(inspect.signature(func).parameters) - _SERVER_ONLY_ARGS
+        unknown = sorted(set(body) - allowed)
+        if unknown:
+            self._reply(400, {"error": f"Unknown arguments: {', '.join(unknown)}"})
+            return
+        if op == "recognize":
+            body["cache"] = self.server.gallery_cache
+        if op in ("recognize", "verify"):
+            body["embedder"] = self.server.embedder
+        self.server.embedder.begin_request()
+        try:
+            result = func(**body)
+        except TypeError as e:  # missing required arguments
+            self._reply(400, {"error": str(e)})
+            return
+        # Per-request batching latency goes into a response header so the
+        # JSON body keeps the CLI's shape
+        records = self.server.embedder.request_stats()
+        headers = {"X-Embed-Stats": json.dumps(records)} if records else {}
+        self._reply(200, result, headers)
+
+    def _reply(self, status: int, payload, headers: dict = None) -> None:
+        data = json.dumps(payload, ensure_ascii=False, default=_json_default).encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self) -> str:
+        # Unix-socket peers have no (host, port) address
+        return self.client_address[0] if self.client_address else "unix"
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Function: serve
+# Purpose : Load models once, then answer recognize / analyze / verify
+#           requests over HTTP on localhost or over a Unix socket.
+#
+# Arguments:
+#   • host, port       TCP address to bind (ignored when socket_path is set).
+#   • socket_path      Path of a Unix socket to listen on instead of TCP.
+#   • model_names      Recognition models to load up front.
+#   • actions          Attribute models to load up front (age, gender…).
+#   • db_paths         Gallery folders whose stores are loaded up front.
+#   • detector_backend Detector used when preloading db_paths.
+#   • rescan_s         Min seconds between gallery folder re-scans.
+#   • max_batch_size   Max face crops per batched forward pass.
+#   • max_wait_ms      Max time a crop waits for its batch to fill.
+# ────────────────────────────────────────────────────────────────────────────────
+def serve(
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    socket_path: str = None,
+    model_names: list = None,
+    actions: list = None,
+    db_paths: list = None,
+    detector_backend: str = "opencv",
+    rescan_s: float = 30.0,
+    max_batch_size: int = 32,
+    max_wait_ms: float = 5.0
+) -> None:
+    model_names = model_names if model_names is not None else ["VGG-Face", "ArcFace"]
+    actions = actions if actions is not None else ["age", "gender", "race", "emotion"]
+
+    start = time.perf_counter()
+    warm_models(model_names, actions)
+    cache = GalleryCache(rescan_s=rescan_s)
+    for db_path in db_paths or []:
+        for name in model_names:
+            cache.get(db_path, name, detector_backend)
+    print(f"[INFO] Models ready in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = _UnixHTTPServer(socket_path, _RequestHandler)
+        where = socket_path
+    else:
+        server = ThreadingHTTPServer((host, port), _RequestHandler)
+        where = f"http://{host}:{port}"
+    server.gallery_cache = cache
+    server.embedder = BatchingEmbedder(max_batch_size, max_wait_ms)
+    server.warm_models = model_names
+    server.warm_actions = actions
+    print(f"[INFO] Serving on {where}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Function: work
+# Purpose : Load models once, then answer newline-delimited JSON requests
+#           read from `stdin` with one JSON line each on `stdout`, in order,
+#           until end of input. Made for shell pipelines (xargs, GNU
+#           parallel, …) that would otherwise start a fresh process per item.
+#
+# Requests: {"op": "recognize" | "analyze" | "verify", "id": …, …} where the
+#           remaining keys are keyword arguments of recognize_face(),
+#           analyze_face() or verify_faces(), as for serve(). "id" is optional
+#           and echoed back. "timings": true adds the request's StageTimer
+#           report.
+# Replies : {"id": …, "result": …[, "timings": …]} or {"id": …, "error": "…"}.
+#           A bad request gets an error line; the worker keeps going.
+#
+# Arguments:
+#   • stdin, stdout    Text streams to read requests from / write replies to.
+#   • model_names      Recognition models to load up front.
+#   • actions          Attribute models to load up front (age, gender…).
+#   • db_paths         Gallery folders whose stores are loaded up front.
+#   • detector_backend Detector used when preloading db_paths.
+#   • rescan_s         Min seconds between gallery folder re-scans.
+#
+# Returns : A summary dict with request / error counts and throughput.
+# ────────────────────────────────────────────────────────────────────────────────
+def work(
+    stdin=None,
+    stdout=None,
+    model_names: list = None,
+    actions: list = None,
+    db_paths: list = None,
+    detector_backend: str = "opencv",
+    rescan_s: float = 30.0
+) -> dict:
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    model_names = model_names if model_names is not None else ["VGG-Face", "ArcFace"]
+    actions = actions if actions is not None else ["age", "gender", "race", "emotion"]
+
+    start = time.perf_counter()
+    warm_models(model_names, actions)
+    cache = GalleryCache(rescan_s=rescan_s)
+    for db_path in db_paths or []:
+        for name in model_names:
+            cache.get(db_path, name, detector_backend)
+    print(f"[INFO] Models ready in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    summary = {"requests": 0, "errors": 0}
+    start = time.perf_counter()
+    for line in stdin:
+        if not line.strip():
+            continue
+        summary["requests"] += 1
+        reply = _work_request(line, cache)
+        if "error" in reply:
+            summary["errors"] += 1
+        stdout.write(json.dumps(
+            reply, ensure_ascii=False, separators=(",", ":"), default=_json_default
+        ) + "\n")
+        stdout.flush()
+
+    elapsed = time.perf_counter() - start
+    summary["seconds"] = round(elapsed, 3)
+    summary["requests_per_s"] = round(summary["requests"] / elapsed, 2) if elapsed else 0.0
+    return summary
+
+
+def _work_request(line: str, cache: GalleryCache) -> dict:
+    # Answer one worker request line; never raises
     try:
-        # Call DeepFace.find() to compare the query face against your DB folder
-        result_df = DeepFace.find(
-            img_path=img_path,
-            db_path=db_path,
-            model_name=model_name,
-            detector_backend=detector_backend,
-            enforce_detection=enforce_detection
-        )
-        # Convert the resulting DataFrame of matches into a list of dicts
-        return result_df.to_dict(orient="records")
-    except Exception as e:
-        # Print any errors to stderr and return an empty list
-        print(f"[ERROR] Recognition failed: {e}", file=sys.stderr)
-        return []
+        request = json.loads(line)
+    except ValueError as e:
+        return {"id": None, "error": f"Invalid JSON: {e}"}
+    if not isinstance(request, dict):
+        return {"id": None, "error": "Request must be a JSON object"}
+    reply = {"id": request.pop("id", None)}
+    op = request.pop("op", None)
+    func = SERVE_OPS.get(op)
+    if func is None:
+        reply["error"] = f"Unknown operation: {op}"
+        return reply
+    timer = StageTimer() if request.pop("timings", False) else None
+
+    allowed = set(inspect.signature(func).parameters) - _SERVER_ONLY_ARGS
+    unknown = sorted(set(request) - allowed)
+    if unknown:
+        reply["error"] = f"Unknown arguments: {', '.join(unknown)}"
+        return reply
+    if op == "recognize":
+        request["cache"] = cache
+    try:
+        with _raising():
+            reply["result"] = func(timings=timer, **request)
+    except Exception as e:  # missing arguments, or the op itself failing
+        reply["error"] = str(e)
+        return reply
+    if timer is not None:
+        reply["timings"] = timer.as_dict()
+    return reply
 
 
 # ────────────────────────────────────────────────────────────────────────────────
-# Function: analyze_face
-# Purpose : Detect a face in an image and estimate attributes:
-#           age, gender, race composition, emotion scores.
+# Class   : AsyncFaceTool
+# Purpose : asyncio front end to recognize_face / analyze_face / verify_faces
+#           for services that already run an event loop. Calls run on a
+#           private thread pool, and at most max_workers of them run at once;
+#           the rest wait in the event loop, where cancelling them is free.
+#           Concurrent calls with identical arguments share one computation.
+#           Like serve(), the tool keeps one GalleryCache and one
+#           BatchingEmbedder, so concurrent calls pool their face crops into
+#           shared forward passes.
 #
 # Arguments:
-#   • img_path         Path to the image to analyze.
-#   • actions          List of analyses to run (["age","gender","race","emotion"]).
-#   • model_name       Embedding model (Facenet, VGG‑Face, ArcFace…).
-#   • detector_backend Face detector (mtcnn, opencv, dlib, retinaface).
-#   • enforce_detection If False, won’t error if no face found.
-#   • output_json      If provided, write a JSON report to this filepath.
+#   • max_workers      Max calls running at once (threads in the pool).
+#   • rescan_s         Min seconds between gallery folder re-scans.
+#   • max_batch_size   Max face crops per batched forward pass.
+#   • max_wait_ms      Max time a crop waits for its batch to fill.
 #
-# Returns : A dict containing requested attributes and their values.
+# Every coroutine takes the keyword arguments of its synchronous
+# counterpart, plus `timeout` (seconds, None = no limit), and raises
+# asyncio.TimeoutError when it expires. A timed-out or cancelled call
+# abandons the shared computation only if no other caller is waiting on
+# it. Work that has already started in a thread runs to completion, and
+# its result is discarded.
+#
+# Usage:
+#     async with AsyncFaceTool(max_workers=4) as tool:
+#         matches = await tool.recognize_face(img_path="a.jpg", db_path="db", timeout=5)
 # ────────────────────────────────────────────────────────────────────────────────
-def analyze_face(
-    img_path: str,
-    actions: list = None,
-    model_name: str = "Facenet",
-    detector_backend: str = "mtcnn",
-    enforce_detection: bool = True,
-    output_json: str = None
-) -> dict:
-    # Default to all four analyses if none specified
-    if actions is None:
-        actions = ["age", "gender", "race", "emotion"]
+class AsyncFaceTool:
+    def __init__(
+        self,
+        max_workers: int = 4,
+        rescan_s: float = 30.0,
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5.0
+    ):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.max_workers = max_workers
+        self.cache = GalleryCache(rescan_s=rescan_s)
+        self.embedder = BatchingEmbedder(max_batch_size, max_wait_ms)
+        self.coalesced = 0
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="facetool-async")
+        self._loop = None      # event loop the two fields below belong to
+        self._slots = None     # asyncio.Semaphore bounding running calls
+        self._inflight = {}    # coalescing key -> [task, waiters]
+
+    async def recognize_face(self, timeout: float = None, **kwargs) -> list:
+        kwargs.setdefault("cache", self.cache)
+        kwargs.setdefault("embedder", self.embedder)
+        return await self._call(recognize_face, kwargs, timeout)
 
+    async def analyze_face(self, timeout: float = None, **kwargs) -> dict:
+        return await self._call(analyze_face, kwargs, timeout)
+
+    async def verify_faces(self, timeout: float = None, **kwargs) -> dict:
+        kwargs.setdefault("embedder", self.embedder)
+        return await self._call(verify_faces, kwargs, timeout)
+
+    def close(self) -> None:
+        # Stop the pool, dropping calls that have not started
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    async def _call(self, func, kwargs: dict, timeout: float):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.max_workers)
+            self._inflight = {}
+        key = self._key(func, kwargs)
+        entry = self._inflight.get(key) if key is not None else None
+        if entry is None:
+            entry = [asyncio.ensure_future(self._run(func, kwargs)), 0]
+            if key is not None:
+                self._inflight[key] = entry
+                entry[0].add_done_callback(lambda _: self._forget(key, entry))
+        else:
+            self.coalesced += 1
+        entry[1] += 1
+        try:
+            # shield: one caller giving up must not cancel the others' result
+            return await asyncio.wait_for(asyncio.shield(entry[0]), timeout)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done():
+                entry[0].cancel()
+                self._forget(key, entry)
+
+    async def _run(self, func, kwargs: dict):
+        async with self._slots:
+            # copy_context: the caller's active StageTimer follows the call
+            ctx = contextvars.copy_context()
+            return await self._loop.run_in_executor(
+                self._executor, lambda: ctx.run(func, **kwargs)
+            )
+
+    def _key(self, func, kwargs: dict):
+        # Calls coalesce only when every argument is plain JSON data, plus
+        # this tool's own cache/embedder (a timer or an array opts out)
+        plain = {
+            name: value for name, value in kwargs.items()
+            if value is not self.cache and value is not self.embedder
+        }
+        try:
+            return func.__name__, json.dumps(plain, sort_keys=True)
+        except (TypeError, ValueError):
+            return None
+
+    def _forget(self, key, entry: list) -> None:
+        if key is not None and self._inflight.get(key) is entry:
+            del self._inflight[key]
+
+
+# ────────────────────────────────────────────────────────────────────────────────
+# Benchmark suite
+#
+# `bench` times recognize / analyze / verify on a synthetic (or supplied)
+# gallery for every model × backend combination, in two scenarios:
+#   • cold  a fresh `python systemImplementation.py <cmd>` process per run,
+#           so import and model loading are included
+#   • warm  repeated in-process calls after one warm-up call
+# Results (p50/p95/p99 latency, throughput, peak RSS, plus the memory saving
+# and recall loss of the quantized gallery indexes) are written as sorted
+# JSON so two runs can be diffed directly.
+# ────────────────────────────────────────────────────────────────────────────────
+BENCH_OPS = ("recognize", "analyze", "verify")
+
+
+def make_synthetic_gallery(out_dir: str, size: int, seed: int = 0, img_size: int = 160) -> list:
+    # Draw `size` simple cartoon faces (skin-tone ellipse, eyes, mouth on a
+    # random background) so the pipeline has deterministic input without
+    # shipping real photos. Existing files are reused.
+    import cv2
+
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(size):
+        params = rng.integers(0, 256, size=12)
+        path = os.path.join(out_dir, f"person_{i:06d}.jpg")
+        paths.append(path)
+        if os.path.exists(path):
+            continue
+        img = np.empty((img_size, img_size, 3), dtype=np.uint8)
+        img[:] = params[:3]
+        c = img_size // 2
+        skin = (int(60 + params[3] % 120), int(90 + params[4] % 120), int(140 + params[5] % 110))
+        cv2.ellipse(img, (c, c), (img_size // 3, int(img_size / 2.4)), 0, 0, 360, skin, -1)
+        eye_dy, eye_dx = img_size // 8, img_size // 7 + int(params[6] % 6)
+        for dx in (-eye_dx, eye_dx):
+            cv2.circle(img, (c + dx, c - eye_dy), img_size // 20, (40, 30, 20), -1)
+        mouth_w = img_size // 8 + int(params[7] % 10)
+        cv2.ellipse(img, (c, c + img_size // 5), (mouth_w, img_size // 25), 0, 0, 180, (60, 40, 150), -1)
+        cv2.imwrite(path, img)
+    return paths
+
+
+def _reset_peak_rss() -> bool:
+    # Restart this process's peak RSS (VmHWM) counter; Linux only
     try:
-        # Run DeepFace.analyze() to get attribute predictions
-        result = DeepFace.analyze(
-            img_path=img_path,
-            actions=actions,
-            model_name=model_name,
-            detector_backend=detector_backend,
-            enforce_detection=enforce_detection
-        )
-        # Optionally dump the result dict to a JSON file
-        if output_json:
-            with open(output_json, "w", encoding="utf-8") as fp:
-                json.dump(result, fp, indent=4, ensure_ascii=False)
-        return result
-    except Exception as e:
-        # Print any errors to stderr and return an empty dict
-        print(f"[ERROR] Analysis failed: {e}", file=sys.stderr)
-        return {}
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _proc_status_mb(field: str):
+    # VmRSS / VmHWM of this process in MiB, or None without /proc
+    try:
+        with open("/proc/self/status", encoding="utf-8") as fp:
+            for line in fp:
+                if line.startswith(field + ":"):
+                    return round(int(line.split()[1]) / 1024.0, 1)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+# Bootstrap for cold benchmark runs: runs the CLI and writes the child's own
+# peak RSS (VmHWM, KiB) to a file at exit. ru_maxrss from wait4() is no use
+# on Linux, where it starts from the RSS of the process that forked it.
+_COLD_BOOT = """
+import atexit, runpy, sys
+out = sys.argv.pop(1)
+def report():
+    try:
+        with open("/proc/self/status") as src, open(out, "w") as dst:
+            dst.write(next(l for l in src if l.startswith("VmHWM:")).split()[1])
+    except (OSError, StopIteration):
+        pass
+atexit.register(report)
+del sys.argv[0]
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+def _run_cold(script: str, argv: list) -> tuple:
+    # Run the CLI once in a fresh process and return (wall ms, that
+    # process's own peak RSS in MiB, or None without /proc). A non-zero exit
+    # or an [ERROR] line on stderr raises RuntimeError, so a crash is not
+    # timed as a cold start.
+    fd, peak_path = tempfile.mkstemp(prefix="facetool-rss-")
+    os.close(fd)
+    try:
+        with tempfile.TemporaryFile() as err:
+            start = time.perf_counter()
+            proc = subprocess.run(
+                [sys.executable, "-c", _COLD_BOOT, peak_path, script] + argv,
+                stdout=subprocess.DEVNULL,
+                stderr=err
+            )
+            elapsed_ms = (time.perf_counter() - start) * 1000.0
+            err.seek(0)
+            lines = err.read().decode("utf-8", "replace").splitlines()
+        with open(peak_path, encoding="utf-8") as fp:
+            peak_kib = fp.read()
+    finally:
+        os.remove(peak_path)
+    errors = [line for line in lines if line.startswith("[ERROR]")]
+    if proc.returncode or errors:
+        detail = "\n".join(errors or lines[-5:])
+        raise RuntimeError(f"Cold run failed (exit {proc.returncode}): {' '.join(argv)}\n{detail}")
+    return elapsed_ms, round(int(peak_kib) / 1024.0, 1) if peak_kib else None
+
+
+def _latency_summary(samples_ms: list) -> dict:
+    values = np.asarray(samples_ms, dtype=np.float64)
+    total_s = values.sum() / 1000.0
+    return {
+        "runs": int(len(values)),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "throughput_per_s": round(len(values) / total_s, 3) if total_s else 0.0,
+    }
 
 
 # ────────────────────────────────────────────────────────────────────────────────
-# Function: verify_faces
-# Purpose : Compare two face images and decide if they show the same person.
+# Function: bench
+# Purpose : Run the benchmark matrix and write the report.
 #
 # Arguments:
-#   • img1             First image filepath.
-#   • img2             Second image filepath.
-#   • model_name       Embedding model (ArcFace, Facenet, VGG‑Face…).
-#   • distance_metric  How to compute similarity (cosine, euclidean…).
-#   • detector_backend Face detector (dlib, mtcnn, opencv, retinaface).
-#   • enforce_detection If False, won’t error if no face found.
+#   • out_path         JSON report destination.
+#   • gallery_dir      Existing gallery to use; a synthetic one is generated
+#                      in a temp folder when None.
+#   • size             Number of synthetic gallery images.
+#   • model_names      Recognition models to benchmark.
+#   • backends         Detector backends to benchmark.
+#   • ops              Subset of recognize / analyze / verify.
+#   • warm_runs        In-process calls per combination (after one warm-up).
+#   • cold_runs        Fresh-process calls per combination.
+#   • seed             Seed for the synthetic gallery and probe choice.
 #
-# Returns : A dict with keys:
-#           – verified (bool)
-#           – distance (float)
-#           – threshold (float)
+# Returns : The report dict that was written.
 # ────────────────────────────────────────────────────────────────────────────────
-def verify_faces(
-    img1: str,
-    img2: str,
-    model_name: str = "ArcFace",
-    distance_metric: str = "cosine",
-    detector_backend: str = "dlib",
-    enforce_detection: bool = True
+def bench(
+    out_path: str,
+    gallery_dir: str = None,
+    size: int = 100,
+    model_names: list = None,
+    backends: list = None,
+    ops: list = None,
+    warm_runs: int = 20,
+    cold_runs: int = 3,
+    seed: int = 0
 ) -> dict:
+    model_names = model_names or ["VGG-Face"]
+    backends = backends or ["opencv"]
+    ops = ops or list(BENCH_OPS)
+
+    tmp_dir = None
+    if gallery_dir is None:
+        tmp_dir = tempfile.TemporaryDirectory(prefix="facetool-bench-")
+        gallery_dir = tmp_dir.name
+        make_synthetic_gallery(gallery_dir, size, seed)
+    gallery = [os.path.join(gallery_dir, rel) for rel in _list_images(gallery_dir)]
+    if len(gallery) < 2:
+        raise ValueError(f"Benchmark gallery needs at least 2 images: {gallery_dir}")
+    rng = np.random.default_rng(seed)
+    probes = [gallery[i] for i in rng.permutation(len(gallery))[:max(2, min(10, len(gallery)))]]
+    script = os.path.abspath(__file__)
+
+    def warm(call):
+        # Failed calls raise instead of returning an empty result. Peak RSS
+        # covers this combination only: the kernel's peak counter is reset
+        # after the warm-up, or RSS is sampled after every call where that
+        # is not allowed.
+        with _raising():
+            call(0)  # warm-up: model load, store build
+            reset = _reset_peak_rss()
+            samples, rss = [], []
+            for i in range(warm_runs):
+                start = time.perf_counter()
+                call(i)
+                samples.append((time.perf_counter() - start) * 1000.0)
+                if not reset:
+                    rss.append(_proc_status_mb("VmRSS"))
+        summary = _latency_summary(samples)
+        if reset:
+            summary["peak_rss_mb"] = _proc_status_mb("VmHWM")
+        else:
+            summary["peak_rss_mb"] = max(rss) if rss and None not in rss else None
+        return summary
+
+    def cold(argv):
+        samples, peaks = [], []
+        for _ in range(cold_runs):
+            elapsed_ms, peak = _run_cold(script, argv)
+            samples.append(elapsed_ms)
+            peaks.append(peak)
+        summary = _latency_summary(samples)
+        summary["peak_rss_mb"] = max(peaks) if None not in peaks else None
+        return summary
+
+    results, quantization = [], []
     try:
-        # Call DeepFace.verify() to compare embeddings of two images
-        result = DeepFace.verify(
-            img1_path=img1,
-            img2_path=img2,
-            model_name=model_name,
-            distance_metric=distance_metric,
-            detector_backend=detector_backend,
-            enforce_detection=enforce_detection
-        )
-        # Return only the keys you care about
-        return {
-            "verified": result.get("verified", False),
-            "distance": result.get("distance", None),
-            "threshold": result.get("threshold", None)
-        }
-    except Exception as e:
-        # Print any errors to stderr and return an empty dict
-        print(f"[ERROR] Verification failed: {e}", file=sys.stderr)
-        return {}
+        for backend in backends:
+            for model in model_names:
+                combos = []
+                if "recognize" in ops:
+                    start = time.perf_counter()
+                    store = open_store(gallery_dir, model, backend, enforce_detection=False)
+                    build_s = round(time.perf_counter() - start, 3)
+                    quantization.append(dict(
+                        quantization_report(store, seed=seed), model=model, backend=backend
+                    ))
+                    combos.append(("recognize", {"gallery_build_s": build_s},
+                        lambda i: recognize_face(
+                            probes[i % len(probes)], gallery_dir, model, backend,
+                            enforce_detection=False
+                        ),
+                        ["recognize", "--img", probes[0], "--db", gallery_dir,
+                         "--model", model, "--backend", backend, "--no-enforce"]))
+                if "verify" in ops:
+                    combos.append(("verify", {},
+                        lambda i: verify_faces(
+                            probes[i % len(probes)], probes[(i + 1) % len(probes)],
+                            model, detector_backend=backend, enforce_detection=False
+                        ),
+                        ["verify", "--img1", probes[0], "--img2", probes[1],
+                         "--model", model, "--backend", backend, "--no-enforce"]))
+                for op, extra, call, argv in combos:
+                    for scenario, runner in (("warm", lambda: warm(call)), ("cold", lambda: cold(argv))):
+                        if scenario == "cold" and not cold_runs:
+                            continue
+                        results.append(dict(
+                            runner(), op=op, model=model, backend=backend,
+                            scenario=scenario, **extra
+                        ))
+
+            # Attribute models do not depend on the recognition model
+            if "analyze" in ops:
+                call = lambda i: analyze_face(
+                    probes[i % len(probes)], detector_backend=backend, enforce_detection=False
+                )
+                argv = ["analyze", "--img", probes[0], "--backend", backend, "--no-enforce"]
+                results.append(dict(
+                    warm(call), op="analyze", model=None, backend=backend, scenario="warm"
+                ))
+                if cold_runs:
+                    results.append(dict(
+                        cold(argv), op="analyze", model=None, backend=backend, scenario="cold"
+                    ))
+    finally:
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+
+    report = {
+        "config": {
+            "gallery_size": len(gallery),
+            "synthetic": tmp_dir is not None,
+            "models": model_names,
+            "backends": backends,
+            "ops": ops,
+            "warm_runs": warm_runs,
+            "cold_runs": cold_runs,
+            "seed": seed,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+        "quantization": quantization,
+    }
+    with open(out_path, "w", encoding="utf-8") as fp:
+        json.dump(report, fp, indent=2, sort_keys=True)
+    return report
+
+
+def profile_startup(model_names: list, actions: list) -> dict:
+    # Time the deepface/TensorFlow import and each model load up front, so
+    # the numbers are not mixed into the first request's latency
+    start = time.perf_counter()
+    DeepFace.build_model  # attribute access triggers the lazy import
+    loads = {}
+    for name in model_names:
+        t0 = time.perf_counter()
+        DeepFace.build_model(name)
+        loads[name] = round(time.perf_counter() - t0, 3)
+    for action in actions:
+        t0 = time.perf_counter()
+        _attribute_model(action)
+        loads[action.capitalize()] = round(time.perf_counter() - t0, 3)
+    return {
+        "deepface_import_s": STARTUP_PROFILE.get("deepface_import_s", 0.0),
+        "model_load_s": loads,
+        "total_s": round(time.perf_counter() - start, 3),
+    }
+
+
+def _add_timing_args(sub: argparse.ArgumentParser) -> None:
+    # --timings / --prometheus, shared by recognize, analyze and verify
+    sub.add_argument(
+        "--timings",
+        action="store_true",
+        help="Wrap output as {result, timings} with per-stage timings"
+    )
+    sub.add_argument(
+        "--prometheus", help="Also write the timings in Prometheus text format here"
+    )
+
+
+def _embedding_cache_arg(args):
+    # EmbeddingCache selected by verify's --embed-cache-* flags (False = off)
+    if args.no_embed_cache:
+        return False
+    return EmbeddingCache(args.embed_cache_dir, int(args.embed_cache_mb * 1024 * 1024))
+
+
+def _emit(args, result, timer: StageTimer) -> None:
+    # Print a command's JSON result, adding the timings block if requested
+    if args.prometheus:
+        timer.write_prometheus(args.prometheus, args.command)
+    if args.timings:
+        result = {"result": result, "timings": timer.as_dict()}
+    print(json.dumps(result, indent=2, ensure_ascii=False, default=_json_default))
 
 
 def main():
@@ -141,6 +4812,28 @@ def main():
     parser = argparse.ArgumentParser(
         description="Face Recognition / Analysis CLI using DeepFace"
     )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="Report deepface import and model load times to stderr"
+    )
+    parser.add_argument(
+        "--detect-side",
+        type=int,
+        help="Decode JPEGs at reduced size, longer side >= this, for detection "
+             "(same as FACETOOL_DETECT_SIDE)"
+    )
+    parser.add_argument(
+        "--no-crop-cache",
+        action="store_true",
+        help="Do not reuse cached face detections (same as FACETOOL_CROP_CACHE=0)"
+    )
+    parser.add_argument(
+        "--cache-probe-crops",
+        action="store_true",
+        help="Cache face detections of probe images too, not only gallery "
+             "images (same as FACETOOL_CROP_CACHE=all)"
+    )
     # Create sub-command parsers: recognize, analyze, verify
     subparsers = parser.add_subparsers(dest="command", required=True)
 
@@ -148,10 +4841,49 @@ def main():
     p_rec = subparsers.add_parser(
         "recognize", help="Find a face in a DB folder"
     )
-    p_rec.add_argument("--img", required=True, help="Path to input image")
+    p_rec_src = p_rec.add_mutually_exclusive_group(required=True)
+    p_rec_src.add_argument("--img", help="Path to input image")
+    p_rec_src.add_argument(
+        "--img-list", help="Text file with one probe image path per line (JSONL output)"
+    )
+    p_rec_src.add_argument(
+        "--video", help="Video file; time-stamped matches are written as JSONL"
+    )
     p_rec.add_argument("--db", required=True, help="Path to face database folder")
     p_rec.add_argument("--model", default="VGG-Face", help="Embedding model")
     p_rec.add_argument("--backend", default="opencv", help="Detector backend")
+    p_rec.add_argument("--metric", default="cosine", help="Distance metric")
+    p_rec.add_argument(
+        "--top-k", type=int, default=None, help="Max matches per query face"
+    )
+    p_rec.add_argument(
+        "--index", choices=INDEX_KINDS, default="exact", help="Gallery search backend"
+    )
+    p_rec.add_argument(
+        "--ef", type=int, default=None, help="HNSW search candidate list size"
+    )
+    p_rec.add_argument(
+        "--rerank", type=int, default=None,
+        help="int8/float16/pq shortlist size re-ranked in float32 (pq: 0 = none)"
+    )
+    p_rec.add_argument(
+        "--batch-size", type=int, default=None,
+        help="Face crops per model call with --img-list (64) / --video (32)"
+    )
+    p_rec.add_argument(
+        "--fps", type=float, default=2.0,
+        help="Video frames per second to analyse with --video (0 = every frame)"
+    )
+    p_rec.add_argument("--out", help="JSONL output file for --video (default stdout)")
+    p_rec.add_argument(
+        "--reembed-every", type=int, default=10,
+        help="With --video, re-embed a tracked face every K sampled frames"
+    )
+    p_rec.add_argument(
+        "--no-track", action="store_false", dest="track",
+        help="With --video, embed every detected face instead of tracking"
+    )
+    _add_timing_args(p_rec)
     p_rec.add_argument(
         "--no-enforce",
         action="store_false",
@@ -163,7 +4895,20 @@ def main():
     p_an = subparsers.add_parser(
         "analyze", help="Analyze face attributes"
     )
-    p_an.add_argument("--img", required=True, help="Path to input image")
+    p_an.add_argument("--img", help="Path to input image")
+    p_an.add_argument("--input-dir", help="Analyze every image in this folder")
+    p_an.add_argument("--input-list", help="Text file with one image path per line")
+    p_an.add_argument(
+        "--workers", type=int, default=1, help="Worker processes for batch mode"
+    )
+    p_an.add_argument(
+        "--batch-size", type=int, default=16, help="Images per batched model call"
+    )
+    p_an.add_argument(
+        "--resume",
+        action="store_true",
+        help="Batch mode: append to --out, skipping images already in it"
+    )
     p_an.add_argument(
         "--actions",
         nargs="+",
@@ -178,14 +4923,36 @@ def main():
         dest="enforce_detection",
         help="Skip enforcing face detection"
     )
-    p_an.add_argument("--out", help="Path to dump JSON output")
+    p_an.add_argument(
+        "--out", help="Path to dump JSON output (JSONL in batch mode)"
+    )
+    _add_timing_args(p_an)
 
     # ─── verify sub-command ─────────────────────────────────────────────────────
     p_ver = subparsers.add_parser(
-        "verify", help="Verify two face images"
+        "verify", help="Verify two face images (or a CSV of pairs)"
+    )
+    p_ver.add_argument("--img1", help="First face image")
+    p_ver.add_argument("--img2", help="Second face image")
+    p_ver.add_argument("--pairs", help="CSV of img1,img2 pairs to verify in bulk")
+    p_ver.add_argument("--out", help="JSONL output path for --pairs (default stdout)")
+    p_ver.add_argument(
+        "--cache-size",
+        type=int,
+        default=100000,
+        help="Max images whose embeddings are kept in memory for --pairs"
+    )
+    p_ver.add_argument(
+        "--embed-cache-dir",
+        help="On-disk embedding cache (default $FACETOOL_CACHE_DIR/embeddings)"
+    )
+    p_ver.add_argument(
+        "--embed-cache-mb", type=float, default=512.0, help="On-disk embedding cache size"
+    )
+    p_ver.add_argument(
+        "--no-embed-cache", action="store_true", help="Do not use the on-disk embedding cache"
     )
-    p_ver.add_argument("--img1", required=True, help="First face image")
-    p_ver.add_argument("--img2", required=True, help="Second face image")
+    _add_timing_args(p_ver)
     p_ver.add_argument("--model", default="ArcFace", help="Embedding model")
     p_ver.add_argument("--metric", default="cosine", help="Distance metric")
     p_ver.add_argument("--backend", default="dlib", help="Detector backend")
@@ -196,40 +4963,386 @@ def main():
         help="Skip enforcing face detection"
     )
 
+    # ─── bench sub-command ──────────────────────────────────────────────────────
+    p_bench = subparsers.add_parser(
+        "bench", help="Benchmark recognize / analyze / verify"
+    )
+    p_bench.add_argument("--out", default="bench.json", help="JSON report path")
+    p_bench.add_argument("--gallery", help="Use this gallery instead of a synthetic one")
+    p_bench.add_argument("--size", type=int, default=100, help="Synthetic gallery size")
+    p_bench.add_argument(
+        "--models", nargs="+", default=["VGG-Face"], help="Recognition models"
+    )
+    p_bench.add_argument(
+        "--backends", nargs="+", default=["opencv"], help="Detector backends"
+    )
+    p_bench.add_argument(
+        "--ops", nargs="+", choices=BENCH_OPS, default=list(BENCH_OPS),
+        help="Operations to benchmark"
+    )
+    p_bench.add_argument("--warm-runs", type=int, default=20, help="In-process runs")
+    p_bench.add_argument("--cold-runs", type=int, default=3, help="Fresh-process runs")
+    p_bench.add_argument("--seed", type=int, default=0, help="Random seed")
+
+    # ─── index sub-command ──────────────────────────────────────────────────────
+    p_idx = subparsers.add_parser(
+        "index", help="Manage gallery search indexes"
+    )
+    idx_sub = p_idx.add_subparsers(dest="index_command", required=True)
+    p_rep = idx_sub.add_parser(
+        "report", help="Recall vs latency of HNSW against exact search"
+    )
+    p_rep.add_argument("--db", required=True, help="Path to face database folder")
+    p_rep.add_argument("--model", default="VGG-Face", help="Embedding model")
+    p_rep.add_argument("--backend", default="opencv", help="Detector backend")
+    p_rep.add_argument("--metric", default="cosine", help="Distance metric")
+    p_rep.add_argument(
+        "--ef", type=int, nargs="+", default=[16, 32, 64, 128, 256],
+        help="HNSW ef values to sweep"
+    )
+    p_rep.add_argument("--queries", type=int, default=200, help="Number of queries")
+    p_rep.add_argument("--top-k", type=int, default=10, help="Recall@k cutoff")
+    p_rep.add_argument(
+        "--no-enforce",
+        action="store_false",
+        dest="enforce_detection",
+        help="Report on the store built without enforcing face detection"
+    )
+
+    p_bld = idx_sub.add_parser(
+        "build", help="Embed a gallery up front using several processes"
+    )
+    p_bld.add_argument("--db", required=True, help="Path to face database folder")
+    p_bld.add_argument("--model", default="VGG-Face", help="Embedding model")
+    p_bld.add_argument("--backend", default="opencv", help="Detector backend")
+    p_bld.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1, help="Worker processes"
+    )
+    p_bld.add_argument(
+        "--index", choices=INDEX_KINDS, default="exact",
+        help="Also build this search index after embedding"
+    )
+    p_bld.add_argument("--metric", default="cosine", help="Distance metric for --index")
+    p_bld.add_argument(
+        "--no-enforce",
+        action="store_false",
+        dest="enforce_detection",
+        help="Skip enforcing face detection"
+    )
+
+    # ─── serve sub-command ──────────────────────────────────────────────────────
+    p_srv = subparsers.add_parser(
+        "serve", help="Keep models loaded and answer requests over HTTP"
+    )
+    p_srv.add_argument("--host", default="127.0.0.1", help="Address to bind")
+    p_srv.add_argument("--port", type=int, default=8765, help="Port to bind")
+    p_srv.add_argument("--socket", help="Listen on this Unix socket instead of TCP")
+    p_srv.add_argument(
+        "--models",
+        nargs="+",
+        default=["VGG-Face", "ArcFace"],
+        help="Recognition models to preload"
+    )
+    p_srv.add_argument(
+        "--actions",
+        nargs="*",
+        default=["age", "gender", "race", "emotion"],
+        help="Attribute models to preload"
+    )
+    p_srv.add_argument("--db", nargs="*", default=[], help="Galleries to preload")
+    p_srv.add_argument("--backend", default="opencv", help="Detector backend for --db")
+    p_srv.add_argument(
+        "--rescan", type=float, default=30.0, help="Seconds between gallery re-scans"
+    )
+    p_srv.add_argument(
+        "--max-batch", type=int, default=32, help="Max face crops per model call"
+    )
+    p_srv.add_argument(
+        "--max-wait-ms", type=float, default=5.0, help="Max wait for a batch to fill"
+    )
+
+    # ─── worker sub-command ─────────────────────────────────────────────────────
+    p_wrk = subparsers.add_parser(
+        "worker", help="Keep models loaded and answer JSON lines from stdin"
+    )
+    p_wrk.add_argument(
+        "--models",
+        nargs="+",
+        default=["VGG-Face", "ArcFace"],
+        help="Recognition models to preload"
+    )
+    p_wrk.add_argument(
+        "--actions",
+        nargs="*",
+        default=["age", "gender", "race", "emotion"],
+        help="Attribute models to preload"
+    )
+    p_wrk.add_argument("--db", nargs="*", default=[], help="Galleries to preload")
+    p_wrk.add_argument("--backend", default="opencv", help="Detector backend for --db")
+    p_wrk.add_argument(
+        "--rescan", type=float, default=30.0, help="Seconds between gallery re-scans"
+    )
+
+    # ─── enroll / unenroll sub-commands ─────────────────────────────────────────
+    p_enr = subparsers.add_parser(
+        "enroll", help="Add images of one identity to a gallery in place"
+    )
+    p_enr.add_argument("--id", required=True, help="Identity (sub-folder) name")
+    p_enr.add_argument("--img", nargs="+", required=True, help="Images of this person")
+    p_enr.add_argument("--db", required=True, help="Path to face database folder")
+    p_enr.add_argument("--model", default="VGG-Face", help="Embedding model")
+    p_enr.add_argument("--backend", default="opencv", help="Detector backend")
+    p_enr.add_argument(
+        "--no-enforce",
+        action="store_false",
+        dest="enforce_detection",
+        help="Skip enforcing face detection"
+    )
+
+    p_unr = subparsers.add_parser(
+        "unenroll", help="Remove one identity from a gallery in place"
+    )
+    p_unr.add_argument("--id", required=True, help="Identity (sub-folder) name")
+    p_unr.add_argument("--db", required=True, help="Path to face database folder")
+
     # Parse arguments and dispatch to the chosen function
     args = parser.parse_args()
+    if getattr(args, "rerank", None) is not None and args.rerank < 1 and args.index in QuantizedIndex.DTYPES:
+        parser.error(f"--index {args.index} needs --rerank >= 1 (0 is only valid with pq)")
+    # Via the environment so spawned gallery workers see these too
+    if args.no_crop_cache:
+        os.environ["FACETOOL_CROP_CACHE"] = "0"
+    elif args.cache_probe_crops:
+        os.environ["FACETOOL_CROP_CACHE"] = "all"
+    if args.detect_side is not None:
+        os.environ["FACETOOL_DETECT_SIDE"] = str(args.detect_side)
+
+    if args.profile_startup:
+        # Load exactly what the chosen sub-command is about to use
+        if args.command in ("recognize", "verify", "enroll"):
+            needed = ([args.model], [])
+        elif args.command == "analyze":
+            needed = ([], args.actions)
+        elif args.command in ("serve", "worker"):
+            needed = (args.models, args.actions)
+        elif args.command == "bench":
+            needed = (args.models, ["age", "gender", "race", "emotion"])
+        else:
+            needed = ([], [])
+        report = profile_startup(*needed)
+        print(json.dumps({"startup": report}), file=sys.stderr)
+
+    # Timer shared by the single-image recognize / analyze / verify paths
+    timer = StageTimer()
+
+    if args.command == "recognize" and args.img_list:
+        probes = list(iter_image_paths(input_list=args.img_list))
+        results = recognize_faces(
+            img_paths=probes,
+            db_path=args.db,
+            model_name=args.model,
+            detector_backend=args.backend,
+            enforce_detection=args.enforce_detection,
+            distance_metric=args.metric,
+            top_k=args.top_k,
+            index=args.index,
+            ef=args.ef,
+            rerank=args.rerank,
+            batch_size=args.batch_size or 64,
+            timings=timer
+        )
+        for path, hits in zip(probes, results):
+            print(json.dumps({"img": path, "matches": hits}, ensure_ascii=False))
+        summary = {"probes": len(probes), "matched": sum(1 for hits in results if hits)}
+        if args.timings:
+            summary["timings"] = timer.as_dict()
+        if args.prometheus:
+            timer.write_prometheus(args.prometheus, args.command)
+        print(json.dumps(summary, ensure_ascii=False), file=sys.stderr)
+
+    elif args.command == "recognize" and args.video:
+        summary = recognize_video(
+            video_path=args.video,
+            db_path=args.db,
+            out_path=args.out,
+            model_name=args.model,
+            detector_backend=args.backend,
+            distance_metric=args.metric,
+            top_k=args.top_k,
+            index=args.index,
+            ef=args.ef,
+            rerank=args.rerank,
+            enforce_detection=args.enforce_detection,
+            sample_fps=args.fps or None,
+            batch_size=args.batch_size or 32,
+            track=args.track,
+            reembed_every=args.reembed_every,
+            timings=timer
+        )
+        if args.timings:
+            summary["timings"] = timer.as_dict()
+        if args.prometheus:
+            timer.write_prometheus(args.prometheus, args.command)
+        print(json.dumps(summary, ensure_ascii=False), file=sys.stderr)
 
-    if args.command == "recognize":
+    elif args.command == "recognize":
         hits = recognize_face(
             img_path=args.img,
             db_path=args.db,
             model_name=args.model,
             detector_backend=args.backend,
-            enforce_detection=args.enforce_detection
+            enforce_detection=args.enforce_detection,
+            distance_metric=args.metric,
+            top_k=args.top_k,
+            index=args.index,
+            ef=args.ef,
+            rerank=args.rerank,
+            timings=timer
+        )
+        _emit(args, hits, timer)
+
+    elif args.command == "analyze" and (args.input_dir or args.input_list):
+        summary = analyze_batch(
+            iter_image_paths(args.input_dir, args.input_list),
+            out_path=args.out,
+            actions=args.actions,
+            model_name=args.model,
+            detector_backend=args.backend,
+            enforce_detection=args.enforce_detection,
+            workers=args.workers,
+            resume=args.resume,
+            batch_size=args.batch_size
         )
-        print(json.dumps(hits, indent=2, ensure_ascii=False))
+        if args.prometheus:
+            timer.merge(summary["timings"])
+            timer.write_prometheus(args.prometheus, args.command)
+        print(json.dumps(summary, ensure_ascii=False), file=sys.stderr)
 
     elif args.command == "analyze":
+        if not args.img:
+            parser.error("analyze requires --img, --input-dir or --input-list")
         info = analyze_face(
             img_path=args.img,
             actions=args.actions,
             model_name=args.model,
             detector_backend=args.backend,
             enforce_detection=args.enforce_detection,
-            output_json=args.out
+            output_json=args.out,
+            timings=timer
         )
-        print(json.dumps(info, indent=2, ensure_ascii=False))
+        _emit(args, info, timer)
+
+    elif args.command == "verify" and args.pairs:
+        embedding_cache = _embedding_cache_arg(args)
+        with _use_timer(timer):
+            summary = verify_pairs(
+                pairs_path=args.pairs,
+                out_path=args.out,
+                model_name=args.model,
+                distance_metric=args.metric,
+                detector_backend=args.backend,
+                enforce_detection=args.enforce_detection,
+                cache_size=args.cache_size,
+                embedding_cache=embedding_cache
+            )
+        if args.timings:
+            summary["timings"] = timer.as_dict()
+        if args.prometheus:
+            timer.write_prometheus(args.prometheus, args.command)
+        print(json.dumps(summary, ensure_ascii=False), file=sys.stderr)
 
     elif args.command == "verify":
+        if not (args.img1 and args.img2):
+            parser.error("verify requires --img1 and --img2, or --pairs")
         verdict = verify_faces(
             img1=args.img1,
             img2=args.img2,
             model_name=args.model,
             distance_metric=args.metric,
             detector_backend=args.backend,
+            enforce_detection=args.enforce_detection,
+            embedding_cache=_embedding_cache_arg(args),
+            timings=timer
+        )
+        _emit(args, verdict, timer)
+
+    elif args.command == "serve":
+        serve(
+            host=args.host,
+            port=args.port,
+            socket_path=args.socket,
+            model_names=args.models,
+            actions=args.actions,
+            db_paths=args.db,
+            detector_backend=args.backend,
+            rescan_s=args.rescan,
+            max_batch_size=args.max_batch,
+            max_wait_ms=args.max_wait_ms
+        )
+
+    elif args.command == "worker":
+        summary = work(
+            model_names=args.models,
+            actions=args.actions,
+            db_paths=args.db,
+            detector_backend=args.backend,
+            rescan_s=args.rescan
+        )
+        print(json.dumps(summary, ensure_ascii=False), file=sys.stderr)
+
+    elif args.command == "bench":
+        report = bench(
+            out_path=args.out,
+            gallery_dir=args.gallery,
+            size=args.size,
+            model_names=args.models,
+            backends=args.backends,
+            ops=args.ops,
+            warm_runs=args.warm_runs,
+            cold_runs=args.cold_runs,
+            seed=args.seed
+        )
+        print(json.dumps(report["results"], indent=2, ensure_ascii=False))
+
+    elif args.command == "index" and args.index_command == "build":
+        report = build_store(
+            db_path=args.db,
+            model_name=args.model,
+            detector_backend=args.backend,
+            enforce_detection=args.enforce_detection,
+            workers=args.workers,
+            index=args.index,
+            distance_metric=args.metric
+        )
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+
+    elif args.command == "index" and args.index_command == "report":
+        report = index_report(
+            db_path=args.db,
+            model_name=args.model,
+            detector_backend=args.backend,
+            distance_metric=args.metric,
+            ef_values=args.ef,
+            n_queries=args.queries,
+            top_k=args.top_k,
+            enforce_detection=args.enforce_detection
+        )
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+
+    elif args.command == "enroll":
+        report = enroll_face(
+            identity=args.id,
+            img_paths=args.img,
+            db_path=args.db,
+            model_name=args.model,
+            detector_backend=args.backend,
             enforce_detection=args.enforce_detection
         )
-        print(json.dumps(verdict, indent=2, ensure_ascii=False))
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+
+    elif args.command == "unenroll":
+        report = unenroll_face(identity=args.id, db_path=args.db)
+        print(json.dumps(report, indent=2, ensure_ascii=False))
 
 
 if __name__ == "__main__":
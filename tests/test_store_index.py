@@ -0,0 +1,219 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import systemImplementation as si  # noqa: E402
+
+DIM = 32
+
+
+def _entry(i: int, faces: int = 1) -> dict:
+    area = {"x": i, "y": i + 1, "w": 40, "h": 40}
+    return {"hash": f"{i:040x}", "size": 1, "mtime_ns": 1, "faces": [area] * faces}
+
+
+def _vectors(rng, n: int) -> np.ndarray:
+    return rng.standard_normal((n, DIM)).astype(np.float32)
+
+
+@pytest.fixture
+def store(tmp_path):
+    # A checkpointed gallery of 50 single-face files, seeded without DeepFace
+    rng = np.random.default_rng(0)
+    st = si.EmbeddingStore(str(tmp_path), "VGG-Face", "opencv")
+    st.files = {f"p{i:03d}.png": _entry(i) for i in range(50)}
+    st._vectors = {rel: _vectors(rng, 1) for rel in st.files}
+    st._rebuild()
+    st.save()
+    return st
+
+
+def _reopen(st: si.EmbeddingStore) -> si.EmbeddingStore:
+    other = si.EmbeddingStore(st.db_path, st.model_name, st.detector_backend)
+    other.load()
+    return other
+
+
+def _enroll(st: si.EmbeddingStore, vecs: np.ndarray, first: int = 100) -> list:
+    rels = [f"alice/a{i}.png" for i in range(len(vecs))]
+    st.append({
+        rel: (_entry(first + i), vecs[i:i + 1]) for i, rel in enumerate(rels)
+    })
+    return rels
+
+
+def _recall(found: np.ndarray, truth: np.ndarray) -> float:
+    return np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)])
+
+
+# ─── EmbeddingStore ──────────────────────────────────────────────────────────
+def test_enroll_is_replayed_by_another_store(store):
+    vecs = _vectors(np.random.default_rng(1), 3)
+    rels = _enroll(store, vecs)
+
+    other = _reopen(store)
+    assert len(other.identities) == 53
+    assert other.fingerprint() == store.fingerprint()
+    np.testing.assert_array_equal(other.embeddings[50:], vecs)
+    assert other.identities[51] == os.path.join(store.db_path, rels[1])
+    assert other.facial_areas[51] == {"x": 101, "y": 102, "w": 40, "h": 40}
+
+    dists, rows = si.load_index(other, "cosine", "exact").search(vecs[1], 1)
+    assert rows[0, 0] == 51
+    assert dists[0, 0] == pytest.approx(0.0, abs=1e-5)
+
+
+def test_torn_wal_tail_is_ignored(store):
+    _enroll(store, _vectors(np.random.default_rng(1), 3))
+    with open(store.wal_path, "a") as fp:
+        fp.write('{"seq": 2, "base": "')
+
+    other = _reopen(store)
+    assert len(other.identities) == 53
+    assert other.wal_seq == 1
+
+    # The next commit cuts the torn tail off before appending
+    other.append({"bob/b0.png": (_entry(200), _vectors(np.random.default_rng(2), 1))})
+    assert len(_reopen(store).identities) == 54
+
+
+def test_unenroll_over_fetches_past_dead_rows(store):
+    rng = np.random.default_rng(1)
+    base = _vectors(rng, 1)
+    # Three near-duplicates of the query, all closer than any other row
+    vecs = base + 0.01 * _vectors(rng, 3)
+    rels = _enroll(store, vecs)
+    assert store.remove(rels) == 3
+
+    other = _reopen(store)
+    assert other.dead_rows == 3
+    assert all(other.identities[row] is None for row in range(50, 53))
+
+    top_k = 2
+    fetch = top_k + other.dead_rows
+    dists, rows = si.ExactIndex(other.embeddings, "cosine", other.norms).search(base, fetch)
+    source = {"x": 0, "y": 0, "w": 40, "h": 40}
+    hits = si._gallery_hits(other, source, dists[0], rows[0], np.inf, top_k)
+    assert len(hits) == top_k
+    assert all(not hit["identity"].startswith(os.path.join(store.db_path, "alice")) for hit in hits)
+
+    # Without the over-fetch the dead rows fill the whole result
+    dists, rows = si.ExactIndex(other.embeddings, "cosine", other.norms).search(base, top_k)
+    assert si._gallery_hits(other, source, dists[0], rows[0], np.inf, top_k) == []
+
+
+def test_reader_never_mixes_checkpoint_generations(store, monkeypatch):
+    # Replace p000 by q000: same row count, every row shifts by one
+    rng = np.random.default_rng(4)
+    files = dict(store.files)
+    del files["p000.png"]
+    files["q000.png"] = _entry(999)
+    store.files = files
+    store._vectors = {rel: np.asarray(store._vectors.get(rel, _vectors(rng, 1))) for rel in files}
+    expected = {rel: vec[0].copy() for rel, vec in store._vectors.items()}
+    old = _reopen(store)
+    before = {rel: old.embeddings[row].copy() for row, rel in enumerate(sorted(old.files))}
+
+    seen = []
+    replace = os.replace
+
+    def commit(src, dst):
+        if os.path.basename(dst) == "meta.json":
+            seen.append(_reopen(store))  # all new data written, not committed
+        replace(src, dst)
+
+    monkeypatch.setattr(si.os, "replace", commit)
+    store._rebuild()
+    store.save()
+    monkeypatch.undo()
+    seen.append(_reopen(store))
+
+    for reader, vectors in zip(seen, (before, expected)):
+        assert len(reader.identities) == 50
+        for row in range(50):
+            rel = os.path.relpath(reader.identities[row], store.db_path)
+            np.testing.assert_array_equal(reader.embeddings[row], vectors[rel])
+    # A store opened before the checkpoint keeps its own mapping
+    np.testing.assert_array_equal(old.embeddings[0], before["p000.png"])
+
+
+def test_checkpoint_removes_older_generations(store):
+    store._rebuild()
+    store.save()
+    names = sorted(os.listdir(store.store_dir))
+    assert [n for n in names if n.startswith("embeddings.")] == ["embeddings.2.npy"]
+    assert "files.2.json" in names and "files.1.json" not in names
+
+
+# ─── search indexes ──────────────────────────────────────────────────────────
+@pytest.mark.parametrize("kind", ["int8", "float16", "pq"])
+def test_index_load_keeps_codes_mapped(store, kind):
+    si.load_index(store, "cosine", kind)
+    index = si.load_index(_reopen(store), "cosine", kind)
+    assert isinstance(index.codes, np.memmap)
+    assert not index.codes.flags.writeable
+
+
+INDEXES = {
+    "hnsw": lambda x: si.HNSWIndex(x, "cosine", ef_construction=64),
+    "int8": lambda x: si.QuantizedIndex(x, "cosine", "int8"),
+    "pq": lambda x: si.PQIndex(x, "cosine"),
+}
+
+
+@pytest.fixture(scope="module")
+def gallery():
+    # Clustered data, so nearest neighbours are meaningful
+    rng = np.random.default_rng(3)
+    centres = rng.standard_normal((20, DIM)).astype(np.float32)
+    x = centres[rng.integers(0, 20, 600)] + 0.3 * _vectors(rng, 600)
+    queries = centres[rng.integers(0, 20, 50)] + 0.3 * _vectors(rng, 50)
+    truth = si.ExactIndex(x, "cosine").search(queries, 10)[1]
+    return x, queries, truth
+
+
+@pytest.mark.parametrize("kind", sorted(INDEXES))
+def test_index_recall_against_exact(gallery, kind):
+    x, queries, truth = gallery
+    index = INDEXES[kind](x).build()
+    assert _recall(index.search(queries, 10)[1], truth) >= 0.9
+
+
+@pytest.mark.parametrize("kind", sorted(INDEXES))
+def test_index_save_load_extends_appended_rows(gallery, tmp_path, kind):
+    x, queries, truth = gallery
+    path = str(tmp_path / ("index.npz" if kind == "hnsw" else "index"))
+    INDEXES[kind](x[:450]).build().save(path, "fp")
+
+    cls = type(INDEXES[kind](x[:1]))
+    assert cls.load(path, x, fingerprint="other") is None
+    index = cls.load(path, x, fingerprint="fp")
+    assert len(index) == len(x)
+    assert _recall(index.search(queries, 10)[1], truth) >= 0.9
+
+
+@pytest.mark.parametrize("kind", sorted(INDEXES))
+def test_search_options_do_not_change_the_index(gallery, kind):
+    x, queries, _ = gallery
+    index = INDEXES[kind](x).build()
+    defaults = (getattr(index, "ef_search", None), getattr(index, "rerank", None))
+    options = si._search_options(index, ef=1, rerank=1)
+    assert len(options) == 1
+    index.search(queries, 10, **options)
+    assert (getattr(index, "ef_search", None), getattr(index, "rerank", None)) == defaults
+
+
+@pytest.mark.parametrize("dtype", si.QuantizedIndex.DTYPES)
+def test_quantized_index_rejects_zero_rerank(gallery, dtype):
+    x, queries, _ = gallery
+    with pytest.raises(ValueError):
+        si.QuantizedIndex(x, "cosine", dtype, rerank=0)
+    index = si.QuantizedIndex(x, "cosine", dtype).build()
+    with pytest.raises(ValueError):
+        index.search(queries, rerank=0)
+    # pq keeps 0 as "approximate distances only"
+    assert si.PQIndex(x, "cosine").build().search(queries, rerank=0)[0].shape == (50, 600)